@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""
+Small audio I/O helpers shared by the audiobook generator scripts.
+
+Only the standard library is used so the helpers work the same inside
+and outside the containers.
+"""
+
+import os
+import re
+import struct
+import wave
+
+WAV_HEADER_SIZE = 44
+# Bitrates in kbps of MPEG-1 and MPEG-2/2.5 Layer III, by bitrate index
+MP3_BITRATES = (
+    (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+)
+# Sample rates by version bits (MPEG-2.5, reserved, MPEG-2, MPEG-1) and rate index
+MP3_SAMPLE_RATES = {0: (11025, 12000, 8000), 2: (22050, 24000, 16000), 3: (44100, 48000, 32000)}
+# Bytes read after the ID3 tag to find the first frame and its Xing/VBRI header
+MP3_PROBE_BYTES = 16384
+
+
+class StreamingWavWriter:
+    """
+    Write 16-bit PCM WAV incrementally.
+
+    The RIFF and data sizes are patched after every append, so the file is
+    a valid WAV that players can open while it is still being written.
+    """
+
+    def __init__(self, path, sample_rate, channels=1):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.data_size = 0
+        self._file = open(path, "wb")
+        self._write_header()
+
+    def _write_header(self):
+        block_align = self.channels * 2
+        self._file.seek(0)
+        self._file.write(b"RIFF")
+        self._file.write(struct.pack("<I", 36 + self.data_size))
+        self._file.write(b"WAVEfmt ")
+        self._file.write(struct.pack("<IHHIIHH", 16, 1, self.channels, self.sample_rate,
+                                     self.sample_rate * block_align, block_align, 16))
+        self._file.write(b"data")
+        self._file.write(struct.pack("<I", self.data_size))
+
+    def append(self, pcm_bytes):
+        """Append raw little-endian int16 PCM and update the header."""
+        self._file.seek(WAV_HEADER_SIZE + self.data_size)
+        self._file.write(pcm_bytes)
+        self.data_size += len(pcm_bytes)
+        self._write_header()
+        self._file.flush()
+
+    @property
+    def duration(self):
+        """Seconds of audio written so far."""
+        return self.data_size / (self.sample_rate * self.channels * 2)
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def wav_duration(path):
+    """Return the duration of a WAV file in seconds from its header, without decoding."""
+    with wave.open(path, "rb") as f:
+        return f.getnframes() / f.getframerate()
+
+
+def _mp3_frame(data, i):
+    """Return (sample_rate, samples per frame, kbps, side info bytes) of a Layer III frame header at i, or None."""
+    if data[i] != 0xFF or data[i + 1] & 0xE0 != 0xE0:
+        return None
+    version, layer = (data[i + 1] >> 3) & 3, (data[i + 1] >> 1) & 3
+    bitrate_index, rate_index = data[i + 2] >> 4, (data[i + 2] >> 2) & 3
+    if version == 1 or layer != 1 or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+    mono = data[i + 3] >> 6 == 3
+    if version == 3:  # MPEG-1
+        return MP3_SAMPLE_RATES[version][rate_index], 1152, MP3_BITRATES[0][bitrate_index], 17 if mono else 32
+    return MP3_SAMPLE_RATES[version][rate_index], 576, MP3_BITRATES[1][bitrate_index], 9 if mono else 17
+
+
+def mp3_duration(path):
+    """
+    Return the duration of an MP3 file in seconds from its headers, without decoding.
+
+    VBR and LAME files carry the frame count in a Xing/Info (or VBRI) header;
+    the encoder delay and padding recorded by LAME are subtracted, as
+    gapless decoders do. Files without one are assumed to be CBR.
+    """
+    with open(path, "rb") as f:
+        head = f.read(10)
+        offset = 0
+        if head[:3] == b"ID3":
+            offset = 10 + ((head[6] & 0x7F) << 21 | (head[7] & 0x7F) << 14 | (head[8] & 0x7F) << 7 | (head[9] & 0x7F))
+            if head[5] & 0x10:
+                offset += 10  # footer
+        f.seek(offset)
+        data = f.read(MP3_PROBE_BYTES)
+    for i in range(len(data) - 4):
+        frame = _mp3_frame(data, i)
+        if frame is not None:
+            break
+    else:
+        raise ValueError(f"{path}: no MP3 frame found")
+    sample_rate, frame_samples, kbps, side_info = frame
+    xing = i + 4 + side_info
+    if data[xing:xing + 4] in (b"Xing", b"Info"):
+        flags = struct.unpack(">I", data[xing + 4:xing + 8])[0]
+        if flags & 1:
+            samples = struct.unpack(">I", data[xing + 8:xing + 12])[0] * frame_samples
+            lame = xing + 8 + 4 * bool(flags & 1) + 4 * bool(flags & 2) + 100 * bool(flags & 4) + 4 * bool(flags & 8)
+            if data[lame:lame + 4] == b"LAME":
+                delay_padding = int.from_bytes(data[lame + 21:lame + 24], "big")
+                samples -= (delay_padding >> 12) + (delay_padding & 0xFFF)
+            return samples / sample_rate
+    vbri = i + 4 + 32
+    if data[vbri:vbri + 4] == b"VBRI":
+        return struct.unpack(">I", data[vbri + 14:vbri + 18])[0] * frame_samples / sample_rate
+    size = os.path.getsize(path) - offset - i
+    with open(path, "rb") as f:
+        f.seek(-128, os.SEEK_END)
+        if f.read(3) == b"TAG":
+            size -= 128
+    return size * 8 / (kbps * 1000)
+
+
+def audio_duration(path):
+    """Return the duration of a WAV or MP3 file in seconds from its headers."""
+    if path.lower().endswith(".wav"):
+        return wav_duration(path)
+    if path.lower().endswith(".mp3"):
+        return mp3_duration(path)
+    raise ValueError(f"{path}: only WAV and MP3 durations can be read from headers")
+
+
+def chapter_markers(files, titles, pause_seconds=0.0):
+    """
+    Return (title, start, end) in seconds of each file, played back to back.
+
+    pause_seconds is the silence after each file, as combine_audio_files
+    inserts it. Only headers are read, so this takes milliseconds even for
+    a 40-hour book.
+    """
+    markers, start = [], 0.0
+    for path, title in zip(files, titles):
+        end = start + audio_duration(path)
+        markers.append((title, start, end))
+        start = end + pause_seconds
+    return markers
+
+
+def _ffmetadata_escape(value):
+    return re.sub(r"([=;#\\\n])", r"\\\1", str(value))
+
+
+def write_ffmetadata(path, markers, metadata=None):
+    """Atomically write an FFMETADATA1 file with a chapter per (title, start, end) marker."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(";FFMETADATA1\n")
+        for key, value in (metadata or {}).items():
+            f.write(f"{key}={_ffmetadata_escape(value)}\n")
+        for title, start, end in markers:
+            f.write(f"\n[CHAPTER]\nTIMEBASE=1/1000\nSTART={round(start * 1000)}\nEND={round(end * 1000)}\n"
+                    f"title={_ffmetadata_escape(title)}\n")
+    os.replace(tmp_path, path)
+
+
+def write_chapter_metadata(output_path, files, titles, pause_seconds=0.0, metadata=None):
+    """
+    Write the chapter markers of an audiobook assembled from chapter files.
+
+    The markers go to <output_path without extension>.ffmetadata, for
+    'ffmpeg -i book.mp3 -i book.ffmetadata -map_metadata 1 -map_chapters 1'.
+    Returns the path; raises ValueError for files whose duration is not in their headers.
+    """
+    path = os.path.splitext(output_path)[0] + ".ffmetadata"
+    write_ffmetadata(path, chapter_markers(files, titles, pause_seconds), metadata)
+    return path
+
+
+def write_wav(path, pcm_bytes, sample_rate, channels=1):
+    """Write 16-bit PCM to a WAV file."""
+    with wave.open(path, "wb") as f:
+        f.setnchannels(channels)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(pcm_bytes)
+
+
+def read_wav(path):
+    """Return the PCM bytes and sample rate of a 16-bit WAV file."""
+    with wave.open(path, "rb") as f:
+        return f.readframes(f.getnframes()), f.getframerate()
+
+
+def write_playlist(path, files):
+    """Atomically write an M3U playlist of files, relative to the playlist's directory."""
+    base = os.path.dirname(os.path.abspath(path))
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write("#EXTM3U\n")
+        for file_path in files:
+            f.write(os.path.relpath(os.path.abspath(file_path), base) + "\n")
+    os.replace(tmp_path, path)
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+Single-pass muxing of an audiobook into M4B (AAC) or MKA (Opus).
+
+The PCM of the chunks (stored chunks or WAV files, see chunk_store) or
+chapter WAV files is streamed into one ffmpeg process, which encodes it
+once and writes the container with chapter atoms, title and author
+metadata and the cover image. Chapter boundaries come from the chunk
+index or WAV headers before encoding starts, so they are exact, and no
+intermediate MP3 is decoded or re-encoded. encode_audio streams chunks
+the same way into a plain audio file, such as a chapter MP3.
+"""
+
+import os
+import subprocess
+import tempfile
+
+from audio_io import write_ffmetadata
+from chunk_store import PcmReader
+from job_manifest import part_path
+from metrics import METRICS
+
+# Output extension: (ffmpeg muxer, audio encoder arguments)
+CONTAINERS = {
+    ".m4b": ("mp4", ["-c:a", "aac"]),
+    ".m4a": ("mp4", ["-c:a", "aac"]),
+    # Opus only encodes at 48 kHz among the usual TTS rates
+    ".mka": ("matroska", ["-c:a", "libopus", "-ar", "48000"]),
+}
+COVER_EXTENSIONS = {"image/jpeg": ".jpg", "image/png": ".png", "image/gif": ".gif"}
+
+
+def is_container(path):
+    """Return True if path is an audiobook container written by mux_audiobook."""
+    return os.path.splitext(path)[1].lower() in CONTAINERS
+
+
+def _format(sources, reader):
+    """Return the (sample rate, channels) shared by sources, and each source's frame count."""
+    fmt, frames = None, []
+    for source in sources:
+        sample_rate, channels, count = reader.format(source)
+        frames.append(count)
+        if fmt is None:
+            fmt = (sample_rate, channels)
+        elif (sample_rate, channels) != fmt:
+            raise ValueError(f"{source}: {sample_rate} Hz/{channels} ch differs from {fmt[0]} Hz/{fmt[1]} ch")
+    return fmt, frames
+
+
+def _stream(command, chapters, reader, file_silence, chapter_silence, output_path):
+    """Run an ffmpeg command reading PCM from stdin, and write the chapters' sources to it."""
+    process = subprocess.Popen(command, stdin=subprocess.PIPE)
+    try:
+        for _, sources in chapters:
+            for source in sources:
+                for block in reader.blocks(source):
+                    process.stdin.write(block)
+                process.stdin.write(file_silence)
+            process.stdin.write(chapter_silence)
+        process.stdin.close()
+    except BrokenPipeError:
+        pass  # ffmpeg exited early; its status is checked below
+    if process.wait() != 0:
+        raise RuntimeError(f"ffmpeg exited with status {process.returncode} while writing {output_path}")
+
+
+def encode_audio(output_path, sources, file_pause=0.0, audio_format="mp3", part_tag=None):
+    """
+    Encode sources in order into one audio file, e.g. a chapter MP3, in one ffmpeg pass.
+
+    Args:
+        output_path (str): Output file; written atomically.
+        sources (list): WAV files or chunk locators.
+        file_pause (float): Seconds of silence after every source.
+        audio_format (str): ffmpeg output format.
+        part_tag (str): Tag of the in-progress file (see job_manifest.part_path).
+    """
+    reader = PcmReader()
+    try:
+        (sample_rate, channels), _ = _format(sources, reader)
+        silence = bytes(round(file_pause * sample_rate) * 2 * channels)
+        command = ["ffmpeg", "-y", "-loglevel", "error", "-f", "s16le", "-ar", str(sample_rate), "-ac", str(channels),
+                   "-i", "pipe:0", "-f", audio_format, part_path(output_path, part_tag)]
+        with METRICS.timer("encode_audio", format=audio_format):
+            _stream(command, [(None, sources)], reader, silence, b"", output_path)
+    finally:
+        reader.close()
+    os.replace(part_path(output_path, part_tag), output_path)
+
+
+def mux_audiobook(output_path, chapters, metadata=None, cover=None, file_pause=0.0, chapter_pause=0.0, bitrate="64k"):
+    """
+    Encode chapters into an M4B or MKA audiobook in one ffmpeg pass.
+
+    Args:
+        output_path (str): .m4b, .m4a or .mka file; written atomically.
+        chapters (list): (title, WAV files or chunk locators) per chapter, in order.
+        metadata (dict): Global tags, e.g. title and artist.
+        cover (tuple): (image bytes, media type) attached as the cover, or None.
+        file_pause (float): Seconds of silence after every file, as combine_audio_files inserts.
+        chapter_pause (float): Seconds of extra silence after every chapter.
+        bitrate (str): Audio bitrate passed to the encoder.
+
+    Returns the (title, start, end) chapter markers in seconds.
+    """
+    reader = PcmReader()
+    try:
+        return _mux(output_path, chapters, reader, metadata, cover, file_pause, chapter_pause, bitrate)
+    finally:
+        reader.close()
+
+
+def _mux(output_path, chapters, reader, metadata, cover, file_pause, chapter_pause, bitrate):
+    muxer, codec = CONTAINERS[os.path.splitext(output_path)[1].lower()]
+    (sample_rate, channels), frames = _format([path for _, files in chapters for path in files], reader)
+    frame_bytes = 2 * channels
+    file_silence = bytes(round(file_pause * sample_rate) * frame_bytes)
+    chapter_silence = bytes(round(chapter_pause * sample_rate) * frame_bytes)
+
+    # Chapter boundaries from the chunk index and WAV headers, before anything is encoded
+    markers, position, counts = [], 0, iter(frames)
+    for title, files in chapters:
+        start = position
+        for _ in files:
+            position += next(counts) + len(file_silence) // frame_bytes
+        markers.append((title, start / sample_rate, position / sample_rate))
+        position += len(chapter_silence) // frame_bytes
+
+    with tempfile.TemporaryDirectory(prefix="mux_", dir=os.path.dirname(os.path.abspath(output_path))) as work_dir:
+        metadata_path = os.path.join(work_dir, "chapters.ffmetadata")
+        write_ffmetadata(metadata_path, markers, {key: value for key, value in (metadata or {}).items() if value})
+        inputs = ["-f", "s16le", "-ar", str(sample_rate), "-ac", str(channels), "-i", "pipe:0", "-i", metadata_path]
+        outputs = ["-map", "0:a", "-map_metadata", "1", "-map_chapters", "1"] + codec + ["-b:a", bitrate]
+        if cover:
+            cover_path = os.path.join(work_dir, "cover" + COVER_EXTENSIONS.get(cover[1], ".jpg"))
+            with open(cover_path, "wb") as f:
+                f.write(cover[0])
+            if muxer == "mp4":
+                # MP4 carries the cover as an attached picture stream
+                inputs += ["-i", cover_path]
+                outputs += ["-map", "2:v", "-c:v", "copy", "-disposition:v:0", "attached_pic"]
+            else:
+                outputs += ["-attach", cover_path, "-metadata:s:t", f"mimetype={cover[1]}",
+                            "-metadata:s:t", f"filename={os.path.basename(cover_path)}"]
+        command = ["ffmpeg", "-y", "-loglevel", "error"] + inputs + outputs + ["-f", muxer, part_path(output_path)]
+
+        print(f"Encoding {len(chapters)} chapters into {output_path}...")
+        with METRICS.timer("mux_audiobook"):
+            _stream(command, chapters, reader, file_silence, chapter_silence, output_path)
+    os.replace(part_path(output_path), output_path)
+    return markers
@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmarks on synthetic books.
+
+Generates synthetic EPUBs (hundreds of spine items) and PDFs (hundreds of
+pages) of configurable size, then times text extraction, chapter
+detection, the chunkers, concatenation and MP3 export, and a full Piper
+pipeline run with the synthetic TTS backend (--fake_tts), so no model is
+needed. Results are written as JSON; the compare command flags benchmarks
+that got slower than a stored baseline.
+
+Usage:
+    python benchmark.py run --output bench.json [--epub_chapters 300] [--pdf_pages 300] [--repeat 3]
+    python benchmark.py run --output bench.json --baseline baseline.json
+    python benchmark.py compare baseline.json bench.json [--threshold 0.15]
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+WORDS = ("the", "a", "river", "light", "quiet", "house", "stood", "beyond", "morning", "she", "he", "they",
+         "remembered", "letter", "window", "under", "old", "garden", "walked", "slowly", "towards", "city",
+         "never", "again", "voice", "called", "from", "distant", "hills", "and", "with", "evening", "bright",
+         "cold", "wind", "across", "fields", "story", "began", "long", "ago", "when", "nobody", "knew",
+         "answer", "question", "door", "opened", "silence", "fell", "between", "them", "road", "north")
+# Slowdown beyond which a benchmark is flagged, and the absolute change below which it is noise
+DEFAULT_THRESHOLD = 0.15
+MIN_DELTA_SECONDS = 0.005
+
+
+def sentence(rng):
+    words = [rng.choice(WORDS) for _ in range(rng.randint(8, 20))]
+    return " ".join(words).capitalize() + rng.choice((".", ".", ".", "?", "!"))
+
+
+def paragraph(rng):
+    return " ".join(sentence(rng) for _ in range(rng.randint(4, 8)))
+
+
+def make_epub(path, chapters=300, paragraphs=5, seed=0):
+    """Write a synthetic EPUB 2 with one spine item per chapter."""
+    rng = random.Random(seed)
+    items = [f"chap_{i:04d}" for i in range(1, chapters + 1)]
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as z:
+        # The mimetype must come first and be stored uncompressed
+        z.writestr("mimetype", "application/epub+zip", compress_type=zipfile.ZIP_STORED)
+        z.writestr("META-INF/container.xml",
+                   '<?xml version="1.0"?>\n<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+                   '<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>'
+                   '</rootfiles></container>')
+        manifest = "".join(f'<item id="{item}" href="{item}.xhtml" media-type="application/xhtml+xml"/>' for item in items)
+        spine = "".join(f'<itemref idref="{item}"/>' for item in items)
+        z.writestr("OEBPS/content.opf",
+                   '<?xml version="1.0" encoding="utf-8"?>\n'
+                   '<package xmlns="http://www.idpf.org/2007/opf" version="2.0" unique-identifier="id">'
+                   '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/"><dc:title>Synthetic Book</dc:title>'
+                   f'<dc:identifier id="id">synthetic-{seed}-{chapters}</dc:identifier><dc:language>en</dc:language></metadata>'
+                   f'<manifest><item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>{manifest}</manifest>'
+                   f'<spine toc="ncx">{spine}</spine></package>')
+        points = "".join(f'<navPoint id="np{i}" playOrder="{i}"><navLabel><text>Chapter {i}</text></navLabel>'
+                         f'<content src="{item}.xhtml"/></navPoint>' for i, item in enumerate(items, 1))
+        z.writestr("OEBPS/toc.ncx",
+                   '<?xml version="1.0" encoding="utf-8"?>\n<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">'
+                   f'<head><meta name="dtb:uid" content="synthetic-{seed}-{chapters}"/></head>'
+                   f'<docTitle><text>Synthetic Book</text></docTitle><navMap>{points}</navMap></ncx>')
+        for i, item in enumerate(items, 1):
+            body = "".join(f"<p>{paragraph(rng)}</p>" for _ in range(paragraphs))
+            z.writestr(f"OEBPS/{item}.xhtml",
+                       '<?xml version="1.0" encoding="utf-8"?>\n<html xmlns="http://www.w3.org/1999/xhtml">'
+                       f'<head><title>Chapter {i}</title></head><body><h1>Chapter {i}: {sentence(rng)[:-1]}</h1>{body}</body></html>')
+    return path
+
+
+def _pdf_escape(text):
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def make_pdf(path, pages=300, pages_per_chapter=10, seed=0, lines_per_page=50, chars_per_line=90):
+    """Write a synthetic text PDF with a 'Chapter N' heading every pages_per_chapter pages."""
+    rng = random.Random(seed)
+    objects = [None, None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    page_ids = []
+    for page in range(pages):
+        lines = []
+        if page % pages_per_chapter == 0:
+            lines.append(f"Chapter {page // pages_per_chapter + 1}")
+        text = ""
+        while len(lines) < lines_per_page:
+            text += sentence(rng) + " "
+            while len(text) > chars_per_line and len(lines) < lines_per_page:
+                cut = text.rfind(" ", 0, chars_per_line)
+                lines.append(text[:cut])
+                text = text[cut + 1:]
+        lines.append(f"Page {page + 1} of {pages}")
+        stream = "BT /F1 10 Tf 12 TL 50 800 Td " + " ".join(f"({_pdf_escape(line)}) Tj T*" for line in lines) + " ET"
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream".encode("latin-1"))
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 842] /Contents {len(objects)} 0 R "
+                       "/Resources << /Font << /F1 3 0 R >> >> >>".encode())
+        page_ids.append(len(objects))
+    objects[0] = b"<< /Type /Catalog /Pages 2 0 R >>"
+    objects[1] = f"<< /Type /Pages /Count {pages} /Kids [{' '.join(f'{i} 0 R' for i in page_ids)}] >>".encode()
+
+    with open(path, "wb") as f:
+        f.write(b"%PDF-1.4\n")
+        offsets = []
+        for number, body in enumerate(objects, 1):
+            offsets.append(f.tell())
+            f.write(f"{number} 0 obj\n".encode() + body + b"\nendobj\n")
+        xref = f.tell()
+        f.write(f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode())
+        f.write("".join(f"{offset:010d} 00000 n \n" for offset in offsets).encode())
+        f.write(f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode())
+    return path
+
+
+def measure(func, repeat):
+    """Run func repeat times; returns the wall seconds of each run and the last result."""
+    runs, result = [], None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        runs.append(time.perf_counter() - start)
+    return runs, result
+
+
+def summarize(runs, **params):
+    return {"runs": [round(run, 4) for run in runs], "median": round(statistics.median(runs), 4),
+            "min": round(min(runs), 4), "max": round(max(runs), 4), "params": params}
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=SCRIPT_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_text(args, fixtures, results):
+    """Extraction, chapter detection and chunking."""
+    import text_extraction
+
+    runs, chapters = measure(lambda: list(text_extraction.iter_chapters(fixtures["epub"])), args.repeat)
+    results["extract_epub"] = summarize(runs, spine_items=args.epub_chapters, chapters=len(chapters))
+    runs, (pdf_chapters, _) = measure(lambda: text_extraction.extract_text_from_pdf(fixtures["pdf"]), args.repeat)
+    results["extract_pdf"] = summarize(runs, pages=args.pdf_pages, chapters=len(pdf_chapters))
+
+    full_text = "\n".join(pdf_chapters)
+    runs, (detected, _) = measure(lambda: text_extraction.detect_chapters_in_text(full_text), args.repeat)
+    results["detect_chapters_in_text"] = summarize(runs, chars=len(full_text), chapters=len(detected))
+
+    book_text = " ".join(text for text, _ in chapters)
+    runs, chunks = measure(lambda: text_extraction.split_text_into_chunks(book_text, args.chunk_size), args.repeat)
+    results["split_text_into_chunks"] = summarize(runs, chars=len(book_text), chunk_size=args.chunk_size, chunks=len(chunks))
+    try:
+        from generate_audiobook_sesame import split_text
+    except (ImportError, SystemExit) as e:
+        results["sesame_split_text"] = {"skipped": f"Sesame script unavailable: {e}"}
+    else:
+        runs, chunks = measure(lambda: split_text(book_text, max_length=args.chunk_length), args.repeat)
+        results["sesame_split_text"] = summarize(runs, chars=len(book_text), chunk_length=args.chunk_length, chunks=len(chunks))
+
+
+def bench_concat(args, work_dir, results):
+    """Concatenation and MP3 export of synthetic chunk files, and streaming encode of the same chunks from a chunk store."""
+    from audio_io import write_wav
+    from audiobook_mux import encode_audio
+    from chunk_store import ChunkStore
+    from fake_tts import FakeTTS
+    from generate_audiobook_piper import combine_audio_files, PAUSE_MS
+
+    chunk_dir = os.path.join(work_dir, "concat")
+    os.makedirs(chunk_dir, exist_ok=True)
+    voice, rng = FakeTTS(), random.Random(args.seed)
+    store = ChunkStore(os.path.join(chunk_dir, "chapter_01.pcm"))
+    files, locators = [], []
+    for i in range(args.concat_chunks):
+        path = os.path.join(chunk_dir, f"chunk_{i:04d}.wav")
+        pcm = voice.synthesize(" ".join(sentence(rng) for _ in range(3)))
+        write_wav(path, pcm, voice.sample_rate)
+        store.append(i, pcm, voice.sample_rate)
+        files.append(path)
+        locators.append(store.locator(i))
+    store.close()
+    output = os.path.join(work_dir, "concat.mp3")
+    runs, _ = measure(lambda: combine_audio_files(files, output), args.repeat)
+    results["concat_export_mp3"] = summarize(runs, chunks=len(files), output_bytes=os.path.getsize(output))
+    runs, _ = measure(lambda: encode_audio(output, locators, PAUSE_MS / 1000), args.repeat)
+    results["chunk_store_encode_mp3"] = summarize(runs, chunks=len(locators), output_bytes=os.path.getsize(output))
+
+
+def bench_pipeline(args, work_dir, results):
+    """A full Piper run with the synthetic backend, from a fresh job directory each time."""
+    book = make_epub(os.path.join(work_dir, "pipeline.epub"), args.pipeline_chapters, args.paragraphs, args.seed)
+    runs, stage_metrics = [], None
+    for attempt in range(args.repeat):
+        job_dir = os.path.join(work_dir, f"pipeline_{attempt}")
+        shutil.rmtree(job_dir, ignore_errors=True)
+        os.makedirs(job_dir)
+        command = [sys.executable, os.path.join(SCRIPT_DIR, "generate_audiobook_piper.py"), "--input", book,
+                   "--output", os.path.join(job_dir, "book.mp3"), "--output_dir", os.path.join(job_dir, "chapters"),
+                   "--temp_dir", os.path.join(job_dir, "temp"), "--fake_tts", "--fake_speed", str(args.fake_speed),
+                   "--chunk_size", str(args.chunk_size), "--stats_file", os.path.join(job_dir, "throughput.json"),
+                   "--pipeline_metrics", os.path.join(job_dir, "pipeline.json")]
+        start = time.perf_counter()
+        # Answer the prompt about removing temporary files
+        completed = subprocess.run(command, input="n\n", capture_output=True, text=True)
+        runs.append(time.perf_counter() - start)
+        if completed.returncode != 0:
+            results["pipeline_piper_fake"] = {"skipped": f"exit code {completed.returncode}: {completed.stderr[-500:]}"}
+            return
+        with open(os.path.join(job_dir, "pipeline.json")) as f:
+            stage_metrics = json.load(f)
+    results["pipeline_piper_fake"] = summarize(runs, chapters=args.pipeline_chapters, fake_speed=args.fake_speed)
+    results["pipeline_piper_fake"]["stages"] = stage_metrics
+
+
+def run(args):
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="audiobook_bench_")
+    os.makedirs(work_dir, exist_ok=True)
+    sys.path.insert(0, SCRIPT_DIR)
+    print(f"Generating fixtures in {work_dir}...")
+    fixtures = {
+        "epub": make_epub(os.path.join(work_dir, "book.epub"), args.epub_chapters, args.paragraphs, args.seed),
+        "pdf": make_pdf(os.path.join(work_dir, "book.pdf"), args.pdf_pages, args.pages_per_chapter, args.seed),
+    }
+    results = {}
+    benchmarks = [("text", lambda: bench_text(args, fixtures, results)),
+                  ("concat", lambda: bench_concat(args, work_dir, results)),
+                  ("pipeline", lambda: bench_pipeline(args, work_dir, results))]
+    for name, bench in benchmarks:
+        if args.only and name not in args.only:
+            continue
+        print(f"Running {name} benchmarks...")
+        try:
+            bench()
+        except ImportError as e:
+            results[name] = {"skipped": f"missing dependency: {e}"}
+        except Exception as e:
+            # e.g. no ffmpeg for the MP3 export; the other groups still run
+            results[name] = {"skipped": f"failed: {e}"}
+
+    report = {
+        "created": time.time(),
+        "commit": git_commit(),
+        "host": socket.gethostname(),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "config": {name: value for name, value in vars(args).items() if name not in ("command", "output", "baseline")},
+        "benchmarks": results,
+    }
+    print_results(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+    if not args.work_dir:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if args.baseline:
+        return compare(args.baseline, report, args.threshold)
+    return 0
+
+
+def print_results(results):
+    print(f"\n{'benchmark':<28} {'median s':>10} {'min s':>9} {'max s':>9}")
+    for name, result in results.items():
+        if "skipped" in result:
+            print(f"{name:<28} skipped: {result['skipped']}")
+        else:
+            print(f"{name:<28} {result['median']:>10.3f} {result['min']:>9.3f} {result['max']:>9.3f}")
+
+
+def _load_report(report):
+    if isinstance(report, dict):
+        return report
+    with open(report) as f:
+        return json.load(f)
+
+
+def compare(baseline, current, threshold=DEFAULT_THRESHOLD):
+    """Print median changes against a baseline; returns 1 if any benchmark regressed."""
+    baseline, current = _load_report(baseline), _load_report(current)
+    print(f"\nComparing against baseline {baseline.get('commit') or '?'} from {baseline.get('host')}")
+    if baseline.get("host") != current.get("host"):
+        print("Warning: the baseline was recorded on another host")
+    print(f"{'benchmark':<28} {'baseline s':>10} {'current s':>10} {'change':>8}")
+    regressions = []
+    for name, result in current["benchmarks"].items():
+        before = baseline["benchmarks"].get(name)
+        if "skipped" in result or not before or "skipped" in before:
+            print(f"{name:<28} {'-':>10} {result.get('median', '-'):>10} {'n/a':>8}")
+            continue
+        change = (result["median"] - before["median"]) / before["median"] if before["median"] else 0.0
+        regressed = change > threshold and result["median"] - before["median"] > MIN_DELTA_SECONDS
+        if regressed:
+            regressions.append(name)
+        print(f"{name:<28} {before['median']:>10.3f} {result['median']:>10.3f} {change:>+8.1%}"
+              + ("  REGRESSION" if regressed else ""))
+    if regressions:
+        print(f"\n{len(regressions)} benchmarks regressed by more than {threshold:.0%}: {', '.join(regressions)}")
+        return 1
+    print(f"\nNo regressions beyond {threshold:.0%}")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark extraction, chunking, assembly and pipeline runs on synthetic books")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    run_parser = subparsers.add_parser("run", help="Run the benchmarks")
+    run_parser.add_argument("--output", default=None, help="Write the results to this JSON file")
+    run_parser.add_argument("--baseline", default=None, help="Compare the results against this earlier results file")
+    run_parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="Median slowdown flagged as a regression (0.15: 15%%)")
+    run_parser.add_argument("--only", nargs="+", choices=["text", "concat", "pipeline"], help="Run only these benchmark groups")
+    run_parser.add_argument("--work_dir", default=None, help="Keep fixtures and outputs in this directory (default: a temporary directory)")
+    run_parser.add_argument("--repeat", type=int, default=3, help="Runs per benchmark; the median is compared")
+    run_parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic text")
+    run_parser.add_argument("--epub_chapters", type=int, default=300, help="Spine items in the synthetic EPUB")
+    run_parser.add_argument("--paragraphs", type=int, default=5, help="Paragraphs per EPUB chapter")
+    run_parser.add_argument("--pdf_pages", type=int, default=300, help="Pages in the synthetic PDF")
+    run_parser.add_argument("--pages_per_chapter", type=int, default=10, help="PDF pages between chapter headings")
+    run_parser.add_argument("--chunk_size", type=int, default=1000, help="Chunk size for the Piper chunker and pipeline")
+    run_parser.add_argument("--chunk_length", type=int, default=500, help="Chunk length for the Sesame chunker")
+    run_parser.add_argument("--concat_chunks", type=int, default=60, help="Chunk files concatenated and exported")
+    run_parser.add_argument("--pipeline_chapters", type=int, default=12, help="Chapters in the book of the pipeline run")
+    run_parser.add_argument("--fake_speed", type=float, default=0.0, help="Characters per second of the synthetic backend in the pipeline run (0: instantly)")
+    compare_parser = subparsers.add_parser("compare", help="Compare two results files")
+    compare_parser.add_argument("baseline", help="Baseline results (JSON)")
+    compare_parser.add_argument("current", help="Current results (JSON)")
+    compare_parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="Median slowdown flagged as a regression (0.15: 15%%)")
+    args = parser.parse_args()
+    if args.command == "compare":
+        return compare(args.baseline, args.current, args.threshold)
+    return run(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+"""
+Append-only per-chapter store of synthesized chunk audio.
+
+Every chunk used to be its own chunk_XXXX.wav file, so a long book left
+5-20k small files in the temp directory, which is slow on NFS (every
+create, rename and stat is a round trip) and slow to clean up. A
+ChunkStore keeps all chunks of a chapter in three files:
+
+- ``chapter_NN.pcm``: the 16-bit PCM of the chunks, appended one after another.
+- ``chapter_NN.pcm.idx``: a header with a random token, then one fixed-size
+  record (chunk, offset, length, sample rate, channels) per appended chunk.
+  A record is appended only after the chunk's PCM is fsync'd, so it is the
+  commit point of the chunk: PCM without a record (a writer killed while
+  appending) is ignored, and so is a torn last record.
+- ``chapter_NN.pcm.lock``: flock'd around every append, index load and
+  compaction, so worker processes on this host or, over NFS, on others
+  (a lease taken over from a hung worker) can append to one store.
+
+A re-rendered chunk is appended again and its newest record wins. compact()
+rewrites the store with only the newest PCM of each chunk, in chunk order.
+Readers map the PCM file with mmap and get memoryviews of it, so assembling
+a chapter copies no audio in Python. A mapping stays valid when compaction
+replaces the files; readers load the new ones at their next refresh.
+
+Chunks are addressed by locators, "<store path>#<chunk>", which
+PcmReader accepts wherever a WAV file path is accepted too.
+"""
+
+import mmap
+import os
+import struct
+import threading
+import wave
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # e.g. Windows: the threads of one process are still serialized
+
+STORE_EXTENSION = ".pcm"
+INDEX_MAGIC = b"CHUNKIDX"
+# Magic and the token of one generation of the store
+HEADER = struct.Struct("<8s8s")
+# Chunk, offset, length, sample rate, channels
+RECORD = struct.Struct("<IQQIH")
+# Suffix of the files a compaction writes before replacing the store
+COMPACT_SUFFIX = ".compact"
+# Compact a store once superseded PCM takes up more than this fraction of it
+COMPACT_GARBAGE = 0.25
+# Frames read per block from WAV files
+WAV_BLOCK_FRAMES = 1 << 16
+
+
+def store_path(temp_dir, chapter_num):
+    """Return the path of a chapter's chunk store in a temp directory."""
+    return os.path.join(temp_dir, f"chapter_{chapter_num:02d}{STORE_EXTENSION}")
+
+
+def parse_locator(source):
+    """Return (store path, chunk) of a chunk locator, or None for a file path."""
+    path, sep, chunk = source.rpartition("#")
+    if sep and path.endswith(STORE_EXTENSION) and chunk.isdigit():
+        return path, int(chunk)
+    return None
+
+
+class ChunkStore:
+    """
+    The chunks of one chapter, in an append-only PCM file with an offset index.
+
+    Args:
+        path (str): The store's PCM file; the index and lock files are named after it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.index_path = path + ".idx"
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.entries = {}
+        self._token = None
+        self._index_size = 0
+        self._data = None
+        self._map = None
+        self._writers = None
+        self._thread_lock = threading.RLock()
+        self._lock_file = open(path + ".lock", "a")
+        self.refresh()
+
+    @contextmanager
+    def _locked(self):
+        with self._thread_lock:
+            if fcntl:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _recover(self):
+        # A compaction writes the new index, then the new PCM, then replaces the index,
+        # then the PCM; a new PCM file without a new index is the only state to finish
+        index_tmp, data_tmp = self.index_path + COMPACT_SUFFIX, self.path + COMPACT_SUFFIX
+        if os.path.exists(index_tmp):
+            for path in (index_tmp, data_tmp):
+                if os.path.exists(path):
+                    os.remove(path)
+        elif os.path.exists(data_tmp):
+            os.replace(data_tmp, self.path)
+
+    def _close_files(self):
+        for f in (self._writers or ()) + ((self._data,) if self._data else ()):
+            f.close()
+        self._writers = self._data = self._map = None
+
+    def _refresh(self):
+        self._recover()
+        try:
+            index = open(self.index_path, "rb")
+        except FileNotFoundError:
+            return
+        with index:
+            header = index.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return  # torn header of a store that was never written to
+            token = HEADER.unpack(header)[1]
+            if token != self._token:
+                # A new store, or one replaced by compaction: load it from the start.
+                # Memoryviews of the old mapping stay valid
+                self._close_files()
+                self.entries, self._token, self._index_size = {}, token, HEADER.size
+                self._data = open(self.path, "rb")
+            index.seek(self._index_size)
+            data = index.read()
+        usable = len(data) - len(data) % RECORD.size
+        for chunk, offset, length, sample_rate, channels in RECORD.iter_unpack(data[:usable]):
+            self.entries[chunk] = (offset, length, sample_rate, channels)
+        self._index_size += usable
+
+    def refresh(self):
+        """Load the chunks other writers appended since the last refresh."""
+        with self._locked():
+            self._refresh()
+
+    def __contains__(self, chunk):
+        return chunk in self.entries
+
+    def locator(self, chunk):
+        """Return the locator of a chunk, e.g. for the job manifest and PcmReader."""
+        return f"{self.path}#{chunk}"
+
+    def append(self, chunk, pcm, sample_rate, channels=1):
+        """Append the 16-bit PCM of a chunk, replacing any earlier version, and fsync it."""
+        with self._locked():
+            self._refresh()
+            if self._writers is None:
+                self._writers = (open(self.path, "ab"), open(self.index_path, "ab"))
+            data, index = self._writers
+            offset = data.seek(0, os.SEEK_END)
+            data.write(pcm)
+            data.flush()
+            os.fsync(data.fileno())
+            size = index.seek(0, os.SEEK_END)
+            if size < HEADER.size:
+                index.truncate(0)
+                index.write(HEADER.pack(INDEX_MAGIC, os.urandom(8)))
+            elif (size - HEADER.size) % RECORD.size:
+                # A writer died mid-record; drop the torn record so records stay aligned
+                index.truncate(size - (size - HEADER.size) % RECORD.size)
+            index.write(RECORD.pack(chunk, offset, len(pcm), sample_rate, channels))
+            index.flush()
+            os.fsync(index.fileno())
+            self._refresh()
+
+    def _entry(self, chunk):
+        if chunk not in self.entries:
+            self.refresh()
+        if chunk not in self.entries:
+            raise KeyError(f"{self.path}: chunk {chunk} is not stored")
+        return self.entries[chunk]
+
+    def format(self, chunk):
+        """Return the (sample rate, channels, frames) of a stored chunk."""
+        _, length, sample_rate, channels = self._entry(chunk)
+        return sample_rate, channels, length // (2 * channels)
+
+    def read(self, chunk):
+        """Return the PCM of a stored chunk as a memoryview of the mapped store, without copying."""
+        with self._thread_lock:
+            offset, length, _, _ = self._entry(chunk)
+            if not length:
+                return memoryview(b"")
+            if self._map is None or offset + length > len(self._map):
+                # The store grew since it was mapped
+                self._map = mmap.mmap(self._data.fileno(), 0, access=mmap.ACCESS_READ)
+            return memoryview(self._map)[offset:offset + length]
+
+    def garbage_bytes(self):
+        """Return the bytes of PCM superseded by newer versions of their chunks, or never committed."""
+        with self._locked():
+            self._refresh()
+            size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+            return size - sum(length for _, length, _, _ in self.entries.values())
+
+    def compact(self):
+        """Rewrite the store with only the newest PCM of each chunk, in chunk order; return the bytes reclaimed."""
+        with self._locked():
+            self._refresh()
+            if not self.entries:
+                return 0
+            before = os.path.getsize(self.path)
+            index_tmp, data_tmp = self.index_path + COMPACT_SUFFIX, self.path + COMPACT_SUFFIX
+            records, offset = [], 0
+            for chunk in sorted(self.entries):
+                _, length, sample_rate, channels = self.entries[chunk]
+                records.append(RECORD.pack(chunk, offset, length, sample_rate, channels))
+                offset += length
+            with open(index_tmp, "wb") as f:
+                f.write(HEADER.pack(INDEX_MAGIC, os.urandom(8)) + b"".join(records))
+                f.flush()
+                os.fsync(f.fileno())
+            with open(self.path, "rb") as source, open(data_tmp, "wb") as f:
+                for chunk in sorted(self.entries):
+                    chunk_offset, length, _, _ = self.entries[chunk]
+                    source.seek(chunk_offset)
+                    f.write(source.read(length))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(index_tmp, self.index_path)
+            os.replace(data_tmp, self.path)
+            self._refresh()
+            return before - offset
+
+    def close(self):
+        with self._thread_lock:
+            self._close_files()
+            self._lock_file.close()
+
+
+class PcmReader:
+    """16-bit PCM of WAV files and stored chunks, given as file paths or chunk locators."""
+
+    def __init__(self):
+        self._stores = {}
+
+    def _store(self, path):
+        if path not in self._stores:
+            self._stores[path] = ChunkStore(path)
+        return self._stores[path]
+
+    def format(self, source):
+        """Return the (sample rate, channels, frames) of a source."""
+        stored = parse_locator(source)
+        if stored:
+            return self._store(stored[0]).format(stored[1])
+        with wave.open(source, "rb") as f:
+            if f.getsampwidth() != 2:
+                raise ValueError(f"{source}: only 16-bit WAV is supported")
+            return f.getframerate(), f.getnchannels(), f.getnframes()
+
+    def blocks(self, source):
+        """Yield the PCM of a source; a stored chunk is a single memoryview of its store's mapping."""
+        stored = parse_locator(source)
+        if stored:
+            yield self._store(stored[0]).read(stored[1])
+            return
+        with wave.open(source, "rb") as f:
+            while True:
+                block = f.readframes(WAV_BLOCK_FRAMES)
+                if not block:
+                    break
+                yield block
+
+    def close(self):
+        for store in self._stores.values():
+            store.close()
+        self._stores = {}
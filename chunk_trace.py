@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+"""
+Per-chunk JSONL trace and analyzer.
+
+Every synthesized chunk appends one record to the trace: book, chapter,
+chunk index, characters, tokens, audio seconds produced, wall time,
+backend, voice, worker id, retry count and status. The analyzer reads one
+or more traces and reports the slowest chunks, the real-time-factor
+distribution per voice, chunks whose audio seconds per character is far
+from the voice's norm (very short audio suggests truncation, very long
+audio suggests silence or babbling), and real-time factor by chunk size
+to help tune --chunk_size / --chunk_length.
+
+Usage:
+    python chunk_trace.py analyze temp_audio/trace.jsonl [--top 20] [--threshold 3.5]
+"""
+
+import argparse
+import json
+import os
+import socket
+import statistics
+import sys
+import threading
+import time
+
+TRACE_NAME = "trace.jsonl"
+
+
+class ChunkTrace:
+    """
+    Append-only JSONL trace of synthesized chunks, safe to share between threads.
+
+    Args:
+        path (str): Trace file; records are appended to an existing trace.
+        backend (str): TTS backend of the run.
+        voice (str): Voice model or preset name.
+        worker_id (str): Worker that synthesized the chunks (default: host and pid).
+    """
+
+    def __init__(self, path, backend, voice, worker_id=None):
+        self.path = path
+        self.backend = backend
+        self.voice = voice
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._file = open(path, "a")
+        self._lock = threading.Lock()
+
+    def record(self, book, chapter, chunk, text, wall_seconds, audio_seconds=None, status="done",
+               retries=0, tokens=None):
+        """Append the record of one chunk."""
+        record = {
+            "time": time.time(),
+            "book": book,
+            "chapter": chapter,
+            "chunk": chunk,
+            "chars": len(text),
+            "words": len(text.split()),
+            "tokens": tokens,
+            "audio_seconds": round(audio_seconds, 3) if audio_seconds else None,
+            "wall_seconds": round(wall_seconds, 3),
+            "backend": self.backend,
+            "voice": self.voice,
+            "worker": self.worker_id,
+            "retries": retries,
+            "status": status,
+        }
+        with self._lock:
+            self._file.write(json.dumps(record) + "\n")
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def load_records(paths):
+    """Read the records of one or more traces, skipping torn lines."""
+    records = []
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+    return records
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def _voice(record):
+    return f"{record['backend']}/{record['voice']}"
+
+
+def slowest(records, top):
+    """Return the top slowest chunks by wall time."""
+    return sorted(records, key=lambda r: -r["wall_seconds"])[:top]
+
+
+def rtf_by_voice(records):
+    """Return the real-time-factor distribution (wall seconds per audio second) per voice."""
+    by_voice = {}
+    for r in records:
+        if r["status"] == "done" and r["audio_seconds"]:
+            by_voice.setdefault(_voice(r), []).append(r["wall_seconds"] / r["audio_seconds"])
+    return {voice: {"chunks": len(v), "mean": statistics.mean(v), "p10": _percentile(v, 0.1),
+                    "p50": _percentile(v, 0.5), "p90": _percentile(v, 0.9), "p99": _percentile(v, 0.99)}
+            for voice, v in by_voice.items()}
+
+
+def anomalies(records, threshold=3.5):
+    """
+    Return chunks whose audio seconds per character is an outlier for their voice.
+
+    Uses the modified z-score (median and median absolute deviation), so the
+    outliers themselves do not skew the norm.
+    """
+    by_voice = {}
+    for r in records:
+        if r["status"] == "done" and r["audio_seconds"] and r["chars"]:
+            by_voice.setdefault(_voice(r), []).append(r)
+    flagged = []
+    for voice, rs in by_voice.items():
+        ratios = [r["audio_seconds"] / r["chars"] for r in rs]
+        median = statistics.median(ratios)
+        mad = statistics.median(abs(x - median) for x in ratios)
+        if mad == 0:
+            continue
+        for r, x in zip(rs, ratios):
+            score = 0.6745 * (x - median) / mad
+            if abs(score) > threshold:
+                flagged.append({**r, "seconds_per_char": x, "voice_median": median, "score": score,
+                                "reason": "short audio (truncation?)" if score < 0 else "long audio (silence?)"})
+    return sorted(flagged, key=lambda r: -abs(r["score"]))
+
+
+def by_chunk_size(records, bin_chars=250):
+    """Return real-time factor and failure rate per chunk-size bin, per voice."""
+    bins = {}
+    for r in records:
+        key = (_voice(r), r["chars"] // bin_chars * bin_chars)
+        entry = bins.setdefault(key, {"chunks": 0, "failed": 0, "wall": 0.0, "audio": 0.0})
+        entry["chunks"] += 1
+        if r["status"] != "done":
+            entry["failed"] += 1
+        elif r["audio_seconds"]:
+            entry["wall"] += r["wall_seconds"]
+            entry["audio"] += r["audio_seconds"]
+    return {key: {**entry, "rtf": entry["wall"] / entry["audio"] if entry["audio"] else None}
+            for key, entry in sorted(bins.items())}
+
+
+def _where(r):
+    return f"{r['book']} ch{r['chapter']} #{r['chunk']}"
+
+
+def analyze(paths, top=20, threshold=3.5, bin_chars=250):
+    """Print the trace report."""
+    records = load_records(paths)
+    if not records:
+        print("No trace records found.")
+        return
+    failed = sum(1 for r in records if r["status"] != "done")
+    retried = sum(1 for r in records if r["retries"])
+    print(f"{len(records)} chunks, {failed} failed, {retried} retried, "
+          f"{len({r['worker'] for r in records})} workers, {len({r['book'] for r in records})} books")
+
+    print(f"\nSlowest {top} chunks:")
+    print(f"{'chunk':<40} {'wall s':>8} {'audio s':>8} {'chars':>6} {'retries':>7}  voice")
+    for r in slowest(records, top):
+        print(f"{_where(r):<40} {r['wall_seconds']:>8.1f} {r['audio_seconds'] or 0:>8.1f} {r['chars']:>6} "
+              f"{r['retries']:>7}  {_voice(r)}")
+
+    print("\nReal-time factor (wall seconds per audio second) by voice:")
+    print(f"{'voice':<40} {'chunks':>6} {'mean':>6} {'p10':>6} {'p50':>6} {'p90':>6} {'p99':>6}")
+    for voice, d in rtf_by_voice(records).items():
+        print(f"{voice:<40} {d['chunks']:>6} {d['mean']:>6.2f} {d['p10']:>6.2f} {d['p50']:>6.2f} "
+              f"{d['p90']:>6.2f} {d['p99']:>6.2f}")
+
+    flagged = anomalies(records, threshold)
+    print(f"\nChunks with anomalous audio seconds per character ({len(flagged)}):")
+    for r in flagged[:top]:
+        print(f"{_where(r):<40} {r['seconds_per_char'] * 1000:>7.1f} ms/char (voice median "
+              f"{r['voice_median'] * 1000:.1f})  {r['reason']}")
+
+    print(f"\nBy chunk size ({bin_chars}-character bins):")
+    print(f"{'voice':<40} {'chars':>9} {'chunks':>6} {'failed':>6} {'rtf':>6}")
+    for (voice, low), d in by_chunk_size(records, bin_chars).items():
+        rtf = f"{d['rtf']:.2f}" if d["rtf"] is not None else "-"
+        print(f"{voice:<40} {f'{low}-{low + bin_chars - 1}':>9} {d['chunks']:>6} {d['failed']:>6} {rtf:>6}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Analyze per-chunk synthesis traces")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    analyze_parser = subparsers.add_parser("analyze", help="Report slow and anomalous chunks")
+    analyze_parser.add_argument("traces", nargs="+", help="Trace files (JSONL)")
+    analyze_parser.add_argument("--top", type=int, default=20, help="Number of chunks to list")
+    analyze_parser.add_argument("--threshold", type=float, default=3.5, help="Modified z-score above which a chunk is anomalous")
+    analyze_parser.add_argument("--bin_chars", type=int, default=250, help="Chunk-size bin width in characters")
+    args = parser.parse_args()
+    analyze(args.traces, args.top, args.threshold, args.bin_chars)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
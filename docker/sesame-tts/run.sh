@@ -19,6 +19,9 @@ else
     echo "Bitsandbytes should be installed. You can test it with:"
     echo "  python /opt/audiobook/docker/sesame-tts/utils/test_bitsandbytes.py"
     echo ""
+    echo "Benchmark synthesis speed and memory with:"
+    echo "  python /opt/audiobook/docker/sesame-tts/utils/test_csm.py --benchmark"
+    echo ""
     echo "Starting interactive shell..."
     echo "================================"
     exec /bin/bash
@@ -9,8 +9,8 @@ than patching to maintain a cleaner separation between our code and the
 upstream implementation.
 """
 
-import traceback
 import logging
+import re
 import sys
 import os
 
@@ -72,12 +72,55 @@ except ImportError as e:
     logger.warning(f"Could not import CSM generator: {e}")
     logger.warning("This is expected during development but should work in the container")
 
+class GenerationFailedError(RuntimeError):
+    """
+    Raised when a chunk could not be synthesized even after splitting it
+    at sentence boundaries and retrying the pieces.
+
+    Attributes:
+        spans (list): Outcome of every span that was attempted, in text order.
+            Successful spans carry their audio under the "audio" key so the
+            caller can keep them and only re-synthesize the failed ones.
+    """
+
+    def __init__(self, message, spans):
+        super().__init__(message)
+        self.spans = spans
+
+    @property
+    def failed_spans(self):
+        return [span for span in self.spans if span["status"] == "failed"]
+
+
+def split_sentences(text):
+    """
+    Return (start, end) character offsets of the sentences in text.
+
+    A regex is used rather than nltk so the generator has no extra
+    dependencies inside the container.
+    """
+    offsets = []
+    for match in re.finditer(r'\S.*?(?:[.!?]+["\')\]]*(?=\s|$)|$)', text, flags=re.DOTALL):
+        if match.group().strip():
+            offsets.append((match.start(), match.end()))
+    return offsets
+
+
 class AudiobookGenerator(OriginalGenerator):
     """
     Enhanced version of the CSM Generator with additional error handling
     and features specifically for audiobook generation.
+
+    When the upstream generator raises, the text is split at sentence
+    boundaries and the pieces are retried with proportionally smaller
+    audio budgets instead of padding the book with silence.
     """
-    
+
+    # How many times a failing span may be halved before giving up
+    max_split_depth = 3
+    # Smallest audio budget handed to a retried span
+    min_audio_length_ms = 5000
+
     def generate(self, text, speaker, context=None, max_audio_length_ms=30000, temperature=0.8, topk=50):
         """
         Wrapper around the original generate method with additional error handling
@@ -92,7 +135,30 @@ class AudiobookGenerator(OriginalGenerator):
             topk (int): Top-k for sampling
             
         Returns:
-            torch.Tensor: Audio tensor (silent audio on error)
+            torch.Tensor: Audio tensor on the generator's device
+
+        Raises:
+            GenerationFailedError: If any sentence span still fails after
+                splitting. The per-span outcomes are attached to the error
+                and also kept in ``self.last_outcomes``.
+        """
+        spans = self.generate_spans(text, speaker, context, max_audio_length_ms, temperature, topk)
+        failed = [span for span in spans if span["status"] == "failed"]
+        if failed:
+            raise GenerationFailedError(
+                f"{len(failed)} of {len(spans)} spans failed to generate", spans)
+        return torch.cat([span["audio"] for span in spans])
+
+    def generate_spans(self, text, speaker, context=None, max_audio_length_ms=30000,
+                       temperature=0.8, topk=50, offset=0):
+        """
+        Generate audio for text, splitting and retrying on failure.
+
+        Returns a list of span dicts in text order with the keys
+        start, end (character offsets into text, shifted by offset), text,
+        status ("ok" or "failed"), depth, max_audio_length_ms, error and
+        audio (tensor, or None for failed spans). The same list without
+        the audio is stored in ``self.last_outcomes``.
         """
         # Safely handle the case when no context is provided
         if context is None:
@@ -101,17 +167,133 @@ class AudiobookGenerator(OriginalGenerator):
         # Validate all inputs
         if not isinstance(text, str) or not text.strip():
             raise ValueError("Text must be a non-empty string")
-            
+
+        spans = []
+        self._generate_span(text, offset, 0, speaker, context, max_audio_length_ms,
+                            temperature, topk, spans)
+        self.last_outcomes = [{k: v for k, v in span.items() if k != "audio"} for span in spans]
+        return spans
+
+    def _generate_span(self, text, offset, depth, speaker, context, max_audio_length_ms,
+                       temperature, topk, spans):
+        span = {
+            "start": offset,
+            "end": offset + len(text),
+            "text": text,
+            "depth": depth,
+            "max_audio_length_ms": max_audio_length_ms,
+        }
         try:
             # Call the original generate method
-            return super().generate(text, speaker, context, max_audio_length_ms, temperature, topk)
+            audio = super().generate(text, speaker, context, max_audio_length_ms, temperature, topk)
+            spans.append(dict(span, status="ok", error=None, audio=audio.to(self.device)))
+            return
         except Exception as e:
-            logger.error(f"Error in generate: {e}")
-            traceback.print_exc()
-            # Return silent audio instead of failing
-            return torch.zeros(int(self.sample_rate * (max_audio_length_ms / 1000))).to("cuda")
+            logger.error(f"Error in generate (depth {depth}, {len(text)} chars): {e}")
+            error = str(e)
+            self._release_device_memory()
+
+        sentences = split_sentences(text)
+        if depth >= self.max_split_depth or len(sentences) < 2:
+            spans.append(dict(span, status="failed", error=error, audio=None))
+            return
 
-def load_csm_1b(*args, **kwargs):
+        # Split into two halves of roughly equal length at a sentence boundary
+        midpoint = len(text) / 2
+        cut = min(sentences[1:], key=lambda s: abs(s[0] - midpoint))[0]
+        for start, end in ((0, cut), (cut, len(text))):
+            part = text[start:end]
+            stripped = part.strip()
+            if not stripped:
+                continue
+            lead = len(part) - len(part.lstrip())
+            budget = max(self.min_audio_length_ms,
+                         int(max_audio_length_ms * len(stripped) / len(text)))
+            self._generate_span(stripped, offset + start + lead, depth + 1, speaker, context,
+                                budget, temperature, topk, spans)
+
+    def generate_stream(self, text, speaker, context=None, max_audio_length_ms=30000,
+                        temperature=0.8, topk=50, frames_per_chunk=4):
+        """
+        Generate audio incrementally, yielding decoded audio as it is produced.
+
+        Mirrors the upstream generate loop, but decodes the Mimi codes with
+        the audio tokenizer in streaming mode every frames_per_chunk frames
+        (one frame is 80 ms) instead of once at the end. The first audio is
+        therefore available after a few frames rather than after the whole
+        chunk.
+
+        Streamed audio is not watermarked frame by frame; watermark the
+        assembled stream instead.
+
+        Yields:
+            torch.Tensor: 1-D audio at self.sample_rate on the generator's device
+        """
+        if context is None:
+            context = []
+        if not isinstance(text, str) or not text.strip():
+            raise ValueError("Text must be a non-empty string")
+
+        if not hasattr(self._audio_tokenizer, "streaming"):
+            # The tokenizer cannot decode incrementally; fall back to one block
+            yield super().generate(text, speaker, context, max_audio_length_ms, temperature, topk)
+            return
+
+        self._model.reset_caches()
+        max_generation_len = int(max_audio_length_ms / 80)
+
+        tokens, tokens_mask = [], []
+        for segment in context:
+            segment_tokens, segment_tokens_mask = self._tokenize_segment(segment)
+            tokens.append(segment_tokens)
+            tokens_mask.append(segment_tokens_mask)
+        gen_segment_tokens, gen_segment_tokens_mask = self._tokenize_text_segment(text, speaker)
+        tokens.append(gen_segment_tokens)
+        tokens_mask.append(gen_segment_tokens_mask)
+
+        prompt_tokens = torch.cat(tokens, dim=0).long().to(self.device)
+        prompt_tokens_mask = torch.cat(tokens_mask, dim=0).bool().to(self.device)
+
+        curr_tokens = prompt_tokens.unsqueeze(0)
+        curr_tokens_mask = prompt_tokens_mask.unsqueeze(0)
+        curr_pos = torch.arange(0, prompt_tokens.size(0)).unsqueeze(0).long().to(self.device)
+
+        max_seq_len = 2048
+        if curr_tokens.size(1) >= max_seq_len - max_generation_len:
+            raise ValueError(
+                f"Inputs too long, must be below max_seq_len - max_generation_len: {max_seq_len - max_generation_len}")
+
+        pending = []
+        with torch.inference_mode(), self._audio_tokenizer.streaming(1):
+            for _ in range(max_generation_len):
+                sample = self._model.generate_frame(curr_tokens, curr_tokens_mask, curr_pos, temperature, topk)
+                if torch.all(sample == 0):
+                    break  # eos
+
+                pending.append(sample)
+                if len(pending) >= frames_per_chunk:
+                    yield self._decode_frames(pending)
+                    pending = []
+
+                curr_tokens = torch.cat([sample, torch.zeros(1, 1).long().to(self.device)], dim=1).unsqueeze(1)
+                curr_tokens_mask = torch.cat(
+                    [torch.ones_like(sample).bool(), torch.zeros(1, 1).bool().to(self.device)], dim=1
+                ).unsqueeze(1)
+                curr_pos = curr_pos[:, -1:] + 1
+
+            if pending:
+                yield self._decode_frames(pending)
+
+    def _decode_frames(self, frames):
+        """Decode a list of generated frames with the streaming audio tokenizer."""
+        return self._audio_tokenizer.decode(torch.stack(frames).permute(1, 2, 0)).squeeze(0).squeeze(0)
+
+    def _release_device_memory(self):
+        """Free cached allocator blocks before a retry on CUDA devices."""
+        if str(getattr(self, "device", "")).startswith("cuda") and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+def load_csm_1b(*args, defer_watermark=False, **kwargs):
     """
     Drop-in replacement for the original load_csm_1b function that returns
     our enhanced AudiobookGenerator.
@@ -119,7 +301,11 @@ def load_csm_1b(*args, **kwargs):
     Based on examining the original CSM repository, the original load_csm_1b
     returns a Generator instance directly, not a tuple of (model, params).
     
-    All arguments are passed through to the original function.
+    If defer_watermark is True, generated chunks are not watermarked.
+    Instead the generator gets a ``stream_watermarker`` that the caller
+    runs once over the assembled chapter stream.
+
+    All other arguments are passed through to the original function.
     """
     # The original CSM implementation returns a Generator object directly
     original_generator = original_load_csm_1b(*args, **kwargs)
@@ -142,8 +328,16 @@ def load_csm_1b(*args, **kwargs):
     if hasattr(original_generator, '_audio_tokenizer'):
         enhanced_generator._audio_tokenizer = original_generator._audio_tokenizer
     
+    enhanced_generator.stream_watermarker = None
+    if defer_watermark and hasattr(enhanced_generator, '_watermarker'):
+        from watermarking import StreamWatermarker, DummyWatermarker, CSM_1B_GH_WATERMARK
+        enhanced_generator.stream_watermarker = StreamWatermarker(
+            enhanced_generator._watermarker, enhanced_generator.sample_rate, CSM_1B_GH_WATERMARK)
+        # The upstream generate skips watermarking for the dummy watermarker
+        enhanced_generator._watermarker = DummyWatermarker()
+
     # Return our enhanced generator
     return enhanced_generator
 
 # Re-export necessary components to maintain the same interface
-__all__ = ["load_csm_1b", "Segment", "AudiobookGenerator"]
+__all__ = ["load_csm_1b", "Segment", "AudiobookGenerator", "GenerationFailedError", "split_sentences"]
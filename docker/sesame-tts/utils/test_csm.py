@@ -4,12 +4,22 @@ Test script for the CSM text-to-speech system.
 
 This script loads the CSM model and generates a test audio sample
 to verify that the installation is working correctly.
+
+With --benchmark it instead measures model load time, time to the first
+audio frame, generated audio tokens per second, real-time factor and peak
+memory across a matrix of text lengths, voice prompt lengths, devices and
+dtype/quantization settings, and writes the results as JSON so builds of
+the container can be compared (--compare).
 """
 
 import os
 import sys
+import json
+import time
+import socket
 import argparse
 import logging
+import resource
 from pathlib import Path
 
 # Configure logging
@@ -27,8 +37,259 @@ def parse_args():
                         help="Text to synthesize (default: 'This is a test of the Sesame CSM text to speech system.')")
     parser.add_argument("--device", "-d", choices=["cuda", "cpu"], default="cuda",
                         help="Device to use for inference (default: cuda)")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="Run the benchmark matrix instead of the single test sentence")
+    parser.add_argument("--lengths", default="50,200,500",
+                        help="Benchmark: comma-separated text lengths in characters (default: 50,200,500)")
+    parser.add_argument("--context_seconds", default="0,10",
+                        help="Benchmark: comma-separated voice prompt lengths in seconds, 0 for none (default: 0,10)")
+    parser.add_argument("--voice_prompt", default=None,
+                        help="Benchmark: voice prompt WAV (default: speech generated by the model itself)")
+    parser.add_argument("--devices", default=None,
+                        help="Benchmark: comma-separated devices (default: --device)")
+    parser.add_argument("--dtypes", default="bf16",
+                        help="Benchmark: comma-separated settings among bf16, fp16, fp32 and int8 (dynamic int8 quantization, CPU only) (default: bf16)")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Benchmark: runs per configuration (default: 3)")
+    parser.add_argument("--json", default="/audiobook_data/csm_benchmark.json",
+                        help="Benchmark: results file (default: /audiobook_data/csm_benchmark.json)")
+    parser.add_argument("--compare", default=None,
+                        help="Benchmark: earlier results file to compare the real-time factors with")
     return parser.parse_args()
 
+def load_generator(model_path, device):
+    """Load the CSM generator, preferring the audiobook wrapper, which adds generate_stream."""
+    sys.path.append('/opt/utils')
+    try:
+        # The wrapper streams decoded frames, so the time to first audio can be measured
+        import audiobook_generator
+        if audiobook_generator.original_load_csm_1b is None:
+            raise ImportError("audiobook_generator could not import the CSM generator")
+        generator = audiobook_generator.load_csm_1b(model_path=model_path, device=device)
+        logger.info("Successfully imported from audiobook_generator")
+    except ImportError:
+        try:
+            # Try to import from csm package
+            from csm import load_csm_1b
+            generator = load_csm_1b(model_path=model_path, device=device)
+            logger.info("Successfully imported from csm package")
+        except ImportError:
+            # Direct import from module path
+            sys.path.insert(0, "/opt/csm")
+            from generator import load_csm_1b
+            generator = load_csm_1b(model_path=model_path, device=device)
+            logger.info("Successfully imported directly from generator.py")
+    if not hasattr(generator, "generate_stream"):
+        logger.warning("The generator cannot stream; time to first audio is reported as unavailable")
+    return generator
+
+# Passage the benchmark texts are cut from
+BENCHMARK_PASSAGE = (
+    "The old lighthouse keeper climbed the stairs every evening, counting the steps as his father had. "
+    "From the top he could see the whole bay, the fishing boats returning, and the lights of the town "
+    "coming on one by one. Nobody remembered when the lamp had last failed. Still, he checked the wick, "
+    "polished the lens, and wrote the weather in the logbook before he allowed himself to sit down. "
+    "That night the wind came from the north, and the sea turned grey and restless. "
+)
+# One generated audio frame covers 80 ms
+FRAME_SECONDS = 0.08
+
+def benchmark_text(length):
+    """Return about length characters of the benchmark passage, ending at a sentence."""
+    text = BENCHMARK_PASSAGE * (length // len(BENCHMARK_PASSAGE) + 1)
+    end = text.rfind(". ", 0, length + 1)
+    return text[:end + 1] if end > 0 else text[:length]
+
+def apply_dtype(generator, setting, device):
+    """Convert the backbone and decoder to a dtype or quantization setting."""
+    import torch
+    model = generator._model
+    if setting == "int8":
+        if device != "cpu":
+            raise ValueError("dynamic int8 quantization is only available on CPU")
+        model = torch.ao.quantization.quantize_dynamic(model.float(), {torch.nn.Linear}, dtype=torch.qint8)
+        generator._model = model
+    else:
+        dtypes = {"bf16": torch.bfloat16, "fp16": torch.float16, "fp32": torch.float32}
+        model.to(dtype=dtypes[setting])
+    # The KV caches are allocated in the dtype of the parameters
+    if hasattr(model, "setup_caches"):
+        model.setup_caches(1)
+
+def reset_peak_memory(device):
+    import torch
+    if device == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+
+def peak_memory_mb(device):
+    """Peak device memory since the last reset on CUDA; the process's peak RSS on CPU."""
+    import torch
+    if device == "cuda":
+        torch.cuda.synchronize()
+        return torch.cuda.max_memory_allocated() / (1024 * 1024)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def voice_context(generator, prompt_audio, seconds):
+    """Return a context with the first seconds of the prompt audio, or none."""
+    if not seconds or prompt_audio is None:
+        return []
+    try:
+        from generator import Segment
+    except ImportError:
+        from audiobook_generator import Segment
+    audio = prompt_audio[:int(seconds * generator.sample_rate)].to(generator.device)
+    return [Segment(text=benchmark_text(int(seconds * 15)), speaker=0, audio=audio)]
+
+def run_once(generator, text, context, device):
+    """Synthesize text once; returns time to first audio (None without streaming), total time and audio seconds."""
+    reset_peak_memory(device)
+    max_audio_length_ms = max(10_000, len(text) * 150)
+    start = time.perf_counter()
+    first_audio = None
+    samples = 0
+    if hasattr(generator, "generate_stream"):
+        for audio in generator.generate_stream(text, 0, context, max_audio_length_ms=max_audio_length_ms):
+            if first_audio is None:
+                if device == "cuda":
+                    import torch
+                    torch.cuda.synchronize()
+                first_audio = time.perf_counter() - start
+            samples += audio.shape[-1]
+    else:
+        audio = generator.generate(text=text, speaker=0, context=context, max_audio_length_ms=max_audio_length_ms)
+        samples = audio.shape[-1]
+    total = time.perf_counter() - start
+    return first_audio, total, samples / generator.sample_rate
+
+def count_text_tokens(generator, text):
+    tokenizer = getattr(generator, "_text_tokenizer", None)
+    return len(tokenizer.encode(text)) if tokenizer is not None else None
+
+def build_info():
+    """Describe the container build the benchmark ran on."""
+    import torch
+    return {
+        "host": socket.gethostname(),
+        "python": sys.version.split()[0],
+        "torch": torch.__version__,
+        "cuda": torch.version.cuda,
+        "gpu": torch.cuda.get_device_name(0) if torch.cuda.is_available() else None,
+        "image": os.environ.get("IMAGE_TAG") or os.environ.get("CONTAINER_IMAGE"),
+        "time": time.time(),
+    }
+
+def run_benchmark(args):
+    """Run the benchmark matrix and write the results file."""
+    import torch
+    lengths = [int(n) for n in args.lengths.split(",")]
+    context_seconds = [float(n) for n in args.context_seconds.split(",")]
+    devices = (args.devices or args.device).split(",")
+    results = []
+    for device in devices:
+        if device == "cuda" and not torch.cuda.is_available():
+            logger.warning("Skipping cuda: CUDA is not available")
+            continue
+        for setting in args.dtypes.split(","):
+            config = {"device": device, "dtype": setting}
+            reset_peak_memory(device)
+            start = time.perf_counter()
+            try:
+                generator = load_generator(args.model_path, device)
+                apply_dtype(generator, setting, device)
+            except Exception as e:
+                logger.error(f"Skipping {device}/{setting}: {e}")
+                results.append({**config, "error": str(e)})
+                continue
+            load_seconds = time.perf_counter() - start
+            load_peak = peak_memory_mb(device)
+            logger.info(f"{device}/{setting}: model loaded in {load_seconds:.1f}s, peak memory {load_peak:.0f}MB")
+            config.update(load_seconds=round(load_seconds, 3), load_peak_memory_mb=round(load_peak, 1))
+
+            try:
+                results.extend(run_configuration(generator, args, config, lengths, context_seconds))
+            except Exception as e:
+                logger.error(f"{device}/{setting} failed: {e}")
+                results.append({**config, "error": str(e)})
+            del generator
+            if device == "cuda":
+                torch.cuda.empty_cache()
+
+    report = {"build": build_info(), "results": results}
+    output_file = Path(args.json)
+    os.makedirs(output_file.parent, exist_ok=True)
+    with open(output_file, "w") as f:
+        json.dump(report, f, indent=2)
+    logger.info(f"Benchmark results saved to {output_file}")
+    if args.compare:
+        compare_results(args.compare, report)
+    return report
+
+def run_configuration(generator, args, config, lengths, context_seconds):
+    """Benchmark every text and prompt length on a loaded generator."""
+    import torchaudio
+    device, setting = config["device"], config["dtype"]
+    # Warm up kernels and caches before timing anything
+    run_once(generator, benchmark_text(200), [], device)
+    prompt_audio = None
+    if args.voice_prompt:
+        prompt_audio, rate = torchaudio.load(args.voice_prompt)
+        prompt_audio = torchaudio.functional.resample(prompt_audio.mean(dim=0), rate, generator.sample_rate)
+    elif any(context_seconds):
+        # Without a prompt file, the model's own speech serves as the voice prompt
+        prompt_audio = generator.generate(text=benchmark_text(int(max(context_seconds) * 15)), speaker=0, context=[],
+                                          max_audio_length_ms=int(max(context_seconds) * 1000 * 2))
+
+    results = []
+    for seconds in context_seconds:
+        context = voice_context(generator, prompt_audio, seconds)
+        for length in lengths:
+            text = benchmark_text(length)
+            runs = [run_once(generator, text, context, device) for _ in range(args.repeat)]
+            # Without streaming the first audio is the whole chunk, so there is no time to first audio
+            first_audios = sorted(run[0] for run in runs if run[0] is not None)
+            first_audio = first_audios[len(first_audios) // 2] if first_audios else None
+            total = sorted(run[1] for run in runs)[len(runs) // 2]
+            audio_seconds = sum(run[2] for run in runs) / len(runs)
+            result = {
+                **config,
+                "chars": len(text),
+                "text_tokens": count_text_tokens(generator, text),
+                "context_seconds": seconds,
+                "first_audio_seconds": round(first_audio, 3) if first_audio is not None else None,
+                "total_seconds": round(total, 3),
+                "audio_seconds": round(audio_seconds, 3),
+                "audio_tokens_per_second": round(audio_seconds / FRAME_SECONDS / total, 2),
+                "real_time_factor": round(total / audio_seconds, 3) if audio_seconds else None,
+                "peak_memory_mb": round(peak_memory_mb(device), 1),
+                "runs": args.repeat,
+            }
+            results.append(result)
+            first_audio_text = f"{first_audio:.2f}s" if first_audio is not None else "unavailable"
+            logger.info(f"{device}/{setting} {len(text)} chars, {seconds:g}s prompt: first audio "
+                        f"{first_audio_text}, RTF {result['real_time_factor']}, "
+                        f"{result['audio_tokens_per_second']} frames/s, peak {result['peak_memory_mb']:.0f}MB")
+    return results
+
+def _config_key(result):
+    return (result["device"], result["dtype"], result.get("chars"), result.get("context_seconds"))
+
+def compare_results(baseline_path, report):
+    """Log the change in real-time factor against an earlier results file, per configuration."""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    before = {_config_key(r): r for r in baseline["results"] if "error" not in r}
+    logger.info(f"Comparing with {baseline_path} (torch {baseline['build'].get('torch')}, "
+                f"image {baseline['build'].get('image')})")
+    for result in report["results"]:
+        old = before.get(_config_key(result))
+        if "error" in result or old is None or not old["real_time_factor"] or not result["real_time_factor"]:
+            continue
+        change = result["real_time_factor"] / old["real_time_factor"] - 1
+        logger.info(f"{result['device']}/{result['dtype']} {result['chars']} chars, {result['context_seconds']:g}s prompt: "
+                    f"RTF {old['real_time_factor']} -> {result['real_time_factor']} ({change:+.1%}), first audio "
+                    f"{old['first_audio_seconds']}s -> {result['first_audio_seconds']}s")
+
 def main():
     """Run the CSM test."""
     args = parse_args()
@@ -40,26 +301,13 @@ def main():
         logger.info(f"CUDA available: {torch.cuda.is_available()}")
         logger.info(f"Using device: {args.device}")
         
-        # Try multiple import paths for flexibility
-        try:
-            # Try to import from csm_utils (preferred)
-            sys.path.append('/opt/utils')
-            from csm_utils import load_audiobook_model
-            generator = load_audiobook_model(args.model_path, device=args.device)
-            logger.info("Successfully imported from csm_utils")
-        except ImportError:
-            try:
-                # Try to import from csm package
-                from csm import load_csm_1b
-                generator = load_csm_1b(model_path=args.model_path, device=args.device)
-                logger.info("Successfully imported from csm package")
-            except ImportError:
-                # Direct import from module path
-                sys.path.insert(0, "/opt/csm")
-                from generator import load_csm_1b
-                generator = load_csm_1b(model_path=args.model_path, device=args.device)
-                logger.info("Successfully imported directly from generator.py")
+        if args.benchmark:
+            run_benchmark(args)
+            logger.info("✅ Benchmark completed successfully!")
+            return
         
+        # Try multiple import paths for flexibility
+        generator = load_generator(args.model_path, args.device)
         logger.info("CSM imports successful")
         
         # Verify model path exists
@@ -71,7 +319,6 @@ def main():
         logger.info(f"Generating speech for: \"{args.text}\"")
         
         # Time the generation
-        import time
         start_time = time.time()
         
         # Generate audio
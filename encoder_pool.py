@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Parallel chapter encoding in worker processes.
+
+Encoding a chapter streams its chunks' PCM from the chapter's ChunkStore
+(see chunk_store) into an ffmpeg process (see audiobook_mux.encode_audio),
+whose single-threaded MP3 encoder keeps one core busy per chapter. The
+encode stage used to do this for one chapter at a time, so with a fast
+backend the encoder fell behind and the last chapters of a book were
+encoded one after the other once synthesis had finished. EncoderPool runs
+the encodes in worker processes on the cores that synthesis leaves spare,
+while synthesis goes on; the pipeline's encode stage gets one thread per
+worker to keep the pool busy.
+
+Encoded chapters then finish in any order. ChapterOrder tracks how far the
+book can be played from its start without a gap.
+"""
+
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from metrics import METRICS
+
+
+def spare_cores(busy):
+    """Return the number of cores not taken by busy synthesis workers, at least one."""
+    return max(1, (os.cpu_count() or 1) - busy)
+
+
+def _timed_call(func, args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+class EncoderPool:
+    """
+    Worker processes running chapter encodes.
+
+    Args:
+        workers (int): Number of worker processes.
+    """
+
+    def __init__(self, workers):
+        self.workers = max(1, workers)
+        # Workers are forked from a single-threaded server rather than from the
+        # threaded pipeline, where a lock could be held at the moment of the fork
+        method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context(method))
+
+    def run(self, func, *args):
+        """Run func(*args) in a worker process and return its result; func must be a module-level function."""
+        with METRICS.timer("encode_wait"):
+            result, seconds = self._executor.submit(_timed_call, func, args).result()
+        # Metrics recorded inside the worker stay there; its time is recorded here
+        METRICS.observe("stage_seconds", seconds, stage="encode_worker")
+        return result
+
+    def close(self):
+        self._executor.shutdown()
+
+
+class ChapterOrder:
+    """
+    Chapters finishing in any order, against the order they are played in.
+
+    Chapters are numbered consecutively in playing order, so the order is
+    known without reading the book up front.
+
+    Args:
+        first (int): Number of the first chapter.
+    """
+
+    def __init__(self, first=1):
+        self._finished = set()
+        self._next = first
+        self._lock = threading.Lock()
+
+    def finish(self, chapter):
+        """Record a finished chapter and return the chapters it makes playable in order from the start."""
+        with self._lock:
+            self._finished.add(chapter)
+            ready = []
+            while self._next in self._finished:
+                ready.append(self._next)
+                self._next += 1
+            return ready
@@ -7,6 +7,7 @@ from PyPDF2 import PdfReader
 import ebooklib
 from ebooklib import epub
 from bs4 import BeautifulSoup
+from audio_io import chapter_markers, write_ffmetadata
 
 def extract_chapters_from_pdf(pdf_path):
     """Extract potential chapter titles from a PDF file."""
@@ -64,10 +65,14 @@ def extract_chapters_from_epub(epub_path):
         
         def process_toc(toc_items, level=0):
             for item in toc_items:
-                if isinstance(item, tuple):
-                    title, href = item[0], item[1]
-                    # Extract position from href if possible
-                    chapters.append((title, href))
+                if isinstance(item, epub.Link):
+                    chapters.append((item.title, item.href))
+                elif isinstance(item, tuple):
+                    # A section and its children
+                    section, children = item[0], item[1]
+                    if getattr(section, "href", None):
+                        chapters.append((section.title, section.href))
+                    process_toc(children, level + 1)
                 elif isinstance(item, list):
                     process_toc(item, level + 1)
         
@@ -92,9 +97,28 @@ def extract_chapters_from_epub(epub_path):
     
     return chapters
 
+def generate_chapter_markers_from_audio(chapters, audio_files, output_file, pause=0.0):
+    """
+    Generate a chapter markers file for ffmpeg from the chapter audio files.
+
+    Each chapter's length is read from its file's WAV or MP3 header, so the
+    markers are exact and no audio is decoded. Titles come from the book
+    when it lists as many chapters as there are files, otherwise from the
+    file names.
+    """
+    if len(chapters) == len(audio_files):
+        titles = [title for title, _ in chapters]
+    else:
+        print(f"Found {len(chapters)} chapters in the book but {len(audio_files)} audio files; using file names as titles")
+        titles = [os.path.splitext(os.path.basename(path))[0] for path in audio_files]
+    markers = chapter_markers(audio_files, titles, pause)
+    write_ffmetadata(output_file, markers)
+    print(f"Chapter markers for {len(markers)} chapters ({markers[-1][2] / 3600:.2f} hours) written to {output_file}")
+
 def generate_chapter_markers(chapters, duration, output_file):
     """Generate chapter markers file for ffmpeg."""
     print(f"Generating chapter markers for {len(chapters)} chapters...")
+    print("Warning: chapters are spread evenly over --duration; pass --audio for exact markers")
     
     # Calculate approximate time for each chapter (very simple approach)
     time_per_position = duration / (max(1, len(chapters)))
@@ -137,7 +161,9 @@ def main():
     parser = argparse.ArgumentParser(description="Extract chapter information from a book file")
     parser.add_argument("--file", required=True, help="Path to the PDF or EPUB file")
     parser.add_argument("--output", default="chapters.txt", help="Output chapter metadata file")
-    parser.add_argument("--duration", type=float, default=3600, help="Duration of the audiobook in seconds")
+    parser.add_argument("--duration", type=float, default=3600, help="Duration of the audiobook in seconds (without --audio)")
+    parser.add_argument("--audio", nargs="+", default=None, help="Chapter audio files (WAV or MP3) in order, or a directory of chapter_* files as the generators write them; markers use their exact durations")
+    parser.add_argument("--pause", type=float, default=0.0, help="Seconds of silence after each chapter in the combined audiobook")
     parser.add_argument("--format", choices=["pdf", "epub", "auto"], default="auto", 
                          help="Format of the input file (pdf, epub, or auto-detect)")
     args = parser.parse_args()
@@ -170,7 +196,19 @@ def main():
         print(f"{i+1}. {title} (Position: {position})")
     
     # Generate chapter markers file
-    generate_chapter_markers(chapters, args.duration, args.output)
+    if args.audio:
+        audio_files = args.audio
+        if len(audio_files) == 1 and os.path.isdir(audio_files[0]):
+            directory = audio_files[0]
+            audio_files = sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                                 if name.startswith("chapter_") and name.lower().endswith((".wav", ".mp3"))
+                                 and ".part." not in name)
+        if not audio_files:
+            print("No chapter audio files found")
+            return
+        generate_chapter_markers_from_audio(chapters, audio_files, args.output, args.pause)
+    else:
+        generate_chapter_markers(chapters, args.duration, args.output)
 
 if __name__ == "__main__":
     main()
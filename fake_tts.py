@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+Deterministic synthetic TTS backend for benchmarking without models.
+
+Instead of speech, every chunk becomes a sine tone whose pitch is derived
+from the text and whose length is proportional to it, so the same book
+always produces the same audio. Synthesis speed and failures are
+configurable, which lets extraction, chunking, scheduling and assembly be
+measured and regression-tested on a machine without Piper, the CSM weights
+or a GPU.
+
+It is a tts_backends.Backend that can batch and stream, and also
+provides the ``generate``/``generate_stream`` methods of a CSM generator
+for the Sesame scripts.
+"""
+
+import array
+import hashlib
+import math
+import multiprocessing
+import threading
+import time
+
+from tts_backends import Backend, Capabilities
+
+# Audio produced per character, matching typical narration speed
+AUDIO_CHARS_PER_SECOND = 15.0
+# Length of the frames yielded by generate_stream, as decoded by CSM
+FRAME_SECONDS = 0.08
+AMPLITUDE = 0.3
+MAX_BATCH_SIZE = 16
+
+
+class FakeTTS(Backend):
+    """
+    Synthetic voice producing tones at a configurable speed.
+
+    Args:
+        sample_rate (int): Sample rate of the produced audio.
+        chars_per_second (float): Characters synthesized per second; 0 synthesizes instantly.
+        latency (float): Fixed seconds added to every call, like a model's per-call overhead;
+            a batch pays it once.
+        failure_rate (float): Fraction of synthesis attempts that fail.
+        seed (int): Seed of the pitches and of the attempts chosen to fail.
+    """
+
+    name = "fake"
+
+    def __init__(self, sample_rate=22050, chars_per_second=0.0, latency=0.0, failure_rate=0.0, seed=0):
+        super().__init__("tone", sample_rate, Capabilities(
+            batching=True, streaming=True, max_concurrency=multiprocessing.cpu_count(),
+            max_batch_size=MAX_BATCH_SIZE))
+        self.chars_per_second = chars_per_second
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.seed = seed
+        self._attempts = {}
+        self._lock = threading.Lock()
+
+    def _digest(self, *parts):
+        return hashlib.sha256(":".join(str(part) for part in (self.seed,) + parts).encode()).digest()
+
+    def _attempt(self, text):
+        """Count an attempt at text; returns True if this attempt is chosen to fail."""
+        with self._lock:
+            attempt = self._attempts.get(text, 0)
+            self._attempts[text] = attempt + 1
+        # Each retry of a chunk draws again, so failed chunks succeed on resume
+        draw = int.from_bytes(self._digest(text, attempt)[:8], "big") / 2 ** 64
+        return draw < self.failure_rate
+
+    def _wait(self, chars):
+        seconds = self.latency + (chars / self.chars_per_second if self.chars_per_second else 0.0)
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def audio_seconds(self, text):
+        return max(FRAME_SECONDS, len(text) / AUDIO_CHARS_PER_SECOND)
+
+    def pcm(self, text):
+        """Return the 16-bit mono PCM of text's tone."""
+        frequency = 200 + self._digest(text)[0] * 2
+        period = max(2, round(self.sample_rate / frequency))
+        cycle = array.array("h", (int(32767 * AMPLITUDE * math.sin(2 * math.pi * i / period)) for i in range(period)))
+        samples = int(self.audio_seconds(text) * self.sample_rate)
+        audio = cycle * (samples // period + 1)
+        del audio[samples:]
+        return audio.tobytes()
+
+    def synthesize(self, text):
+        """Return text's tone as PCM; raises RuntimeError for an injected failure."""
+        return self.synthesize_batch([text])[0]
+
+    def synthesize_batch(self, texts):
+        self._wait(sum(len(text) for text in texts))
+        failed = [text for text in texts if self._attempt(text)]
+        if failed:
+            raise RuntimeError(f"Injected synthesis failure ({len(failed)} of {len(texts)} texts)")
+        return [self.pcm(text) for text in texts]
+
+    def stream(self, text, max_audio_length_ms=90_000):
+        """Yield text's tone frame by frame, at the configured speed."""
+        pcm = self.pcm(text)[:int(max_audio_length_ms / 1000 * self.sample_rate) * 2]
+        frame_bytes = int(FRAME_SECONDS * self.sample_rate) * 2
+        frames = max(1, math.ceil(len(pcm) / frame_bytes))
+        self._wait(0)
+        fails = self._attempt(text)
+        for i in range(frames):
+            if self.chars_per_second:
+                time.sleep(len(text) / self.chars_per_second / frames)
+            if fails and i == frames // 2:
+                raise RuntimeError("Injected synthesis failure")
+            yield pcm[i * frame_bytes:(i + 1) * frame_bytes]
+
+    def _tensor(self, pcm):
+        import torch
+        return torch.frombuffer(bytearray(pcm), dtype=torch.int16).float() / 32768
+
+    def generate(self, text, speaker=0, context=None, max_audio_length_ms=90_000, **kwargs):
+        """Return text's tone as a float tensor, like the CSM generator."""
+        self._wait(len(text))
+        if self._attempt(text):
+            raise RuntimeError("Injected synthesis failure")
+        return self._tensor(self.pcm(text)[:int(max_audio_length_ms / 1000 * self.sample_rate) * 2])
+
+    def generate_stream(self, text, speaker=0, context=None, max_audio_length_ms=90_000, **kwargs):
+        """Yield text's tone as float tensor frames, like the CSM generator."""
+        for pcm in self.stream(text, max_audio_length_ms):
+            yield self._tensor(pcm)
+
+
+def add_arguments(parser):
+    """Add the --fake_tts options to a generator's argument parser."""
+    parser.add_argument("--fake_tts", action='store_true', help="Use a synthetic backend producing tones instead of speech (no model needed; for benchmarks and tests)")
+    parser.add_argument("--fake_speed", type=float, default=0.0, help="Characters the synthetic backend synthesizes per second (0: instantly)")
+    parser.add_argument("--fake_latency", type=float, default=0.0, help="Seconds the synthetic backend adds to every chunk")
+    parser.add_argument("--fake_failure_rate", type=float, default=0.0, help="Fraction of synthetic synthesis attempts that fail")
+    parser.add_argument("--fake_seed", type=int, default=0, help="Seed of the synthetic backend's tones and failures")
+
+
+def from_args(args, sample_rate=22050):
+    """Return the FakeTTS selected on the command line, or None."""
+    if not args.fake_tts:
+        return None
+    return FakeTTS(sample_rate=sample_rate, chars_per_second=args.fake_speed, latency=args.fake_latency,
+                   failure_rate=args.fake_failure_rate, seed=args.fake_seed)
@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+"""
+Generate audiobooks for a whole library in one process.
+
+Voice models are loaded once and stay resident for every book: the Sesame
+generator is shared by all chapters, and Piper voices are kept loaded in a
+pool of long-lived Piper processes or an onnxruntime session. Worker
+counts and batching follow the backend's capabilities (see tts_backends).
+Chapters from all active books are interleaved round-robin into one
+chapter pipeline, so a long book does not hold up the others, and each
+book gets a completion report in its output directory.
+"""
+
+import argparse
+import copy
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from pydub import AudioSegment
+from tqdm import tqdm
+
+from audio_io import write_chapter_metadata, write_playlist
+from chunk_trace import ChunkTrace, TRACE_NAME
+from encoder_pool import EncoderPool, spare_cores
+from job_manifest import JobManifest
+from memory_governor import MemoryGovernor
+import metrics
+from metrics import METRICS, timed
+from pipeline import Pipeline, Stage
+from profiling import start_profiler, section
+import fake_tts
+from tts_backends import add_piper_arguments, piper_backend_from_args, SesameBackend, worker_count
+from text_extraction import iter_chapters
+
+BOOK_EXTENSIONS = ('.epub', '.pdf')
+REPORT_NAME = "report.json"
+
+
+def find_books(library_dir=None, books_file=None):
+    """Return the book paths from a library directory and/or a books file."""
+    books = []
+    if library_dir:
+        for root, _, files in os.walk(library_dir):
+            books.extend(os.path.join(root, name) for name in files if name.lower().endswith(BOOK_EXTENSIONS))
+        books.sort()
+    if books_file:
+        with open(books_file) as f:
+            content = f.read()
+        try:
+            listed = json.loads(content)
+        except json.JSONDecodeError:
+            # One path per line; blank lines and comments are ignored
+            listed = [line.strip() for line in content.splitlines() if line.strip() and not line.startswith('#')]
+        base = os.path.dirname(os.path.abspath(books_file))
+        books.extend(path if os.path.isabs(path) else os.path.join(base, path) for path in listed)
+    return books
+
+
+def make_books(paths, args):
+    """Create the per-book state: output directory, per-book args and report counters."""
+    books, names = [], set()
+    for path in paths:
+        if not os.path.exists(path) or not path.lower().endswith(BOOK_EXTENSIONS):
+            print(f"Skipping '{path}': not an existing EPUB or PDF file")
+            continue
+        name = os.path.splitext(os.path.basename(path))[0]
+        if name in names:
+            name = f"{name}_{len(books) + 1}"
+        names.add(name)
+
+        book_dir = os.path.join(args.output_root, name)
+        book_args = copy.copy(args)
+        book_args.input = path
+        book_args.output_dir = book_dir
+        book_args.temp_dir = os.path.join(book_dir, "temp_audio")
+        os.makedirs(book_args.temp_dir, exist_ok=True)
+        books.append({
+            "name": name,
+            "input": path,
+            "dir": book_dir,
+            "args": book_args,
+            "manifest": None,
+            "selected": [],
+            "titles": {},
+            "finished": {},
+            "error": None,
+            "start": None,
+            "first_chapter": None,
+            "end": None,
+        })
+    return books
+
+
+def book_chapters(book):
+    """Yield (book, chapter) items for one book, recording which chapters were read."""
+    try:
+        for chapter_num, (chapter_text, chapter_title) in enumerate(iter_chapters(book["input"]), 1):
+            if book["start"] is None:
+                book["start"] = time.time()
+            book["selected"].append(chapter_num)
+            book["titles"][chapter_num] = chapter_title
+            yield book, (chapter_num, chapter_text, chapter_title)
+    except Exception as e:
+        print(f"Error reading {book['input']}: {e}")
+        book["error"] = str(e)
+
+
+def interleave(books, active_books):
+    """
+    Yield chapters from up to active_books books at a time, round-robin.
+
+    A new book joins as soon as an active one runs out of chapters, so every
+    book in flight gets an equal share of the pipeline.
+    """
+    waiting = list(books)
+    active = []
+    while waiting or active:
+        while waiting and len(active) < active_books:
+            active.append(book_chapters(waiting.pop(0)))
+        for stream in list(active):
+            item = next(stream, None)
+            if item is None:
+                active.remove(stream)
+                continue
+            yield item
+
+
+def per_book(func):
+    """Wrap a chapter stage so its input and output carry the book they belong to."""
+    def stage(item):
+        book, value = item
+        result = func(book, value)
+        return None if result is None else (book, result)
+    return stage
+
+
+@timed("combine_chapters")
+def combine_chapters(chapter_outputs, output_path, titles):
+    """Concatenate chapter files into one audiobook file, with its chapter markers next to it."""
+    combined = AudioSegment.empty()
+    for chapter_output in tqdm(chapter_outputs, desc="Combining chapters"):
+        combined += AudioSegment.from_file(chapter_output)
+    combined.export(output_path, format=os.path.splitext(output_path)[1].lstrip('.') or 'mp3')
+    # Chapter lengths come from the chapter files' headers, so no audio is decoded again
+    try:
+        write_chapter_metadata(output_path, chapter_outputs, titles,
+                               metadata={"title": os.path.splitext(os.path.basename(output_path))[0]})
+    except (ValueError, OSError) as e:
+        print(f"Could not write chapter markers for {output_path}: {e}")
+
+
+def write_report(book, args):
+    """Write the per-book completion report and return it."""
+    completed = [{"chapter": num, "output": book["finished"][num]} for num in sorted(book["finished"])]
+    failed = [num for num in book["selected"] if num not in book["finished"]]
+    report = {
+        "book": book["name"],
+        "input": book["input"],
+        "backend": args.backend,
+        "chapters_total": len(book["selected"]),
+        "chapters_completed": completed,
+        "chapters_failed": failed,
+        "error": book["error"],
+        "combined_output": book.get("combined"),
+        "complete": bool(book["selected"]) and not failed and book["error"] is None,
+        "time_to_first_chapter_seconds": round(book["first_chapter"] - book["start"], 2) if book["first_chapter"] else None,
+        "wall_seconds": round(book["end"] - book["start"], 2) if book["start"] and book["end"] else None,
+    }
+    with open(os.path.join(book["dir"], REPORT_NAME), "w") as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+def piper_stages(books, args, governor):
+    """Chapter stages for Piper, sharing one resident voice (a process pool or an onnxruntime session)."""
+    import generate_audiobook_piper as piper
+
+    backend = fake_tts.from_args(args) or piper_backend_from_args(args, os.path.join(args.output_root, ".piper_pool"))
+    governor.max_concurrency = worker_count(backend.capabilities, args.max_workers)
+    print(f"Backend {backend.name}/{backend.voice}: {backend.capabilities.summary()}")
+    for book in books:
+        book["manifest"] = JobManifest(book["args"].temp_dir)
+
+    throughput = piper.voice_throughput(args)
+    trace = ChunkTrace(args.trace or os.path.join(args.output_root, TRACE_NAME), throughput.backend, throughput.voice)
+    # Chapters of all books are encoded in worker processes on the cores synthesis leaves spare
+    encode_workers = spare_cores(governor.max_concurrency) if args.encode_workers is None else args.encode_workers
+    encoder = EncoderPool(encode_workers) if encode_workers > 0 else None
+    stages = [
+        Stage("chunk", per_book(lambda book, chapter: piper.chunk_chapter(chapter, book["args"], book["manifest"]))),
+        Stage("synthesize", per_book(lambda book, chunked: piper.synthesize_chapter(
+            chunked, book["args"], governor, book["manifest"], backend, throughput, trace)), workers=args.workers),
+        Stage("encode", per_book(lambda book, synthesized: piper.encode_chapter(synthesized, book["args"], encoder)),
+              workers=encoder.workers if encoder else 1),
+    ]
+    def shutdown():
+        if encoder:
+            encoder.close()
+        backend.close()
+        trace.close()
+    return stages, shutdown, throughput
+
+
+def sesame_stages(books, args, governor, profiler=None):
+    """Chapter stages for Sesame, sharing one generator loaded on the model's device."""
+    import torch
+    import generate_audiobook_sesame as sesame
+
+    voice_preset_path = None
+    if args.voice_preset:
+        voice_preset_path = sesame.find_voice_preset_file(args.model_path, args.voice_preset)
+        if not voice_preset_path:
+            print(f"Warning: Could not find voice preset '{args.voice_preset}'. Proceeding without voice preset context.")
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    print(f"Loading Sesame CSM model from '{args.model_path}' on {device}...")
+    load_start = time.time()
+    generator = sesame.load_generator(args, device)
+    capabilities = SesameBackend(generator, load_seconds=time.time() - load_start).capabilities
+    governor.max_concurrency = capabilities.max_concurrency
+    print(f"Backend sesame: {capabilities.summary()}")
+    if profiler:
+        profiler.wrap_generator(generator)
+
+    # One generator on one device: chapters are synthesized one at a time
+    throughput = sesame.voice_throughput(args)
+    trace = ChunkTrace(args.trace or os.path.join(args.output_root, TRACE_NAME), throughput.backend, throughput.voice)
+    stages = [
+        Stage("chunk", per_book(lambda book, chapter: sesame.chunk_chapter(chapter, book["args"]))),
+        Stage("synthesize", per_book(lambda book, job: sesame.synthesize_chapter(
+            job, generator, book["args"], voice_preset_path, device, governor, throughput, trace))),
+        Stage("encode", per_book(lambda book, job: sesame.encode_chapter(job, generator, book["args"]))),
+    ]
+    return stages, trace.close, throughput
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate audiobooks for a library of EPUB/PDF files with shared, resident models")
+    parser.add_argument("--library", default=None, help="Directory searched recursively for .epub and .pdf files")
+    parser.add_argument("--books", default=None, help="File listing books to convert (a JSON list or one path per line)")
+    parser.add_argument("--output_root", default="audiobooks", help="Root directory; each book is written to <output_root>/<book name>/")
+    parser.add_argument("--backend", choices=["piper", "sesame"], default="piper", help="TTS backend to use for every book")
+    parser.add_argument("--combine", action='store_true', help="Also combine each completed book into <output_root>/<book name>/<book name>.mp3")
+    parser.add_argument("--active_books", type=int, default=4, help="Books whose chapters are interleaved at any one time")
+    parser.add_argument("--workers", type=int, default=2, help="Chapters synthesized concurrently (Piper only; Sesame runs one chapter at a time)")
+    parser.add_argument("--queue_size", type=int, default=2, help="Chapters buffered between pipeline stages")
+    parser.add_argument("--encode_workers", type=int, default=None, help="Processes encoding chapters while synthesis goes on (Piper; default: the cores synthesis leaves spare, 0: one chapter at a time in-process)")
+    parser.add_argument("--pipeline_metrics", default=None, help="Write per-stage pipeline metrics to this JSON file")
+    parser.add_argument("--memory_budget", type=int, default=None, help="Memory budget in MB for the whole library run (default: 80%% of available memory)")
+    parser.add_argument("--max_batch_size", type=int, default=None, help="Maximum chunks to process between memory checks (default: 20 for Piper, 8 for Sesame)")
+    parser.add_argument("--memory_per_chunk", type=int, default=None, help="Estimated memory usage per chunk in MB (default: 50 for Piper, 150 for Sesame)")
+    parser.add_argument("--metrics_json", default=None, help="Write per-stage timing counters and histograms to this JSON file")
+    parser.add_argument("--metrics_prom", default=None, help="Write the same metrics as a Prometheus textfile (e.g. into node_exporter's textfile directory)")
+    parser.add_argument("--trace", default=None, help="Per-chunk JSONL trace file for all books (default: <output_root>/trace.jsonl)")
+    parser.add_argument("--stats_file", default=None, help="Throughput statistics file (default: ~/.cache/audiobook/throughput.json)")
+    parser.add_argument("--profile", action='store_true', help="Write per-stage CPU profiles, memory snapshots and torch profiler traces to <output_root>/profile")
+    fake_tts.add_arguments(parser)
+    # Piper options
+    parser.add_argument("--model", default="/opt/piper/etc/test_voice.onnx", help="Piper voice model to use")
+    parser.add_argument("--chunk_size", type=int, default=1000, help="Maximum characters per chunk (Piper)")
+    parser.add_argument("--max_workers", type=int, default=max(1, min(4, multiprocessing.cpu_count() // 2)), help="Resident Piper processes (or concurrent inferences) shared by all books")
+    add_piper_arguments(parser)
+    # Sesame options
+    parser.add_argument("--model_path", default=None, help="Directory containing the Sesame model files (Sesame)")
+    parser.add_argument("--voice_preset", default=None, help="Name of the voice preset to use (Sesame)")
+    parser.add_argument("--chunk_length", type=int, default=500, help="Approximate maximum character length for text chunks (Sesame)")
+    parser.add_argument("--output_format", default="mp3", help="Format of the per-chapter files (Sesame)")
+    parser.add_argument("--keep_temp", action='store_true', help="Keep temporary audio chunk files after generation (Sesame)")
+    parser.add_argument("--watermark_mode", choices=["chunk", "stream"], default="chunk", help="Watermark per chunk or once over each assembled chapter (Sesame)")
+    parser.add_argument("--stream", action='store_true', help="Stream decoded audio frames into each chunk file as they are generated (Sesame)")
+    args = parser.parse_args()
+
+    if not args.library and not args.books:
+        print("Error: Specify --library, --books, or both.")
+        return 1
+    if args.backend == "sesame" and not args.fake_tts and not (args.model_path and os.path.isdir(args.model_path)):
+        print("Error: --model_path must be an existing directory for the Sesame backend.")
+        return 1
+
+    os.makedirs(args.output_root, exist_ok=True)
+    books = make_books(find_books(args.library, args.books), args)
+    if not books:
+        print("Error: No books found.")
+        return 1
+    print(f"Converting {len(books)} books with the {args.backend} backend")
+
+    piper_backend = args.backend == "piper"
+    governor = MemoryGovernor(
+        budget_mb=args.memory_budget,
+        per_item_mb=args.memory_per_chunk or (50 if piper_backend else 150),
+        max_concurrency=args.max_workers if piper_backend else 1,
+        max_batch_size=args.max_batch_size or (20 if piper_backend else 8),
+    )
+    profiler = start_profiler(args.profile, args.output_root)
+    if piper_backend:
+        stages, shutdown, throughput = piper_stages(books, args, governor)
+    else:
+        stages, shutdown, throughput = sesame_stages(books, args, governor, profiler)
+
+    # Chapters finish in any order and from any book; each is published in its
+    # book's playlist as soon as it completes
+    lock = threading.Lock()
+    def record(book, finished):
+        chapter_num, chapter_output = finished
+        with lock:
+            book["finished"][chapter_num] = chapter_output
+            book["end"] = time.time()
+            if book["first_chapter"] is None:
+                book["first_chapter"] = book["end"]
+            write_playlist(os.path.join(book["dir"], "playlist.m3u"),
+                           [book["finished"][num] for num in sorted(book["finished"])])
+        return chapter_num, chapter_output
+    stages.append(Stage("report", per_book(record)))
+
+    start_time = time.time()
+    library_pipeline = Pipeline(stages, queue_size=args.queue_size,
+                                after_item=profiler.after_item if profiler else None)
+    try:
+        library_pipeline.run(interleave(books, max(1, args.active_books)))
+    finally:
+        shutdown()
+        for book in books:
+            if book["manifest"] is not None:
+                book["manifest"].close()
+
+    print(f"\nLibrary finished in {time.time() - start_time:.1f}s")
+    print(f"Memory governor: {governor.summary()}")
+    throughput.save(governor.peak_rss_mb)
+    print(f"Throughput: {throughput.summary()}")
+    library_pipeline.print_metrics()
+    METRICS.record_pipeline(library_pipeline.metrics())
+    if args.pipeline_metrics:
+        library_pipeline.write_metrics(args.pipeline_metrics)
+
+    incomplete = 0
+    for book in books:
+        failed = [num for num in book["selected"] if num not in book["finished"]]
+        if args.combine and book["finished"] and not failed:
+            book["combined"] = os.path.join(book["dir"], f"{book['name']}.mp3")
+            try:
+                with section(profiler, f"combine_{book['name']}"):
+                    combine_chapters([book["finished"][num] for num in sorted(book["finished"])], book["combined"],
+                                     [book["titles"][num] for num in sorted(book["finished"])])
+            except Exception as e:
+                print(f"Error combining {book['name']}: {e}")
+                book["combined"] = None
+        report = write_report(book, args)
+        incomplete += not report["complete"]
+        print(f"{book['name']}: {len(report['chapters_completed'])}/{report['chapters_total']} chapters"
+              + (f", failed chapters {report['chapters_failed']}" if report["chapters_failed"] else "")
+              + (f", error: {report['error']}" if report["error"] else ""))
+
+    metrics.export(args.metrics_json, args.metrics_prom)
+    if incomplete:
+        print(f"Warning: {incomplete} of {len(books)} books are incomplete; rerun to resume them.")
+        return 1
+    print("Library generation complete!")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
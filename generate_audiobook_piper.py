@@ -3,24 +3,32 @@
 import os
 import sys
 import argparse
-import subprocess
 import re
 from tqdm import tqdm
-import nltk
-from nltk.tokenize import sent_tokenize
 from pydub import AudioSegment
-import ebooklib
-from ebooklib import epub
-from bs4 import BeautifulSoup
-from PyPDF2 import PdfReader
 import time
-import datetime
-import psutil
 import shutil
 import multiprocessing
-
-# Download NLTK data
-nltk.download('punkt', quiet=True)
+import copy
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from memory_governor import MemoryGovernor
+from job_manifest import JobManifest, FAILED, part_path
+from pipeline import Pipeline, Stage, prioritized
+from text_extraction import iter_chapters, split_text_into_chunks, leading_chunks, book_metadata, SPEECH_CHARS_PER_SECOND
+from audio_io import write_chapter_metadata, write_playlist
+from work_leases import LeaseQueue, run_worker
+from throughput_model import ThroughputModel, RunningEstimate, print_plan
+import metrics
+from metrics import METRICS
+from chunk_trace import ChunkTrace, TRACE_NAME
+from profiling import start_profiler, section
+import fake_tts
+from audiobook_mux import is_container, mux_audiobook, encode_audio
+from encoder_pool import EncoderPool, ChapterOrder, spare_cores
+from chunk_store import ChunkStore, store_path, COMPACT_GARBAGE
+from tts_backends import add_piper_arguments, piper_backend_from_args, batch_groups, worker_count
 
 # Validate input file exists and has correct format
 def validate_input_file(file_path):
@@ -35,184 +43,23 @@ def validate_input_file(file_path):
         
     return True
 
-def html_to_text(html_content):
-    """Convert HTML content to plain text."""
-    soup = BeautifulSoup(html_content, 'html.parser')
-    text = soup.get_text()
-    # Clean up extra whitespace
-    text = re.sub(r'\s+', ' ', text).strip()
-    return text
-
-def extract_text_from_epub(epub_path):
-    """Extract text and chapters from an ePub file."""
-    print(f"Extracting text from ePub: {epub_path}...")
-    
-    book = epub.read_epub(epub_path)
-    chapters = []
-    chapter_titles = []
-    
-    # Get the spine (reading order)
-    spine = [item.get_id() for item in book.spine]
-    
-    # Process items in reading order
-    for item_id in tqdm(spine, desc="Processing ePub items"):
-        # Get the item
-        item = book.get_item_with_id(item_id)
-        
-        # Skip if not a document
-        if not item or item.get_type() != ebooklib.ITEM_DOCUMENT:
-            continue
-            
-        # Get content
-        content = item.get_content().decode('utf-8')
-        
-        # Find title if possible
-        soup = BeautifulSoup(content, 'html.parser')
-        title_tag = soup.find(['h1', 'h2', 'h3', 'h4'])
-        title = title_tag.get_text().strip() if title_tag else f"Chapter {len(chapter_titles) + 1}"
-        
-        # Extract text
-        text = html_to_text(content)
-        
-        # Skip if no meaningful content
-        if len(text.strip()) < 50:
-            continue
-            
-        chapters.append(text)
-        chapter_titles.append(title)
-    
-    print(f"Extracted {len(chapters)} chapters from ePub")
-    return chapters, chapter_titles
+def book_name(args):
+    """Return the name of the book being converted, as used in traces."""
+    return os.path.splitext(os.path.basename(args.input))[0]
 
-def extract_text_from_pdf(pdf_path):
-    """Extract text from a PDF file and attempt to detect chapters."""
-    print(f"Extracting text from PDF: {pdf_path}...")
-    
-    reader = PdfReader(pdf_path)
-    full_text = ""
-    
-    for i, page in enumerate(tqdm(reader.pages, desc="Processing PDF pages")):
-        page_text = page.extract_text()
-        
-        # Clean up page headers, footers, page numbers, etc.
-        page_text = re.sub(r'Page \d+ of \d+', '', page_text)
-        page_text = re.sub(r'^\s*\d+\s*$', '', page_text, flags=re.MULTILINE)
-        
-        full_text += page_text + "\n"
-    
-    # Detect chapters in the PDF text
-    chapters, chapter_titles = detect_chapters_in_text(full_text)
-    print(f"Detected {len(chapters)} chapters from PDF")
-    
-    return chapters, chapter_titles
-
-def detect_chapters_in_text(text):
-    """Attempt to detect chapters in plain text."""
-    # Common chapter heading patterns
-    chapter_patterns = [
-        r'^CHAPTER\s+\d+',          # "CHAPTER 1", "CHAPTER 2", etc.
-        r'^Chapter\s+\d+',          # "Chapter 1", "Chapter 2", etc.
-        r'^\d+\.\s+[A-Z]',          # "1. CHAPTER TITLE", "2. CHAPTER TITLE"
-        r'^PART\s+\d+',             # "PART 1", "PART 2", etc.
-        r'^Part\s+\d+',             # "Part 1", "Part 2", etc.
-        r'^SECTION\s+\d+',          # "SECTION 1", "SECTION 2", etc.
-        r'^Section\s+\d+',          # "Section 1", "Section 2", etc.
-        r'^INTRODUCTION',           # "INTRODUCTION"
-        r'^Introduction',           # "Introduction"
-        r'^APPENDIX\s+\d*',         # "APPENDIX", "APPENDIX A", etc.
-        r'^Appendix\s+\d*',         # "Appendix", "Appendix A", etc.
-    ]
-    
-    # Split text into lines
-    lines = text.split('\n')
-    
-    # Find potential chapter boundaries
-    chapter_starts = []
-    chapter_titles = []
-    
-    for i, line in enumerate(lines):
-        line = line.strip()
-        if not line:
-            continue
-            
-        # Check if line matches a chapter pattern
-        for pattern in chapter_patterns:
-            if re.match(pattern, line):
-                chapter_starts.append(i)
-                chapter_titles.append(line)
-                break
-    
-    # If no chapters detected, treat as a single chapter
-    if not chapter_starts:
-        return [text], ["Chapter 1"]
-    
-    # Extract chapter text
-    chapters = []
-    for i in range(len(chapter_starts)):
-        start = chapter_starts[i]
-        end = chapter_starts[i+1] if i+1 < len(chapter_starts) else len(lines)
-        chapter_text = '\n'.join(lines[start:end]).strip()
-        chapters.append(chapter_text)
-    
-    return chapters, chapter_titles
+def voice_throughput(args):
+    """Return the learned throughput model for the selected Piper voice on this host."""
+    if args.fake_tts:
+        return ThroughputModel("fake", "tone", args.stats_file)
+    backend = "piper-onnx" if args.piper_backend == "onnx" else "piper"
+    return ThroughputModel(backend, os.path.basename(args.model), args.stats_file)
 
-def split_text_into_chunks(text, max_chars=1000):
-    """Split text into manageable chunks for TTS processing."""
-    # Split text into sentences
-    sentences = sent_tokenize(text)
-    
-    # Group sentences into chunks
-    chunks = []
-    current_chunk = ""
-    
-    for sentence in sentences:
-        # Clean the sentence
-        sentence = sentence.strip()
-        if not sentence:
-            continue
-            
-        # If adding this sentence doesn't exceed max_chars, add it to the current chunk
-        if len(current_chunk) + len(sentence) + 1 <= max_chars:
-            current_chunk += sentence + " "
-        else:
-            # Save the current chunk if it's not empty
-            if current_chunk:
-                chunks.append(current_chunk.strip())
-            current_chunk = sentence + " "
-    
-    # Add the last chunk if not empty
-    if current_chunk:
-        chunks.append(current_chunk.strip())
-    
-    return chunks
-
-def estimate_processing_time(num_chunks, avg_time_per_chunk=5):
-    """Estimate the total processing time based on number of chunks."""
-    total_seconds = num_chunks * avg_time_per_chunk
-    return str(datetime.timedelta(seconds=total_seconds))
-
-def generate_audio_with_piper(text, output_file, model_path):
-    """Generate audio for a chunk of text using Piper."""
-    # Save text to a temporary file
-    temp_text_file = "/tmp/piper_input.txt"
-    with open(temp_text_file, "w") as f:
-        f.write(text)
-    
-    # Call Piper to generate audio
-    cmd = [
-        "piper",
-        "--model", model_path,
-        "--output_file", output_file,
-        "--file", temp_text_file
-    ]
-    
-    try:
-        subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        return True
-    except subprocess.CalledProcessError as e:
-        print(f"Error generating audio: {e}")
-        print(f"stderr: {e.stderr.decode()}")
-        return False
+def estimate_processing_time(chunks, throughput, workers=1):
+    """Estimate the processing time of chunk texts from the learned throughput."""
+    return throughput.eta(chunks, workers)
+
+# Silence after every combined segment
+PAUSE_MS = 500
 
 def combine_audio_files(audio_files, output_file):
     """Combine multiple audio files into a single audio file."""
@@ -221,153 +68,457 @@ def combine_audio_files(audio_files, output_file):
     combined = AudioSegment.empty()
     
     # Add a short pause between segments
-    pause = AudioSegment.silent(duration=500)  # 500ms pause
+    pause = AudioSegment.silent(duration=PAUSE_MS)
     
-    for audio_file in tqdm(audio_files, desc="Combining audio"):
-        segment = AudioSegment.from_file(audio_file)
-        combined += segment + pause
+    with METRICS.timer("pydub_concatenate"):
+        for audio_file in tqdm(audio_files, desc="Combining audio"):
+            segment = AudioSegment.from_file(audio_file)
+            combined += segment + pause
     
     # Export the combined audio
-    combined.export(output_file, format="mp3")
+    with METRICS.timer("mp3_export"):
+        combined.export(output_file, format="mp3")
     print(f"Combined audio saved to {output_file}")
 
-def process_chapter(chapter_text, chapter_title, chapter_num, args):
-    """Process a single chapter and generate audio."""
-    print(f"Processing chapter {chapter_num}: {chapter_title}")
-    
-    # Create chapter directory
-    chapter_dir = os.path.join(args.temp_dir, f"chapter_{chapter_num:02d}")
-    os.makedirs(chapter_dir, exist_ok=True)
-    
-    # Split chapter text into chunks
+def chunk_chapter(chapter, args, manifest):
+    """Split a chapter into chunks and register them in the job manifest."""
+    chapter_num, chapter_text, chapter_title = chapter
     chunks = split_text_into_chunks(chapter_text, args.chunk_size)
-    print(f"Chapter split into {len(chunks)} chunks")
-    
+    print(f"Chapter {chapter_num} ({chapter_title}) split into {len(chunks)} chunks")
+    chunk_keys = [f"chapter_{chapter_num:02d}/{i:04d}" for i in range(len(chunks))]
+    manifest.plan(dict(zip(chunk_keys, chunks)))
+    return chapter_num, chapter_title, chunks, chunk_keys
+
+def synthesize_chapter(chunked, args, governor, manifest, backend, throughput=None, trace=None):
+    """
+    Generate audio for every chunk of a chapter and return the chunk locators.
+
+    Chunks go to the backend (see tts_backends) on up to governor.concurrency
+    threads; a backend that can batch gets contiguous groups of chunks per
+    call. Their audio is appended to the chapter's chunk store (see
+    chunk_store). Every synthesized chunk is recorded in the throughput
+    model, which also provides the ETAs, and in the chunk trace if one is given.
+    """
+    throughput = throughput or voice_throughput(args)
+    chapter_num, chapter_title, chunks, chunk_keys = chunked
+    print(f"Processing chapter {chapter_num}: {chapter_title}")
+
+    store = ChunkStore(store_path(args.temp_dir, chapter_num))
+    try:
+        return _synthesize_chunks(chapter_num, chapter_title, chunks, chunk_keys, store,
+                                  args, governor, manifest, backend, throughput, trace)
+    finally:
+        store.close()
+
+def _synthesize_chunks(chapter_num, chapter_title, chunks, chunk_keys, store, args, governor, manifest, backend, throughput, trace):
+    """Synthesize a chapter's chunks into its open chunk store (see synthesize_chapter)."""
+    def is_done(i):
+        # Chunks committed as files by an earlier version are synthesized again into the store
+        return manifest.is_done(chunk_keys[i]) and i in store
+
     # Estimate processing time
-    estimated_time = estimate_processing_time(len(chunks))
+    pending = [chunk for i, chunk in enumerate(chunks) if not is_done(i)]
+    estimated_time = estimate_processing_time(pending, throughput, governor.concurrency)
     print(f"Estimated processing time for this chapter: {estimated_time}")
-    
+
     # Generate audio for each chunk
     audio_files = []
-    start_time = time.time()
-    
-    # Calculate chunks per batch based on memory limit
-    available_memory = psutil.virtual_memory().available
-    memory_per_chunk = args.memory_per_chunk  # MB per chunk (estimated)
-    chunks_per_batch = min(
-        args.max_batch_size,
-        max(1, int(available_memory / (memory_per_chunk * 1024 * 1024)))
-    )
-    print(f"Processing up to {chunks_per_batch} chunks at a time based on available memory")
-    
-    for i, chunk in enumerate(tqdm(chunks, desc="Generating audio")):
-        output_file = os.path.join(chapter_dir, f"chunk_{i:04d}.wav")
-        
-        # Skip if the file already exists (resume capability)
-        if os.path.exists(output_file):
-            print(f"Chunk {i} already processed, skipping...")
-            audio_files.append(output_file)
-            continue
-            
-        # Generate audio for this chunk
-        success = generate_audio_with_piper(chunk, output_file, args.model)
-        
-        if success:
-            audio_files.append(output_file)
-        else:
-            print(f"Failed to generate audio for chunk {i}")
-        
-        # Calculate and display progress
-        if i > 0 and i % 5 == 0:
-            elapsed_time = time.time() - start_time
-            avg_time_per_chunk = elapsed_time / i
-            remaining_chunks = len(chunks) - i
-            estimated_remaining = remaining_chunks * avg_time_per_chunk
-            eta = str(datetime.timedelta(seconds=int(estimated_remaining)))
-            print(f"Progress: {i}/{len(chunks)} chunks ({i/len(chunks)*100:.1f}%) - ETA: {eta}")
-        
-        # Apply memory management - take a break after each batch
-        if i > 0 and i % chunks_per_batch == 0:
-            print("Taking a break to free up memory...")
-            time.sleep(2)  # Short pause to let system recover
-    
-    # Combine all audio files for this chapter
-    if audio_files:
-        safe_title = re.sub(r'[^\w\s-]', '', chapter_title).strip().replace(' ', '_')
-        chapter_output = os.path.join(args.output_dir, f"chapter_{chapter_num:02d}_{safe_title}.mp3")
-        combine_audio_files(audio_files, chapter_output)
-        print(f"Chapter audio saved to {chapter_output}")
-        return chapter_output
-    else:
+
+    # Let the governor decide how many chunks to run at once and how many between memory checks
+    print(f"Memory governor: {governor.summary()}")
+
+    def retries(i):
+        return 1 if manifest.chunk(chunk_keys[i])["status"] == FAILED else 0
+
+    def commit(i, pcm, chunk_seconds, retried):
+        # The store fsyncs the audio before the manifest records the chunk as done
+        manifest.commit_pcm(chunk_keys[i], chunks[i], store, i, pcm, backend.sample_rate)
+        audio_seconds = manifest.chunk(chunk_keys[i])["duration"]
+        throughput.observe(len(chunks[i]), chunk_seconds, audio_seconds, len(pcm))
+        METRICS.record_synthesis(throughput.backend, chunk_seconds, audio_seconds, len(chunks[i]))
+        if trace:
+            trace.record(book_name(args), chapter_num, i, chunks[i], chunk_seconds, audio_seconds, retries=retried)
+
+    def fail(i, error, chunk_seconds, retried):
+        print(f"Failed to generate audio for chunk {i}: {error}")
+        manifest.record_chunk(chunk_keys[i], chunks[i], FAILED)
+        if trace:
+            trace.record(book_name(args), chapter_num, i, chunks[i], chunk_seconds, status="failed", retries=retried)
+
+    def synthesize_one(i):
+        retried, chunk_start = retries(i), time.time()
+        try:
+            pcm = backend.synthesize(chunks[i])
+        except Exception as e:
+            fail(i, e, time.time() - chunk_start, retried)
+            return
+        commit(i, pcm, time.time() - chunk_start, retried)
+
+    def synthesize_group(group):
+        # Skip chunks the manifest records as committed (resume capability)
+        todo = [i for i in group if not is_done(i)]
+        if len(todo) == 1:
+            synthesize_one(todo[0])
+        elif todo:
+            retried, batch_start = [retries(i) for i in todo], time.time()
+            try:
+                pcms = backend.synthesize_batch([chunks[i] for i in todo])
+            except Exception as e:
+                # One bad chunk fails the whole call; retry the group chunk by chunk
+                print(f"Batch of {len(todo)} chunks failed ({e}); retrying them one at a time")
+                for i in todo:
+                    synthesize_one(i)
+            else:
+                # The call's time is shared out by characters, like its cost
+                batch_seconds, batch_chars = time.time() - batch_start, sum(len(chunks[i]) for i in todo)
+                for i, pcm, r in zip(todo, pcms, retried):
+                    commit(i, pcm, batch_seconds * len(chunks[i]) / max(1, batch_chars), r)
+        return [store.locator(i) if is_done(i) else None for i in group]
+
+    done = 0
+    with tqdm(total=len(chunks), desc=f"Generating audio (chapter {chapter_num})") as progress:
+        while done < len(chunks):
+            batch = list(range(done, min(len(chunks), done + governor.batch_size)))
+            groups = batch_groups(batch, governor.concurrency, backend.capabilities)
+            # Named after the stage, so profiles attribute the backend calls to synthesis
+            with ThreadPoolExecutor(max_workers=governor.concurrency, thread_name_prefix="pipeline-synthesize-pool") as executor:
+                for output_files in executor.map(synthesize_group, groups):
+                    audio_files.extend(output_file for output_file in output_files if output_file)
+                    progress.update(len(output_files))
+            done = batch[-1] + 1
+
+            # Calculate and display progress; the ETA uses the fitted per-chunk and per-character cost
+            eta = estimate_processing_time(chunks[done:], throughput, governor.concurrency)
+            print(f"Progress: {done}/{len(chunks)} chunks ({done/len(chunks)*100:.1f}%) - ETA: {eta}")
+
+            # Adapt concurrency and batch size to memory use; caches are only released under pressure
+            governor.update()
+
+    # Chunks synthesized again (after a crash or a changed plan) left their old audio behind
+    garbage = store.garbage_bytes()
+    if garbage and garbage > COMPACT_GARBAGE * os.path.getsize(store.path):
+        print(f"Compacting chunk store {store.path}: {store.compact() / 2**20:.1f} MB reclaimed")
+
+    if not audio_files:
         print(f"No audio generated for chapter {chapter_num}")
         return None
+    return chapter_num, chapter_title, audio_files
+
+def combine_chapters(chapter_files, titles, args):
+    """Combine the chapter files into the audiobook, with its chapter markers next to it."""
+    combine_audio_files(chapter_files, part_path(args.output))
+    os.replace(part_path(args.output), args.output)
+    print(f"Audiobook saved to {args.output}")
+    # Chapter lengths come from the chapter files' headers, so no audio is decoded again
+    try:
+        markers = write_chapter_metadata(args.output, chapter_files, titles, PAUSE_MS / 1000, {"title": book_name(args)})
+        print(f"Chapter markers saved to {markers}")
+    except (ValueError, OSError) as e:
+        print(f"Could not write chapter markers: {e}")
+
+def mux_chapters(chapter_chunks, titles, args):
+    """Encode the chapters' chunk files straight into an M4B/MKA audiobook with chapters and cover."""
+    metadata = book_metadata(args.input)
+    mux_audiobook(args.output, list(zip(titles, chapter_chunks)),
+                  {"title": metadata["title"] or book_name(args), "album": metadata["title"] or book_name(args),
+                   "artist": metadata["author"], "genre": "Audiobook"},
+                  metadata["cover"], file_pause=PAUSE_MS / 1000, chapter_pause=PAUSE_MS / 1000, bitrate=args.audio_bitrate)
+    print(f"Audiobook saved to {args.output}")
+
+def chapter_output_path(args, chapter_num, chapter_title):
+    """Return the output file of a chapter."""
+    safe_title = re.sub(r'[^\w\s-]', '', chapter_title).strip().replace(' ', '_')
+    return os.path.join(args.output_dir, f"chapter_{chapter_num:02d}_{safe_title}.mp3")
+
+def encode_chapter_file(audio_files, chapter_output, part_tag=None):
+    """Encode chunks into a chapter file; a module-level function, so it can run in an EncoderPool."""
+    # The chunks are streamed from their store into the encoder and written to a partial file first
+    encode_audio(chapter_output, audio_files, PAUSE_MS / 1000, part_tag=part_tag)
+
+def encode_chapter(synthesized, args, encoder=None, part_tag=None):
+    """
+    Combine a chapter's chunks into the chapter output, in a worker process of encoder if given.
+
+    part_tag makes the in-progress file unique to this writer (see job_manifest.part_path).
+    """
+    chapter_num, chapter_title, audio_files = synthesized
+    chapter_output = chapter_output_path(args, chapter_num, chapter_title)
+    if encoder:
+        encoder.run(encode_chapter_file, audio_files, chapter_output, part_tag)
+    else:
+        encode_chapter_file(audio_files, chapter_output, part_tag)
+    print(f"Chapter audio saved to {chapter_output}")
+    return chapter_num, chapter_output
+
+def publish_preview(chapters, args, governor, manifest, backend, throughput, trace=None):
+    """
+    Synthesize about the first --first_listen_minutes of the book into preview.mp3.
+
+    The preview's chunks have the same manifest keys and files as in their
+    chapters, so the full run reuses them instead of synthesizing them again.
+    """
+    remaining_minutes = args.first_listen_minutes
+    audio_files = []
+    for chapter in chapters:
+        chapter_num, chapter_title, chunks, chunk_keys = chunk_chapter(chapter, args, manifest)
+        count = leading_chunks(chunks, remaining_minutes)
+        synthesized = synthesize_chapter((chapter_num, chapter_title, chunks[:count], chunk_keys[:count]),
+                                         args, governor, manifest, backend, throughput, trace)
+        if synthesized:
+            audio_files.extend(synthesized[2])
+        remaining_minutes -= sum(len(chunk) for chunk in chunks[:count]) / (60 * SPEECH_CHARS_PER_SECOND)
+        if remaining_minutes <= 0:
+            break
+    if not audio_files:
+        return None
+    preview = os.path.join(args.output_dir, "preview.mp3")
+    encode_audio(preview, audio_files, PAUSE_MS / 1000)
+    return preview
+
+def run_distributed_worker(chapters, args, governor, backend, throughput, trace=None):
+    """
+    Process chapters as one of several workers sharing the temp and output directories.
+
+    Chapters are claimed through lease files in temp_dir/leases. Each chapter
+    has its own manifest, so the chapter's holder is its only writer, and a
+    worker that loses its lease stops writing it; a backup copy of a
+    straggler works in a separate namespace. The worker that
+    sees every chapter done assembles the audiobook.
+    """
+    queue = LeaseQueue(os.path.join(args.temp_dir, "leases"), worker_id=args.worker_id,
+                       lease_seconds=args.lease_seconds, steal_after=args.steal_after)
+    print(f"Worker {queue.worker_id}: {len(chapters)} chapters in {queue.lease_dir}")
+    by_key = {f"chapter_{num:02d}": (num, text, title) for num, text, title in chapters}
+
+    def process(key, lease):
+        chapter_args = copy.copy(args)
+        if lease.backup:
+            chapter_args.temp_dir = os.path.join(args.temp_dir, f"backup_{queue.worker_id}")
+        chapter_dir = os.path.join(chapter_args.temp_dir, key)
+        os.makedirs(chapter_dir, exist_ok=True)
+        # Once the lease is taken over, the manifest refuses writes and the chapter is abandoned
+        manifest = JobManifest(chapter_dir, guard=lease.check)
+        try:
+            synthesized = synthesize_chapter(chunk_chapter(by_key[key], chapter_args, manifest),
+                                             chapter_args, governor, manifest, backend, throughput, trace)
+        finally:
+            manifest.close()
+        lease.check()
+        # A backup copy of this chapter may be encoding it at the same time
+        return synthesized is not None and encode_chapter(synthesized, chapter_args, part_tag=queue.worker_id) is not None
+
+    def assemble():
+        if not args.output:
+            return True
+        outputs = [chapter_output_path(args, num, title) for num, _, title in chapters]
+        combine_chapters(outputs, [title for _, _, title in chapters], args)
+        return True
+
+    summary = run_worker(queue, list(by_key), process, assemble)
+    throughput.save(governor.peak_rss_mb)
+    metrics.export(args.metrics_json, args.metrics_prom)
+    print(f"Worker {queue.worker_id} finished: {summary}")
+    return 0 if summary["failed"] == 0 else 1
 
 def main():
     parser = argparse.ArgumentParser(description="Generate an audiobook using Piper TTS")
     parser.add_argument("--input", required=True, help="Path to the input book file (ePub or PDF)")
-    parser.add_argument("--output", default="audiobook.mp3", help="Output combined audiobook file path")
+    parser.add_argument("--output", default="audiobook.mp3", help="Output combined audiobook file path (.m4b or .mka: encoded in one pass with chapters and cover)")
+    parser.add_argument("--audio_bitrate", default="64k", help="Audio bitrate of an .m4b or .mka --output")
     parser.add_argument("--output_dir", default="audiobook_chapters", help="Output directory for chapter files")
     parser.add_argument("--model", default="/opt/piper/etc/test_voice.onnx", help="Piper voice model to use")
     parser.add_argument("--temp_dir", default="temp_audio", help="Directory for temporary audio files")
     parser.add_argument("--chunk_size", type=int, default=1000, help="Maximum characters per chunk")
-    parser.add_argument("--max_batch_size", type=int, default=20, help="Maximum chunks to process before pausing")
+    parser.add_argument("--max_batch_size", type=int, default=20, help="Maximum chunks to process between memory checks")
     parser.add_argument("--memory_per_chunk", type=int, default=50, help="Estimated memory usage per chunk in MB")
+    parser.add_argument("--memory_budget", type=int, default=None, help="Memory budget in MB for this job (default: 80%% of available memory)")
+    parser.add_argument("--max_workers", type=int, default=max(1, min(4, multiprocessing.cpu_count() // 2)), help="Maximum concurrent Piper processes or inferences (fewer if the backend supports fewer)")
     parser.add_argument("--chapter_range", help="Range of chapters to process (e.g., '1-5')")
+    parser.add_argument("--queue_size", type=int, default=2, help="Chapters buffered between pipeline stages")
+    parser.add_argument("--encode_workers", type=int, default=None, help="Processes encoding chapters while synthesis goes on (default: the cores synthesis leaves spare; 0: encode one chapter at a time in-process)")
+    parser.add_argument("--pipeline_metrics", default=None, help="Write per-stage pipeline metrics to this JSON file")
+    parser.add_argument("--priority_chapters", default=None, help="Comma-separated chapters to synthesize before all others (e.g. '5' or '1,5')")
+    parser.add_argument("--first_listen_minutes", type=float, default=None, help="Publish about the first N minutes of the book as preview.mp3 before synthesizing the rest")
+    parser.add_argument("--plan", action='store_true', help="Only predict wall time, disk usage and peak memory for the book from recorded throughput, without synthesizing")
+    parser.add_argument("--stats_file", default=None, help="Throughput statistics file (default: ~/.cache/audiobook/throughput.json)")
+    parser.add_argument("--metrics_json", default=None, help="Write per-stage timing counters and histograms to this JSON file")
+    parser.add_argument("--metrics_prom", default=None, help="Write the same metrics as a Prometheus textfile (e.g. into node_exporter's textfile directory)")
+    parser.add_argument("--trace", default=None, help="Per-chunk JSONL trace file (default: trace.jsonl in --temp_dir); analyze it with chunk_trace.py")
+    parser.add_argument("--profile", action='store_true', help="Write per-stage CPU profiles and memory snapshots to a profile directory in --output_dir")
+    add_piper_arguments(parser)
+    fake_tts.add_arguments(parser)
+    parser.add_argument("--worker", action='store_true', help="Run as one of several workers (on this or other hosts) sharing --temp_dir and --output_dir")
+    parser.add_argument("--worker_id", default=None, help="Worker identifier in lease files (default: host, pid and a random suffix)")
+    parser.add_argument("--lease_seconds", type=float, default=300, help="Seconds after which a chapter lease that is not renewed is taken over")
+    parser.add_argument("--steal_after", type=float, default=None, help="Seconds after which idle workers start a backup copy of a chapter still in progress")
     args = parser.parse_args()
+    start_time = time.time()
     
     # Validate input file
     if not validate_input_file(args.input):
         return 1
+    if args.worker and args.output and is_container(args.output):
+        print("Error: Workers assemble MP3 audiobooks; use an .mp3 --output with --worker.")
+        return 1
     
-    # Create directories
-    os.makedirs(args.temp_dir, exist_ok=True)
-    os.makedirs(args.output_dir, exist_ok=True)
-    
-    # Determine file type and extract text
-    input_path = args.input
-    
-    if input_path.lower().endswith('.epub'):
-        chapters, chapter_titles = extract_text_from_epub(input_path)
-    elif input_path.lower().endswith('.pdf'):
-        chapters, chapter_titles = extract_text_from_pdf(input_path)
-    else:
-        print(f"Unsupported file format: {input_path}")
-        print("Supported formats: .epub, .pdf")
+    # The voice stays loaded (resident processes or an in-process session); the backend's capabilities bound the workers
+    try:
+        backend = fake_tts.from_args(args) or piper_backend_from_args(args, os.path.join(args.temp_dir, ".piper_pool"))
+    except (RuntimeError, OSError) as e:
+        print(f"Error loading the Piper voice: {e}")
         return 1
+    workers = worker_count(backend.capabilities, args.max_workers)
+    print(f"Backend {backend.name}/{backend.voice} at {backend.sample_rate}Hz: {backend.capabilities.summary()}")
+    
+    governor = MemoryGovernor(
+        budget_mb=args.memory_budget,
+        per_item_mb=args.memory_per_chunk,
+        max_concurrency=workers,
+        max_batch_size=args.max_batch_size,
+    )
     
-    # Process only specified chapter range if provided
+    # Parse the chapter range up front; chapters are filtered as they are extracted
+    first_chapter, last_chapter = 1, None
     if args.chapter_range:
         try:
-            start, end = map(int, args.chapter_range.split('-'))
-            chapter_range = range(start-1, min(end, len(chapters)))
-            selected_chapters = [chapters[i] for i in chapter_range]
-            selected_titles = [chapter_titles[i] for i in chapter_range]
-            chapters = selected_chapters
-            chapter_titles = selected_titles
-            print(f"Processing chapters {start} to {min(end, len(selected_chapters)+start-1)}")
+            first_chapter, last_chapter = map(int, args.chapter_range.split('-'))
+            print(f"Processing chapters {first_chapter} to {last_chapter}")
         except ValueError:
             print(f"Invalid chapter range format: {args.chapter_range}. Expected format: '1-5'")
             return 1
     
-    # Estimate total processing time
-    total_text_length = sum(len(chapter) for chapter in chapters)
-    estimated_chunks = total_text_length / args.chunk_size
-    estimated_time = estimate_processing_time(estimated_chunks)
-    print(f"Total estimated processing time: {estimated_time}")
+    def selected_chapters():
+        for chapter_num, (chapter_text, chapter_title) in enumerate(iter_chapters(args.input), 1):
+            if last_chapter is not None and chapter_num > last_chapter:
+                break
+            if chapter_num >= first_chapter:
+                yield chapter_num, chapter_text, chapter_title
+    
+    # Only a plan reads the whole book up front; a run refines its ETA as chapters are chunked
+    throughput = voice_throughput(args)
+    if args.plan:
+        print_plan(throughput.plan([(num, title, split_text_into_chunks(text, args.chunk_size))
+                                    for num, text, title in selected_chapters()],
+                                   workers=workers, per_item_mb=args.memory_per_chunk))
+        return 0
+    print(f"Throughput: {throughput.summary()}")
+    
+    # Create directories
+    os.makedirs(args.temp_dir, exist_ok=True)
+    os.makedirs(args.output_dir, exist_ok=True)
+    profiler = start_profiler(args.profile, args.output_dir)
     
-    # Process each chapter
-    chapter_audio_files = []
+    # One trace per job; workers sharing the job directory each add their own records
+    trace = ChunkTrace(args.trace or os.path.join(args.temp_dir, TRACE_NAME), throughput.backend,
+                       throughput.voice, worker_id=args.worker_id)
     
-    for i, (chapter_text, chapter_title) in enumerate(zip(chapters, chapter_titles)):
-        chapter_audio = process_chapter(chapter_text, chapter_title, i+1, args)
-        if chapter_audio:
-            chapter_audio_files.append(chapter_audio)
+    if args.worker:
+        try:
+            # Chapters are leased by key, so a worker needs all of them
+            return run_distributed_worker(list(selected_chapters()), args, governor, backend, throughput, trace)
+        finally:
+            trace.close()
+            backend.close()
+    
+    manifest = JobManifest(args.temp_dir)
+    notes = {}
+    
+    # Requested chapters are synthesized first, then the rest in order
+    chapters = selected_chapters()
+    if args.priority_chapters:
+        try:
+            priority = [int(num) for num in args.priority_chapters.split(',')]
+        except ValueError:
+            print(f"Invalid chapter list: {args.priority_chapters}. Expected format: '1,5'")
+            return 1
+        chapters = prioritized(chapters, priority)
+    
+    # Publish the opening of the book before anything else
+    if args.first_listen_minutes:
+        opening, opening_chars = [], 0
+        for chapter in chapters:
+            opening.append(chapter)
+            opening_chars += len(chapter[1])
+            if opening_chars >= args.first_listen_minutes * 60 * SPEECH_CHARS_PER_SECOND:
+                break
+        preview = publish_preview(opening, args, governor, manifest, backend, throughput, trace)
+        if preview:
+            notes["time_to_preview_seconds"] = round(time.time() - start_time, 3)
+            print(f"Preview of the first {args.first_listen_minutes:g} minutes saved to {preview} "
+                  f"after {notes['time_to_preview_seconds']:.1f}s")
+        chapters = itertools.chain(opening, chapters)
+    
+    # Chapters are encoded in worker processes on the cores synthesis leaves spare,
+    # several at once, so encoding keeps up with synthesis instead of trailing it
+    encode_workers = spare_cores(workers) if args.encode_workers is None else args.encode_workers
+    if last_chapter is not None:
+        encode_workers = min(encode_workers, last_chapter - first_chapter + 1)
+    encoder = EncoderPool(encode_workers) if encode_workers > 0 else None
+    if encoder:
+        print(f"Encoding up to {encoder.workers} chapters in parallel")
+    
+    # Each chapter is published, with a playlist of the finished chapters, as soon as it is encoded
+    published, chapter_chunks, titles = {}, {}, {}
+    order = ChapterOrder(first_chapter)
+    publish_lock = threading.Lock()
+    estimate = RunningEstimate(throughput, workers)
+    def chunk(chapter):
+        chunked = chunk_chapter(chapter, args, manifest)
+        titles[chunked[0]] = chunked[1]
+        estimate.add(chunked[2])
+        print(f"Estimated processing time: {estimate.summary()}")
+        return chunked
+    def encode(synthesized):
+        # An M4B/MKA audiobook is encoded from the chunks, not from the chapter MP3s
+        chapter_chunks[synthesized[0]] = synthesized[2]
+        return publish(encode_chapter(synthesized, args, encoder))
+    def publish(encoded):
+        chapter_num, chapter_output = encoded
+        with publish_lock:
+            if not published:
+                notes["time_to_first_chapter_seconds"] = round(time.time() - start_time, 3)
+                print(f"First playable chapter after {notes['time_to_first_chapter_seconds']:.1f}s")
+            published[chapter_num] = chapter_output
+            write_playlist(os.path.join(args.output_dir, "playlist.m3u"), [published[num] for num in sorted(published)])
+        ready = order.finish(chapter_num)
+        if ready:
+            print(f"Chapters up to {ready[-1]} can be played in order")
+        return encoded
+    
+    # Extraction, chunking, synthesis and encoding overlap: the encoder works on
+    # chapter N while chapter N+1 is synthesized and chapter N+2 is chunked
+    chapter_pipeline = Pipeline([
+        Stage("chunk", chunk),
+        Stage("synthesize", lambda chunked: synthesize_chapter(chunked, args, governor, manifest, backend, throughput, trace)),
+        Stage("encode", encode, workers=encoder.workers if encoder else 1),
+    ], queue_size=args.queue_size, after_item=profiler.after_item if profiler else None)
+    chapter_pipeline.notes = notes
+    try:
+        finished = sorted(chapter_pipeline.run(chapters))
+    finally:
+        if encoder:
+            encoder.close()
+    chapter_audio_files = [output for _, output in finished]
+    manifest.close()
+    trace.close()
+    backend.close()
+    throughput.save(governor.peak_rss_mb)
+    print(f"Throughput: {throughput.summary()}")
+    chapter_pipeline.print_metrics()
+    METRICS.record_pipeline(chapter_pipeline.metrics())
+    if args.pipeline_metrics:
+        chapter_pipeline.write_metrics(args.pipeline_metrics)
     
     # Combine all chapters into a single audiobook if requested
     if args.output and chapter_audio_files:
         print(f"Combining {len(chapter_audio_files)} chapters into final audiobook...")
-        combine_audio_files(chapter_audio_files, args.output)
-        print(f"Audiobook saved to {args.output}")
+        # The growing combined AudioSegment shows up between these snapshots
+        with section(profiler, "combine"):
+            if is_container(args.output):
+                mux_chapters([chapter_chunks[num] for num, _ in finished], [titles[num] for num, _ in finished], args)
+            else:
+                combine_chapters(chapter_audio_files, [titles[num] for num, _ in finished], args)
+    metrics.export(args.metrics_json, args.metrics_prom)
     
     # Clean up temporary files if successful
     if args.temp_dir and os.path.exists(args.temp_dir) and chapter_audio_files:
@@ -3,7 +3,6 @@
 import os
 import sys
 import argparse
-import subprocess
 import re
 import ebooklib
 from ebooklib import epub
@@ -12,6 +11,11 @@ from tqdm import tqdm
 import nltk
 from nltk.tokenize import sent_tokenize
 from pydub import AudioSegment
+from profiling import start_profiler, section
+import fake_tts
+from audio_io import write_wav
+from job_manifest import JobManifest, part_path
+from tts_backends import PiperProcessBackend
 
 # Download NLTK data
 nltk.download('punkt', quiet=True)
@@ -71,29 +75,6 @@ def split_text_into_chunks(text, max_chars=1000):
     print(f"Text split into {len(chunks)} chunks")
     return chunks
 
-def generate_audio_with_piper(text, output_file, model="en_US-lessac-medium"):
-    """Generate audio for a chunk of text using Piper."""
-    # Save text to a temporary file
-    temp_text_file = "/tmp/piper_input.txt"
-    with open(temp_text_file, "w") as f:
-        f.write(text)
-    
-    # Call Piper to generate audio
-    cmd = [
-        "piper",
-        "--model", model,
-        "--output_file", output_file,
-        "--file", temp_text_file
-    ]
-    
-    try:
-        subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        return True
-    except subprocess.CalledProcessError as e:
-        print(f"Error generating audio: {e}")
-        print(f"stderr: {e.stderr.decode()}")
-        return False
-
 def combine_audio_files(audio_files, output_file):
     """Combine multiple audio files into a single audiobook file."""
     print(f"Combining {len(audio_files)} audio segments...")
@@ -118,10 +99,14 @@ def main():
     parser.add_argument("--model", default="en_US-lessac-medium", help="Piper voice model to use")
     parser.add_argument("--temp_dir", default="temp_audio", help="Directory for temporary audio files")
     parser.add_argument("--chunk_size", type=int, default=1000, help="Maximum characters per chunk")
+    parser.add_argument("--profile", action='store_true', help="Write CPU profiles and memory snapshots to a profile directory in --temp_dir")
+    fake_tts.add_arguments(parser)
     args = parser.parse_args()
+    backend = fake_tts.from_args(args) or PiperProcessBackend(args.model)
     
     # Create temporary directory
     os.makedirs(args.temp_dir, exist_ok=True)
+    profiler = start_profiler(args.profile, args.temp_dir)
     
     # Extract text from EPUB
     text = extract_text_from_epub(args.epub)
@@ -129,28 +114,35 @@ def main():
     # Split text into chunks
     chunks = split_text_into_chunks(text, args.chunk_size)
     
-    # Generate audio for each chunk
+    # Generate audio for each chunk; the manifest records finished chunks, so a
+    # file left behind by an interrupted write is never taken as complete
+    manifest = JobManifest(args.temp_dir)
+    chunk_keys = [f"{i:04d}" for i in range(len(chunks))]
+    manifest.plan(dict(zip(chunk_keys, chunks)))
     audio_files = []
     
     for i, chunk in enumerate(tqdm(chunks, desc="Generating audio")):
         output_file = os.path.join(args.temp_dir, f"chunk_{i:04d}.wav")
         
-        # Skip if the file already exists (resume capability)
-        if os.path.exists(output_file):
+        # Skip chunks finished by an earlier run (resume capability)
+        if manifest.is_done(chunk_keys[i]):
             print(f"Chunk {i} already processed, skipping...")
             audio_files.append(output_file)
             continue
         
         # Generate audio for this chunk
-        success = generate_audio_with_piper(chunk, output_file, args.model)
-        
-        if success:
+        try:
+            write_wav(part_path(output_file), backend.synthesize(chunk), backend.sample_rate)
+            manifest.commit_output(chunk_keys[i], chunk, part_path(output_file), output_file)
             audio_files.append(output_file)
-        else:
+        except Exception as e:
+            print(f"Error generating audio: {e}")
             print(f"Failed to generate audio for chunk {i}")
+    manifest.close()
     
     # Combine all audio files
-    combine_audio_files(audio_files, args.output)
+    with section(profiler, "combine"):
+        combine_audio_files(audio_files, args.output)
     
     print("Audiobook generation complete!")
 
@@ -7,7 +7,8 @@ import re
 import shutil
 import time
 import datetime
-import psutil
+import copy
+import itertools
 from tqdm import tqdm
 from pydub import AudioSegment
 import torch
@@ -38,13 +39,24 @@ except ModuleNotFoundError as e:
         print("sys.path:", sys.path)
         print("Current directory:", os.getcwd())
         print("Directory contents:", os.listdir())
-        sys.exit(1)
+        # Only needed once the model is loaded; --plan and --fake_tts runs work without it
+        load_csm_1b = Segment = None
+
+from job_manifest import JobManifest, DONE, PARTIAL, FAILED, part_path
+from audio_io import StreamingWavWriter, write_chapter_metadata, write_playlist
+from audiobook_mux import is_container, mux_audiobook
+from memory_governor import MemoryGovernor
+from pipeline import Pipeline, Stage, prioritized
+from work_leases import LeaseQueue, run_worker
+from throughput_model import ThroughputModel, RunningEstimate, print_plan
+import metrics
+from metrics import METRICS, timed
+from chunk_trace import ChunkTrace, TRACE_NAME
+from profiling import start_profiler, section
+import fake_tts
+from tts_backends import SesameBackend, pcm16
 
 # --- Helper Functions ---
-import ebooklib
-from ebooklib import epub
-from bs4 import BeautifulSoup
-from PyPDF2 import PdfReader
 import nltk
 try:
     nltk.data.find('tokenizers/punkt')
@@ -57,54 +69,12 @@ except (nltk.downloader.DownloadError, LookupError):
         print(f"Error downloading NLTK punkt: {e}")
         sys.exit("Error: NLTK 'punkt' not available.")
 from nltk.tokenize import sent_tokenize
+from text_extraction import iter_chapters, leading_chunks, book_metadata, SPEECH_CHARS_PER_SECOND
 
-def html_to_text(html_content):
-    """Convert HTML content to plain text."""
-    soup = BeautifulSoup(html_content, 'html.parser')
-    # Get text and remove extra whitespace
-    text = ' '.join(soup.stripped_strings)
-    return text
-
-def extract_text_from_epub(epub_path):
-    """Extract text from an ePub file, chapter by chapter."""
-    print("Extracting text from ePub: {}...".format(epub_path))
-    try:
-        book = epub.read_epub(epub_path)
-        chapters_text = []
-        # Process items in reading order (spine)
-        for item in tqdm(book.get_items_of_type(ebooklib.ITEM_DOCUMENT), desc="Processing ePub items"):
-            content = item.get_content().decode('utf-8', errors='ignore')
-            text = html_to_text(content)
-            if text: # Only add if text is not empty
-                chapters_text.append(text)
-        full_text = "\n\n".join(chapters_text) # Join chapters
-        print("Extracted text from {} items.".format(len(chapters_text)))
-        return full_text
-    except Exception as e:
-        print("Error reading EPUB file {}: {}".format(epub_path, e))
-        return None
-
-def extract_text_from_pdf(pdf_path):
-    """Extract text from a PDF file."""
-    print("Extracting text from PDF: {}...".format(pdf_path))
-    full_text = ""
-    try:
-        reader = PdfReader(pdf_path)
-        for page in tqdm(reader.pages, desc="Processing PDF pages"):
-            try:
-                page_text = page.extract_text()
-                if page_text:
-                    # Basic cleaning (remove excessive newlines)
-                    page_text = re.sub(r'\n\s*\n', '\n', page_text)
-                    full_text += page_text + "\n"
-            except Exception as page_e:
-                print("Warning: Could not extract text from a PDF page: {}".format(page_e))
-        print("Extracted text from {} pages.".format(len(reader.pages)))
-        return full_text.strip()
-    except Exception as e:
-        print("Error reading PDF file {}: {}".format(pdf_path, e))
-        return None
+# Sample rate of the CSM decoder, used for the synthetic backend
+CSM_SAMPLE_RATE = 24000
 
+@timed("split_text")
 def split_text(text, max_length=500, sentence_boundary=True):
     """Split text into chunks, respecting sentence boundaries if possible."""
     print("Splitting text...")
@@ -141,36 +111,39 @@ def split_text(text, max_length=500, sentence_boundary=True):
     print("Split into {} chunks.".format(len(chunks)))
     return chunks
 
-def process_range(range_str, max_val):
-    """Process a range string like '1-5' and return a list of indices."""
+def parse_range(range_str):
+    """
+    Parse a range string like '1-5' (or '3') into 1-based (first, last).
+
+    last is None when no range is given, so chapters can be filtered as
+    they are extracted without knowing how many there are.
+    """
     if not range_str:
-        return list(range(max_val))  # All chunks
+        return 1, None  # All chapters
     
     try:
         # Parse the range string (e.g., "1-5")
         parts = range_str.split('-')
         if len(parts) == 1:
             # Single value
-            start = int(parts[0]) - 1  # Convert to 0-based index
-            end = start + 1
+            first = last = int(parts[0])
         else:
             # Range
-            start = int(parts[0]) - 1  # Convert to 0-based index
-            end = int(parts[1])
+            first, last = int(parts[0]), int(parts[1])
         
         # Validate range
-        if start < 0 or end > max_val or start >= end:
-            print(f"Warning: Invalid range {range_str} for {max_val} chunks. Using all chunks.")
-            return list(range(max_val))
+        if first < 1 or first > last:
+            print(f"Warning: Invalid range {range_str}. Using all chapters.")
+            return 1, None
         
-        return list(range(start, end))
+        return first, last
     except ValueError:
-        print(f"Warning: Could not parse range string '{range_str}'. Using all chunks.")
-        return list(range(max_val))
+        print(f"Warning: Could not parse range string '{range_str}'. Using all chapters.")
+        return 1, None
 
 def find_voice_preset_file(model_path, voice_preset):
     """Find the voice preset file in various possible locations."""
-    if not voice_preset:
+    if not voice_preset or not model_path:
         return None
     
     # Define possible preset locations and extensions
@@ -197,56 +170,500 @@ def find_voice_preset_file(model_path, voice_preset):
     
     return None
 
-def synthesize_chunk(generator, text, voice_preset_wav, output_path, device):
-    """Synthesizes audio for a text chunk using the generator."""
+@timed("load_voice_context")
+def load_voice_context(generator, voice_preset_wav, device, speaker_id=0):
+    """Load the voice preset as a generation context, or return an empty context."""
+    if not voice_preset_wav or not os.path.exists(voice_preset_wav):
+        return []
     try:
-        context = []
-        speaker_id = 0 # Default speaker ID
-
-        # Use voice_preset_wav as context
-        if voice_preset_wav and os.path.exists(voice_preset_wav):
-            try:
-                ref_wav, ref_sr = torchaudio.load(voice_preset_wav)
-                # Resample if necessary
-                if ref_sr != generator.sample_rate:
-                    ref_wav = torchaudio.functional.resample(ref_wav.squeeze(0), orig_freq=ref_sr, new_freq=generator.sample_rate)
-                else:
-                    ref_wav = ref_wav.squeeze(0)
-                # Create a Segment for context
-                # Use a placeholder text for the context segment
-                context = [Segment(text="Voice prompt.", speaker=speaker_id, audio=ref_wav.to(device))]
-                print(f"Using voice preset as context: {voice_preset_wav}")
-            except Exception as load_e:
-                print("Warning: Could not load or process voice preset {}: {}".format(voice_preset_wav, load_e))
-                context = [] # Fallback to no context
-        
-        # Generate audio using the new method
-        audio = generator.generate(
-            text=text,
-            speaker=speaker_id,
-            context=context,
-            max_audio_length_ms=60_000, # Allow longer chunks (60s)
-        )
-
-        # Save generated audio
-        torchaudio.save(output_path, audio.unsqueeze(0).cpu(), generator.sample_rate)
+        ref_wav, ref_sr = torchaudio.load(voice_preset_wav)
+        # Resample if necessary
+        if ref_sr != generator.sample_rate:
+            ref_wav = torchaudio.functional.resample(ref_wav.squeeze(0), orig_freq=ref_sr, new_freq=generator.sample_rate)
+        else:
+            ref_wav = ref_wav.squeeze(0)
+        # Create a Segment for context
+        # Use a placeholder text for the context segment
+        print(f"Using voice preset as context: {voice_preset_wav}")
+        return [Segment(text="Voice prompt.", speaker=speaker_id, audio=ref_wav.to(device))]
+    except Exception as load_e:
+        print("Warning: Could not load or process voice preset {}: {}".format(voice_preset_wav, load_e))
+        return [] # Fallback to no context
+
+def save_span_audio(spans, output_path, sample_rate):
+    """Save the audio of successful spans next to the chunk file and drop the tensors."""
+    base = os.path.splitext(output_path)[0]
+    for span in spans:
+        audio = span.pop("audio", None)
+        if span["status"] == "ok" and audio is not None:
+            span["audio_file"] = "{}.span_{:06d}_{:06d}.wav".format(base, span["start"], span["end"])
+            torchaudio.save(span["audio_file"], audio.unsqueeze(0).cpu(), sample_rate)
+    return spans
+
+def assemble_spans(spans, output_path):
+    """Concatenate span files into the chunk file and remove them."""
+    audio = torch.cat([torchaudio.load(span["audio_file"])[0] for span in spans], dim=1)
+    sample_rate = torchaudio.info(spans[0]["audio_file"]).sample_rate
+    torchaudio.save(output_path, audio, sample_rate)
+    for span in spans:
+        os.remove(span["audio_file"])
+        span["audio_file"] = None
+
+def finish_output(manifest, chunk_index, text, tmp_path, output_path, spans=None):
+    """Move a finished chunk into place; with a manifest this is atomic and journaled."""
+    if manifest:
+        manifest.commit_output(chunk_index, text, tmp_path, output_path, spans=spans)
+    else:
+        os.replace(tmp_path, output_path)
+
+@timed("synthesize_chunk")
+def synthesize_chunk(generator, text, voice_preset_wav, output_path, device, manifest=None, chunk_index=None):
+    """
+    Synthesizes audio for a text chunk using the generator.
+
+    Failed sentence spans are recorded in the manifest. If the manifest
+    already holds a partial result for this chunk, only its failed spans
+    are re-synthesized.
+    """
+    speaker_id = 0 # Default speaker ID
+    context = load_voice_context(generator, voice_preset_wav, device, speaker_id)
+    max_audio_length_ms = 60_000 # Allow longer chunks (60s)
+
+    # Original CSM generator: no span-level retries, just save or fail
+    if not hasattr(generator, "generate_spans"):
+        try:
+            with METRICS.timer("generate"):
+                audio = generator.generate(
+                    text=text,
+                    speaker=speaker_id,
+                    context=context,
+                    max_audio_length_ms=max_audio_length_ms,
+                )
+            torchaudio.save(part_path(output_path), audio.unsqueeze(0).cpu(), generator.sample_rate)
+        except Exception as e:
+            print("Error during synthesis for chunk: {}".format(e))
+            return False
+        # Outside the try: a manifest refusing the commit (see JobManifest) stops the chapter
+        finish_output(manifest, chunk_index, text, part_path(output_path), output_path)
         return True
+
+    entry = manifest.chunk(chunk_index) if manifest else None
+    try:
+        if entry and entry["status"] == PARTIAL:
+            # Keep the spans that already succeeded and retry only the failed ones
+            spans = []
+            for span in entry["spans"]:
+                if span["status"] != FAILED:
+                    spans.append(span)
+                    continue
+                budget = max(generator.min_audio_length_ms,
+                             int(max_audio_length_ms * len(span["text"]) / len(text)))
+                retried = generator.generate_spans(span["text"], speaker_id, context, budget, offset=span["start"])
+                spans.extend(save_span_audio(retried, output_path, generator.sample_rate))
+            print("Retried {} failed spans of chunk {}".format(len(manifest.failed_spans(chunk_index)), chunk_index))
+        else:
+            with METRICS.timer("generate"):
+                generated = generator.generate_spans(text, speaker_id, context, max_audio_length_ms)
+            spans = save_span_audio(generated, output_path, generator.sample_rate)
     except Exception as e:
         print("Error during synthesis for chunk: {}".format(e))
-        # print("Chunk text: {}".format(text[:100])) # Optional debug
+        if manifest:
+            manifest.record_chunk(chunk_index, text, FAILED, spans=[{
+                "start": 0, "end": len(text), "text": text, "status": FAILED, "error": str(e)}])
         return False
 
+    failed = [span for span in spans if span["status"] == FAILED]
+    if failed:
+        print("Warning: {} of {} spans failed in chunk {}; they will be retried on resume".format(
+            len(failed), len(spans), chunk_index))
+        if manifest:
+            manifest.record_chunk(chunk_index, text, PARTIAL, spans=spans)
+        return False
+
+    assemble_spans(spans, part_path(output_path))
+    finish_output(manifest, chunk_index, text, part_path(output_path), output_path, spans)
+    return True
+
+@timed("stream_chunk")
+def stream_chunk(generator, text, voice_preset_wav, output_path, device, manifest=None, chunk_index=None):
+    """
+    Synthesize a chunk frame by frame, appending audio to the output as it is decoded.
+
+    Audio is written to '<output>.part.wav', which is a playable WAV at
+    all times, and renamed to the output once the chunk is complete. If the
+    stream fails, the chunk falls back to synthesize_chunk and its
+    split-and-retry policy.
+    """
+    if not hasattr(generator, "generate_stream"):
+        return synthesize_chunk(generator, text, voice_preset_wav, output_path, device, manifest, chunk_index)
+
+    speaker_id = 0 # Default speaker ID
+    context = load_voice_context(generator, voice_preset_wav, device, speaker_id)
+    tmp_path = part_path(output_path)
+    start_time = time.time()
+    first_audio_time = None
+    try:
+        with StreamingWavWriter(tmp_path, generator.sample_rate) as writer:
+            for audio in generator.generate_stream(text, speaker_id, context, max_audio_length_ms=60_000):
+                writer.append(pcm16(audio))
+                if first_audio_time is None:
+                    first_audio_time = time.time() - start_time
+                    print("First audio for chunk {} after {:.2f}s".format(chunk_index, first_audio_time))
+    except Exception as e:
+        print("Streaming synthesis failed for chunk {}: {}. Retrying without streaming.".format(chunk_index, e))
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return synthesize_chunk(generator, text, voice_preset_wav, output_path, device, manifest, chunk_index)
+
+    finish_output(manifest, chunk_index, text, tmp_path, output_path)
+    print("Chunk {}: {:.1f}s of audio in {:.2f}s".format(chunk_index, writer.duration, time.time() - start_time))
+    return True
+
+@timed("assemble_watermarked")
+def assemble_watermarked(audio_files, output_path, stream_watermarker, sample_rate):
+    """
+    Concatenate chunk files into one WAV, watermarking the stream block by block.
+
+    Chunks are read one at a time, so memory stays bounded by the
+    watermarker's block size rather than the length of the book.
+    """
+    with StreamingWavWriter(output_path, sample_rate) as writer:
+        for audio_file in tqdm(audio_files, desc="Watermarking Audio"):
+            if not os.path.exists(audio_file) or os.path.getsize(audio_file) == 0:
+                print("Warning: Skipping missing or empty audio file: {}".format(audio_file))
+                continue
+            audio, file_rate = torchaudio.load(audio_file)
+            audio = audio.mean(dim=0)
+            if file_rate != sample_rate:
+                audio = torchaudio.functional.resample(audio, orig_freq=file_rate, new_freq=sample_rate)
+            writer.append(pcm16(stream_watermarker.process(audio)))
+        writer.append(pcm16(stream_watermarker.flush()))
+    return output_path
+
+def chapter_output_path(args, chapter_num, chapter_title):
+    """Return the output file of a chapter."""
+    safe_title = re.sub(r'[^\w\s-]', '', chapter_title).strip().replace(' ', '_')
+    return os.path.join(args.output_dir, f"chapter_{chapter_num:02d}_{safe_title}.{args.output_format}")
+
+def chunk_chapter(chapter, args, guard=None):
+    """
+    Open a chapter's manifest and split it into chunks.
+
+    Each chapter has its own temp namespace (temp_dir/chapter_NN) with its
+    own manifest, so chapters resume and can be scheduled independently:
+    a finished chapter is skipped from its manifest alone, and a failure
+    only ever requires re-exporting that chapter. guard is passed to the
+    manifest (see JobManifest).
+    """
+    chapter_num, chapter_text, chapter_title = chapter
+    chapter_dir = os.path.join(args.temp_dir, f"chapter_{chapter_num:02d}")
+    os.makedirs(chapter_dir, exist_ok=True)
+    manifest = JobManifest(chapter_dir, guard=guard)
+
+    job = {
+        "num": chapter_num,
+        "title": chapter_title,
+        "text": chapter_text,
+        "dir": chapter_dir,
+        "manifest": manifest,
+        "output": chapter_output_path(args, chapter_num, chapter_title),
+        "chunks": [],
+        "audio_files": [],
+    }
+
+    # The chapter output is keyed by the whole chapter text, so edits invalidate it
+    manifest.plan({"output": chapter_text})
+    if manifest.is_done("output"):
+        print(f"Chapter {chapter_num} already exported to {manifest.chunk('output')['output']}, skipping")
+        job["output"] = manifest.chunk("output")["output"]
+        job["done"] = True
+        return job
+
+    job["chunks"] = split_text(chapter_text, max_length=args.chunk_length, sentence_boundary=True)
+    manifest.plan({i: chunk for i, chunk in enumerate(job["chunks"])})
+    return job
+
+def voice_throughput(args):
+    """Return the learned throughput model for the selected voice and device type on this host."""
+    if args.fake_tts:
+        return ThroughputModel("fake", "tone", args.stats_file)
+    backend = "sesame-cuda" if torch.cuda.is_available() else "sesame-cpu"
+    return ThroughputModel(backend, args.voice_preset or "default", args.stats_file)
+
+def load_generator(args, device):
+    """Load the CSM generator, or the synthetic backend selected with --fake_tts."""
+    if args.fake_tts:
+        return fake_tts.from_args(args, sample_rate=CSM_SAMPLE_RATE)
+    if load_csm_1b is None:
+        raise RuntimeError("the CSM generator module could not be imported")
+    if args.watermark_mode == "stream" or args.stream:
+        # Watermark once over the assembled stream instead of per chunk
+        return load_csm_1b(args.model_path, device=device, defer_watermark=True)
+    return load_csm_1b(args.model_path, device=device)
+
+def count_tokens(generator, text):
+    """Return the number of text tokens the model sees for text, if its tokenizer is available."""
+    tokenizer = getattr(generator, "_text_tokenizer", None)
+    try:
+        return len(tokenizer.encode(text)) if tokenizer is not None else None
+    except Exception:
+        return None
+
+def synthesize_chapter(job, generator, args, voice_preset_path, device, governor, throughput=None, trace=None):
+    """Synthesize every pending chunk of a chapter on the model's device, recording its throughput and trace."""
+    if job.get("done"):
+        return job
+    throughput = throughput or voice_throughput(args)
+    chapter_num, manifest = job["num"], job["manifest"]
+    print(f"Processing chapter {chapter_num}: {job['title']}")
+    pending = [chunk for idx, chunk in enumerate(job["chunks"]) if not manifest.is_done(idx)]
+    print("Estimated processing time for this chapter: {}".format(throughput.eta(pending)))
+
+    start_time = time.time()
+    next_check = governor.batch_size
+    for chunk_idx, chunk in enumerate(tqdm(job["chunks"], desc=f"Synthesizing chapter {chapter_num}")):
+        chunk_filename = os.path.join(job["dir"], "chunk_{:04d}.wav".format(chunk_idx))
+        
+        # Resume from the manifest alone: only committed chunks count as done
+        entry = manifest.chunk(chunk_idx)
+        if entry["status"] == DONE:
+            job["audio_files"].append(chunk_filename)
+            continue
+
+        synthesize = stream_chunk if args.stream and entry["status"] != PARTIAL else synthesize_chunk
+        # A resumed chunk counts as one retry, and so does every split of a failing span
+        retries = 1 if entry["status"] in (PARTIAL, FAILED) else 0
+        chunk_start = time.time()
+        if synthesize(generator, chunk, voice_preset_path, chunk_filename, device, manifest, chunk_idx):
+            job["audio_files"].append(chunk_filename)
+            chunk_seconds, audio_seconds = time.time() - chunk_start, manifest.chunk(chunk_idx)["duration"]
+            throughput.observe(len(chunk), chunk_seconds, audio_seconds, os.path.getsize(chunk_filename))
+            METRICS.record_synthesis(throughput.backend, chunk_seconds, audio_seconds, len(chunk))
+            status = "done"
+        else:
+            print("Warning: Failed to synthesize chunk {} of chapter {}.".format(chunk_idx, chapter_num))
+            chunk_seconds, audio_seconds, status = time.time() - chunk_start, None, "failed"
+        if trace:
+            retries += max(0, len(manifest.chunk(chunk_idx)["spans"]) - 1)
+            trace.record(os.path.splitext(os.path.basename(args.input))[0], chapter_num, chunk_idx, chunk,
+                         chunk_seconds, audio_seconds, status=status, retries=retries,
+                         tokens=count_tokens(generator, chunk))
+
+        if chunk_idx + 1 >= next_check:
+            governor.update()
+            next_check = chunk_idx + 1 + governor.batch_size
+
+    print("Chapter {} synthesis took {:.2f} seconds.".format(chapter_num, time.time() - start_time))
+    incomplete = len(manifest.pending(range(len(job["chunks"]))))
+    if incomplete:
+        # Never export a chapter with holes; a rerun retries only what failed
+        print("Warning: {} chunks of chapter {} are incomplete (see {}); not exporting it.".format(
+            incomplete, chapter_num, manifest.path))
+        manifest.close()
+        return None
+    return job
+
+def encode_chapter(job, generator, args, part_tag=None):
+    """
+    Concatenate a chapter's chunks, export it atomically and record it as done.
+
+    part_tag makes the in-progress file unique to this writer (see job_manifest.part_path).
+    """
+    chapter_num, manifest = job["num"], job["manifest"]
+    if job.get("done"):
+        manifest.close()
+        return chapter_num, job["output"]
+
+    audio_files = job["audio_files"]
+    chapter_output = job["output"]
+    combined_audio = AudioSegment.empty()
+    stream_watermarker = getattr(generator, "stream_watermarker", None)
+    try:
+        if stream_watermarker is not None:
+            assembled = assemble_watermarked(audio_files, os.path.join(job["dir"], "assembled.wav"),
+                                             stream_watermarker, generator.sample_rate)
+            combined_audio = AudioSegment.from_wav(assembled)
+            audio_files.append(assembled)  # removed with the chunks on cleanup
+        else:
+            with METRICS.timer("pydub_concatenate"):
+                for audio_file in tqdm(audio_files, desc="Combining Audio"):
+                    if os.path.exists(audio_file) and os.path.getsize(audio_file) > 0:
+                        try:
+                            segment = AudioSegment.from_wav(audio_file)
+                            combined_audio += segment
+                        except Exception as combine_e:
+                             print("Warning: Could not process audio file {}: {}".format(audio_file, combine_e))
+                    else:
+                        print("Warning: Skipping missing or empty audio file: {}".format(audio_file))
+
+        if len(combined_audio) == 0:
+            print("Error: Combined audio for chapter {} is empty. Cannot export.".format(chapter_num))
+            manifest.close()
+            return None
+
+        # Export the chapter atomically, then record it so resume skips the chapter
+        print("Exporting chapter {} to '{}'...".format(chapter_num, chapter_output))
+        with METRICS.timer("export", format=args.output_format):
+            combined_audio.export(part_path(chapter_output, part_tag), format=args.output_format)
+        manifest.commit_output("output", job["text"], part_path(chapter_output, part_tag), chapter_output)
+    except Exception as e:
+        print("Error during audio concatenation or export of chapter {}: {}".format(chapter_num, e))
+        manifest.close()
+        return None
+    manifest.close()
+
+    # --- Cleanup (Optional) ---
+    # The chapter manifest is kept so the finished chapter is skipped on resume
+    if not args.keep_temp:
+        for audio_file in audio_files:
+            try:
+                if os.path.exists(audio_file):
+                    os.remove(audio_file)
+            except Exception as e:
+                print("Warning: Could not remove temp file {}: {}".format(audio_file, e))
+    return chapter_num, chapter_output
+
+@timed("combine_chapters")
+def combine_chapters(chapter_outputs, output_path, titles, input_path=None, bitrate="64k"):
+    """Concatenate chapter files into the combined audiobook, with its chapter markers next to it."""
+    if is_container(output_path):
+        # M4B/MKA: the chapter WAV files are encoded once, with chapters, tags and cover from the book
+        if not all(path.lower().endswith(".wav") for path in chapter_outputs):
+            raise ValueError("an .m4b or .mka audiobook is encoded from WAV chapter files; use --output_format wav")
+        metadata = book_metadata(input_path) if input_path else {"title": None, "author": None, "cover": None}
+        title = metadata["title"] or os.path.splitext(os.path.basename(output_path))[0]
+        mux_audiobook(output_path, [(chapter_title, [path]) for chapter_title, path in zip(titles, chapter_outputs)],
+                      {"title": title, "album": title, "artist": metadata["author"], "genre": "Audiobook"},
+                      metadata["cover"], bitrate=bitrate)
+        print("Audiobook saved to {}".format(output_path))
+        return
+    combined_audio = AudioSegment.empty()
+    for chapter_output in tqdm(chapter_outputs, desc="Combining Chapters"):
+        combined_audio += AudioSegment.from_file(chapter_output)
+    output_format = os.path.splitext(output_path)[1].lower().strip('.') or 'mp3'
+    combined_audio.export(part_path(output_path), format=output_format)
+    os.replace(part_path(output_path), output_path)
+    # Chapter lengths come from the chapter files' headers, so no audio is decoded again
+    try:
+        markers = write_chapter_metadata(output_path, chapter_outputs, titles,
+                                         metadata={"title": os.path.splitext(os.path.basename(output_path))[0]})
+        print("Chapter markers saved to {}".format(markers))
+    except (ValueError, OSError) as e:
+        print("Could not write chapter markers: {}".format(e))
+
+def publish_preview(chapters, generator, args, voice_preset_path, device, governor, throughput, trace=None):
+    """
+    Synthesize about the first --first_listen_minutes of the book into a preview file.
+
+    The preview's chunks are the leading chunks of their chapters, recorded
+    in the chapter manifests, so the full run reuses them. Chapters that
+    were already exported are playable as they are and are skipped.
+    """
+    remaining_minutes = args.first_listen_minutes
+    audio_files = []
+    for chapter in chapters:
+        job = chunk_chapter(chapter, args)
+        if job.get("done"):
+            job["manifest"].close()
+            continue
+        count = leading_chunks(job["chunks"], remaining_minutes)
+        job["chunks"] = job["chunks"][:count]
+        remaining_minutes -= sum(len(chunk) for chunk in job["chunks"]) / (60 * SPEECH_CHARS_PER_SECOND)
+        job = synthesize_chapter(job, generator, args, voice_preset_path, device, governor, throughput, trace)
+        if job is not None:
+            audio_files.extend(job["audio_files"])
+            job["manifest"].close()
+        if remaining_minutes <= 0:
+            break
+    if not audio_files:
+        return None
+
+    preview = os.path.join(args.output_dir, "preview.{}".format(args.output_format))
+    stream_watermarker = getattr(generator, "stream_watermarker", None)
+    if stream_watermarker is not None:
+        # Chunks are not watermarked individually in stream mode
+        assembled = assemble_watermarked(audio_files, os.path.join(args.temp_dir, "preview.wav"),
+                                         stream_watermarker, generator.sample_rate)
+        preview_audio = AudioSegment.from_wav(assembled)
+        os.remove(assembled)
+    else:
+        preview_audio = AudioSegment.empty()
+        for audio_file in audio_files:
+            preview_audio += AudioSegment.from_wav(audio_file)
+    preview_audio.export(part_path(preview), format=args.output_format)
+    os.replace(part_path(preview), preview)
+    return preview
+
+def run_distributed_worker(chapters, generator, args, voice_preset_path, device, governor, throughput, trace=None):
+    """
+    Process chapters as one of several workers sharing the temp and output directories.
+
+    Chapters are claimed through lease files in temp_dir/leases; the lease
+    holder is the only writer of the chapter's manifest (a worker that loses
+    its lease stops writing it), and a backup copy of a straggler works in a
+    separate namespace. The worker that sees every chapter done assembles
+    the audiobook. Returns the worker's exit status: 1 if chapters failed.
+    """
+    queue = LeaseQueue(os.path.join(args.temp_dir, "leases"), worker_id=args.worker_id,
+                       lease_seconds=args.lease_seconds, steal_after=args.steal_after)
+    print("Worker {}: {} chapters in {}".format(queue.worker_id, len(chapters), queue.lease_dir))
+    by_key = {"chapter_{:02d}".format(chapter[0]): chapter for chapter in chapters}
+
+    def process(key, lease):
+        chapter_args = copy.copy(args)
+        if lease.backup:
+            chapter_args.temp_dir = os.path.join(args.temp_dir, "backup_{}".format(queue.worker_id))
+        # Once the lease is taken over, the manifest refuses writes and the chapter is abandoned
+        job = chunk_chapter(by_key[key], chapter_args, guard=lease.check)
+        manifest = job["manifest"]
+        try:
+            job = synthesize_chapter(job, generator, chapter_args, voice_preset_path, device, governor, throughput, trace)
+            lease.check()
+            # A backup copy of this chapter may be exporting it at the same time
+            return job is not None and encode_chapter(job, generator, chapter_args, part_tag=queue.worker_id) is not None
+        finally:
+            manifest.close()
+
+    def assemble():
+        if args.output:
+            print("Combining {} chapters into '{}'...".format(len(chapters), args.output))
+            combine_chapters([chapter_output_path(args, num, title) for num, _, title in chapters], args.output,
+                             [title for _, _, title in chapters], args.input, args.audio_bitrate)
+        return True
+
+    summary = run_worker(queue, list(by_key), process, assemble)
+    throughput.save(governor.peak_rss_mb)
+    metrics.export(args.metrics_json, args.metrics_prom)
+    print("Worker {} finished: {}".format(queue.worker_id, summary))
+    return 0 if summary["failed"] == 0 else 1
+
+def output_format_error(args):
+    """Return why the --output container cannot be made from the --output_format chapter files, or None."""
+    if args.output and is_container(args.output) and args.output_format and args.output_format.lower() != "wav":
+        return "an .m4b or .mka --output is encoded from WAV chapter files; use --output_format wav"
+    return None
+
 def main(args):
+    job_start = time.time()
     # Validate input file path
     if not os.path.exists(args.input):
         print("Error: Input file '{}' does not exist.".format(args.input))
         return
 
     # Validate model path (still needed for load_csm_1b)
-    if not os.path.exists(args.model_path) or not os.path.isdir(args.model_path):
+    if not args.fake_tts and not (args.model_path and os.path.isdir(args.model_path)):
         print("Error: Model path '{}' does not exist or is not a directory.".format(args.model_path))
         return
 
+    if not args.output and not args.output_dir:
+        print("Error: Specify --output, --output_dir, or both.")
+        return
+
+    # Checked before the model is loaded, not after the whole book is synthesized
+    if output_format_error(args):
+        print("Error: {}".format(output_format_error(args)))
+        return
+
     # Determine voice preset path (used for context)
     voice_preset_path = None
     if args.voice_preset:
@@ -259,17 +676,77 @@ def main(args):
         print("No voice preset specified, using default voice.")
 
     # Create output directories
-    temp_dir = args.temp_dir or os.path.join(os.path.dirname(args.output), "temp_audio_sesame")
-    os.makedirs(temp_dir, exist_ok=True)
+    if not args.output_dir:
+        args.output_dir = os.path.splitext(args.output)[0] + "_chapters"
+    if not args.output_format:
+        if args.output and is_container(args.output):
+            # Chapters of an M4B/MKA audiobook stay lossless until it is encoded
+            args.output_format = 'wav'
+        else:
+            args.output_format = (os.path.splitext(args.output)[1].lower().strip('.') if args.output else '') or 'mp3'
+    args.temp_dir = args.temp_dir or os.path.join(args.output_dir, "temp_audio_sesame")
+
+    # --- Process Chapter Range ---
+    first_chapter, last_chapter = parse_range(args.chapter_range)
+    if args.chapter_range:
+        print(f"Processing chapters {first_chapter}-{last_chapter if last_chapter else 'end'} from specified range: {args.chapter_range}")
+
+    # --- Text Extraction ---
+    # Chapters are extracted lazily, so extraction overlaps synthesis; --plan reads
+    # the whole book, without loading the model, for a dry run
+    print("Extracting text from '{}'...".format(args.input))
+    file_extension = os.path.splitext(args.input)[1].lower()
+    if file_extension not in ('.epub', '.pdf'):
+        print("Error: Unsupported file format '{}'. Please use EPUB or PDF.".format(file_extension))
+        return
+
+    selected = []
+    def selected_chapters():
+        try:
+            for chapter_num, (chapter_text, chapter_title) in enumerate(iter_chapters(args.input), 1):
+                if last_chapter is not None and chapter_num > last_chapter:
+                    break
+                if chapter_num >= first_chapter:
+                    selected.append(chapter_num)
+                    yield chapter_num, chapter_text, chapter_title
+        except Exception as e:
+            print("Error reading {}: {}".format(args.input, e))
+    # Chapters are extracted as the pipeline asks for them; the first one shows
+    # that the book can be read before the model is loaded
+    chapters = selected_chapters()
+    first = next(chapters, None)
+    if first is None:
+        print("Error: Could not extract text from the input file.")
+        return
+    chapters = itertools.chain([first], chapters)
+
+    # Only a plan reads the whole book up front; a run refines its ETA as chapters are chunked
+    throughput = voice_throughput(args)
+    if args.plan:
+        print_plan(throughput.plan([(num, title, split_text(text, max_length=args.chunk_length, sentence_boundary=True))
+                                    for num, text, title in chapters],
+                                   per_item_mb=args.memory_per_chunk))
+        return
+    print("Throughput: {}".format(throughput.summary()))
 
     # --- Model Loading ---
+    os.makedirs(args.temp_dir, exist_ok=True)
+    os.makedirs(args.output_dir, exist_ok=True)
     print("Loading Sesame CSM model from '{}'...".format(args.model_path))
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     print("Using device: {}".format(device))
     try:
-        # Load using the new function, passing the model path
-        generator = load_csm_1b(args.model_path, device=device)
+        load_start = time.time()
+        generator = load_generator(args, device)
         print("Model loaded successfully. Sample rate: {}".format(generator.sample_rate))
+        capabilities = SesameBackend(generator, load_seconds=time.time() - load_start).capabilities
+        print("Backend: {}".format(capabilities.summary()))
+        if args.stream and not capabilities.streaming:
+            print("Warning: This generator cannot stream; synthesizing whole chunks instead.")
+            args.stream = False
+        profiler = start_profiler(args.profile, args.temp_dir)
+        if profiler:
+            profiler.wrap_generator(generator)
     except Exception as e:
         print("Error loading model: {}".format(e))
         # Check if it's related to Llama-3.2-1B access
@@ -277,134 +754,153 @@ def main(args):
              print("Ensure you are logged into Hugging Face CLI and have accepted terms for meta-llama/Llama-3.2-1B.")
         return
 
-    # --- Text Extraction ---
-    print("Extracting text from '{}'...".format(args.input))
-    file_extension = os.path.splitext(args.input)[1].lower()
-    if file_extension == '.epub':
-        full_text = extract_text_from_epub(args.input)
-    elif file_extension == '.pdf':
-        full_text = extract_text_from_pdf(args.input)
-    else:
-        print("Error: Unsupported file format '{}'. Please use EPUB or PDF.".format(file_extension))
-        return
-
-    if not full_text:
-        print("Error: Could not extract text from the input file.")
-        return
-    print("Text extracted successfully.")
-
-    # --- Text Splitting ---
-    text_chunks = split_text(full_text, max_length=args.chunk_length, sentence_boundary=True)
-    
-    # --- Process Chapter Range ---
-    if args.chapter_range:
-        chunk_indices = process_range(args.chapter_range, len(text_chunks))
-        selected_chunks = [text_chunks[i] for i in chunk_indices]
-        print(f"Processing {len(selected_chunks)} chunks from specified range: {args.chapter_range}")
-        text_chunks = selected_chunks
-
     # --- Apply Memory Constraints ---
-    if args.memory_per_chunk > 0 and args.max_batch_size > 0:
-        # Split into batches to manage memory
-        max_chunks = args.max_batch_size
-        print(f"Processing in batches of maximum {max_chunks} chunks (memory per chunk: {args.memory_per_chunk}MB)")
-        batches = [text_chunks[i:i+max_chunks] for i in range(0, len(text_chunks), max_chunks)]
-    else:
-        # Process all at once
-        batches = [text_chunks]
-        
-    # --- Audio Synthesis ---
+    # The model is resident on one device, so only the number of chunks between
+    # memory checks adapts; caches are released only when close to the budget.
+    governor = MemoryGovernor(
+        budget_mb=args.memory_budget,
+        per_item_mb=args.memory_per_chunk,
+        max_concurrency=capabilities.max_concurrency,
+        max_batch_size=max(1, args.max_batch_size),
+    )
+    print(f"Memory governor: {governor.summary()}")
+
+    # One trace per job; workers sharing the job directory each add their own records
+    trace = ChunkTrace(args.trace or os.path.join(args.temp_dir, TRACE_NAME), throughput.backend,
+                       throughput.voice, worker_id=args.worker_id)
+
+    if args.worker:
+        # Chapters are leased by key, so a worker needs all of them
+        try:
+            return run_distributed_worker(list(chapters), generator, args, voice_preset_path, device, governor, throughput, trace)
+        finally:
+            trace.close()
+
+    # --- Scheduling ---
+    # Requested chapters are synthesized first, then the rest in order
+    notes = {}
+    if args.priority_chapters:
+        try:
+            priority = [int(num) for num in args.priority_chapters.split(',')]
+        except ValueError:
+            print("Error: Invalid chapter list '{}'. Expected format: '1,5'".format(args.priority_chapters))
+            return
+        chapters = prioritized(chapters, priority)
+
+    # Publish the opening of the book before anything else
+    if args.first_listen_minutes:
+        opening, opening_chars = [], 0
+        for chapter in chapters:
+            opening.append(chapter)
+            opening_chars += len(chapter[1])
+            if opening_chars >= args.first_listen_minutes * 60 * SPEECH_CHARS_PER_SECOND:
+                break
+        preview = publish_preview(opening, generator, args, voice_preset_path, device, governor, throughput, trace)
+        if preview:
+            notes["time_to_preview_seconds"] = round(time.time() - job_start, 3)
+            print("Preview of the first {:g} minutes saved to '{}' after {:.1f}s".format(
+                args.first_listen_minutes, preview, notes["time_to_preview_seconds"]))
+        chapters = itertools.chain(opening, chapters)
+
+    # Each chapter is published, with a playlist of the finished chapters, as soon as it is exported
+    published = {}
+    def publish(encoded):
+        if encoded is None:
+            return None
+        chapter_num, chapter_output = encoded
+        if not published:
+            notes["time_to_first_chapter_seconds"] = round(time.time() - job_start, 3)
+            print("First playable chapter after {:.1f}s".format(notes["time_to_first_chapter_seconds"]))
+        published[chapter_num] = chapter_output
+        write_playlist(os.path.join(args.output_dir, "playlist.m3u"), [published[num] for num in sorted(published)])
+        return encoded
+
+    titles = {}
+    estimate = RunningEstimate(throughput)
+    def chunk(chapter):
+        job = chunk_chapter(chapter, args)
+        titles[job["num"]] = job["title"]
+        estimate.add(job["chunks"])
+        print("Estimated processing time: {}".format(estimate.summary()))
+        return job
+
+    # --- Chapter Synthesis ---
+    # Extraction, chunking, synthesis and encoding overlap: the encoder works on
+    # chapter N while chapter N+1 is synthesized and chapter N+2 is chunked
     print("Starting audio synthesis...")
-    audio_files = []
     start_time = time.time()
-    
-    batch_count = len(batches)
-    for batch_idx, batch in enumerate(batches):
-        print(f"Processing batch {batch_idx+1}/{batch_count} ({len(batch)} chunks)")
-        
-        for i, chunk in enumerate(tqdm(batch, desc=f"Synthesizing Batch {batch_idx+1}")):
-            overall_idx = batch_idx * args.max_batch_size + i if args.max_batch_size > 0 else i
-            chunk_filename = os.path.join(temp_dir, "chunk_{:04d}.wav".format(overall_idx))
-            
-            if os.path.exists(chunk_filename) and os.path.getsize(chunk_filename) > 0:
-                print(f"Chunk {overall_idx} already exists, skipping synthesis")
-                audio_files.append(chunk_filename)
-                continue
-
-            if not synthesize_chunk(generator, chunk, voice_preset_path, chunk_filename, device):
-                print("Warning: Failed to synthesize chunk {}. Skipping.".format(overall_idx))
-                continue # Skip this chunk
-
-            audio_files.append(chunk_filename)
-        
-        # Clean up GPU memory between batches
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-
-    if not audio_files:
-        print("Error: No audio chunks were successfully synthesized.")
-        return
-
-    end_time = time.time()
-    print("Audio synthesis complete in {:.2f} seconds.".format(end_time - start_time))
-
-    # --- Audio Concatenation ---
-    print("Combining audio chunks...")
-    combined_audio = AudioSegment.empty()
-    try:
-        for audio_file in tqdm(audio_files, desc="Combining Audio"):
-            if os.path.exists(audio_file) and os.path.getsize(audio_file) > 0:
-                try:
-                    segment = AudioSegment.from_wav(audio_file)
-                    combined_audio += segment
-                except Exception as combine_e:
-                     print("Warning: Could not process audio file {}: {}".format(audio_file, combine_e))
-            else:
-                print("Warning: Skipping missing or empty audio file: {}".format(audio_file))
-
-        if len(combined_audio) == 0:
-            print("Error: Combined audio is empty. Cannot export.")
-            return
-
-        # Export final audio file
-        output_format = os.path.splitext(args.output)[1].lower().strip('.') or 'mp3'
-        print("Exporting final audiobook to '{}' (format: {})...".format(args.output, output_format))
-        combined_audio.export(args.output, format=output_format)
-        print("Audiobook generation complete!")
-
-    except Exception as e:
-        print("Error during audio concatenation or export: {}".format(e))
-
-    # --- Cleanup (Optional) ---
-    if not args.keep_temp:
-        print("Cleaning up temporary files...")
-        for audio_file in audio_files:
-            try:
-                if os.path.exists(audio_file):
-                    os.remove(audio_file)
-            except Exception as e:
-                print("Warning: Could not remove temp file {}: {}".format(audio_file, e))
+    chapter_pipeline = Pipeline([
+        Stage("chunk", chunk),
+        Stage("synthesize", lambda job: synthesize_chapter(job, generator, args, voice_preset_path, device, governor, throughput, trace)),
+        Stage("encode", lambda job: publish(encode_chapter(job, generator, args))),
+    ], queue_size=args.queue_size, after_item=profiler.after_item if profiler else None)
+    chapter_pipeline.notes = notes
+    finished = dict(chapter_pipeline.run(chapters))
+    trace.close()
+    chapter_outputs = [finished[num] for num in sorted(finished)]
+    failed_chapters = [num for num in selected if num not in finished]
+
+    print("Audio synthesis complete in {:.2f} seconds.".format(time.time() - start_time))
+    print(f"Memory governor: {governor.summary()}")
+    throughput.save(governor.peak_rss_mb)
+    print("Throughput: {}".format(throughput.summary()))
+    chapter_pipeline.print_metrics()
+    METRICS.record_pipeline(chapter_pipeline.metrics())
+    if args.pipeline_metrics:
+        chapter_pipeline.write_metrics(args.pipeline_metrics)
+    if failed_chapters:
+        print("Warning: Chapters {} are incomplete; rerun to resume them.".format(failed_chapters))
+
+    # --- Book Assembly (Optional) ---
+    if args.output and chapter_outputs and not failed_chapters:
+        print("Combining {} chapters into '{}'...".format(len(chapter_outputs), args.output))
         try:
-            # Attempt to remove the temp directory if it's empty
-            if os.path.exists(temp_dir) and not os.listdir(temp_dir):
-                 os.rmdir(temp_dir)
+            with section(profiler, "combine"):
+                combine_chapters(chapter_outputs, args.output, [titles[num] for num in sorted(finished)],
+                                 args.input, args.audio_bitrate)
         except Exception as e:
-            print("Warning: Could not remove temp directory {}: {}".format(temp_dir, e))
-        print("Cleanup complete.")
+            print("Error during audio concatenation or export: {}".format(e))
+            metrics.export(args.metrics_json, args.metrics_prom)
+            return
+    metrics.export(args.metrics_json, args.metrics_prom)
+    print("Audiobook generation complete!")
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Generate an audiobook using Sesame CSM.")
     parser.add_argument("--input", required=True, help="Path to the input EPUB or PDF file.")
-    parser.add_argument("--output", required=True, help="Path to the output audio file (e.g., audiobook.mp3).")
-    parser.add_argument("--model_path", required=True, help="Path to the directory containing the downloaded Sesame model files (used by load_csm_1b).")
+    parser.add_argument("--output", default=None, help="Path to the combined output audio file (e.g., audiobook.mp3, or .m4b/.mka for one encoding pass with chapters and cover). If omitted, only per-chapter files are written.")
+    parser.add_argument("--output_dir", default=None, help="Directory for per-chapter audio files. Defaults to '<output>_chapters'.")
+    parser.add_argument("--output_format", default=None, help="Format of the per-chapter files (default: the --output extension, wav for .m4b/.mka, or mp3).")
+    parser.add_argument("--audio_bitrate", default="64k", help="Audio bitrate of an .m4b or .mka --output.")
+    parser.add_argument("--model_path", default=None, help="Path to the directory containing the downloaded Sesame model files (used by load_csm_1b; not needed with --fake_tts).")
     parser.add_argument("--voice_preset", default=None, help="Name of the voice preset to use (without extension, e.g., 'calm'). If omitted, uses default voice.")
     parser.add_argument("--chunk_length", type=int, default=500, help="Approximate maximum character length for text chunks (respects sentence boundaries).")
-    parser.add_argument("--temp_dir", default=None, help="Directory to store temporary audio chunks. Defaults to 'temp_audio_sesame' next to the output file.")
+    parser.add_argument("--temp_dir", default=None, help="Directory to store temporary audio chunks, one subdirectory per chapter. Defaults to 'temp_audio_sesame' in the output directory.")
     parser.add_argument("--keep_temp", action='store_true', help="Keep temporary audio chunk files after generation.")
-    parser.add_argument("--chapter_range", default=None, help="Range of chapters to process (e.g., '1-5')")
+    parser.add_argument("--chapter_range", default=None, help="Range of chapters to process (e.g., '1-5', or '3' for a single chapter)")
     parser.add_argument("--memory_per_chunk", type=int, default=150, help="Estimated memory usage per chunk in MB.")
-    parser.add_argument("--max_batch_size", type=int, default=8, help="Maximum number of chunks to process in a single batch.")
+    parser.add_argument("--max_batch_size", type=int, default=8, help="Maximum number of chunks to process between memory checks.")
+    parser.add_argument("--memory_budget", type=int, default=None, help="Host memory budget in MB for this job (default: 80%% of available memory).")
+    parser.add_argument("--watermark_mode", choices=["chunk", "stream"], default="chunk", help="Watermark each chunk as it is generated, or once over the assembled audio stream (implied by --stream).")
+    parser.add_argument("--queue_size", type=int, default=2, help="Chapters buffered between pipeline stages.")
+    parser.add_argument("--pipeline_metrics", default=None, help="Write per-stage pipeline metrics to this JSON file.")
+    parser.add_argument("--stream", action='store_true', help="Stream decoded audio frames into each chunk file as they are generated (chunks can be previewed while in progress).")
+    parser.add_argument("--priority_chapters", default=None, help="Comma-separated chapters to synthesize before all others (e.g. '5' or '1,5').")
+    parser.add_argument("--first_listen_minutes", type=float, default=None, help="Publish about the first N minutes of the book as a preview file before synthesizing the rest.")
+    parser.add_argument("--plan", action='store_true', help="Only predict wall time, disk usage and peak memory for the book from recorded throughput, without loading the model.")
+    parser.add_argument("--stats_file", default=None, help="Throughput statistics file (default: ~/.cache/audiobook/throughput.json).")
+    parser.add_argument("--metrics_json", default=None, help="Write per-stage timing counters and histograms to this JSON file.")
+    parser.add_argument("--metrics_prom", default=None, help="Write the same metrics as a Prometheus textfile (e.g. into node_exporter's textfile directory).")
+    parser.add_argument("--trace", default=None, help="Per-chunk JSONL trace file (default: trace.jsonl in the temp directory); analyze it with chunk_trace.py.")
+    parser.add_argument("--profile", action='store_true', help="Write per-stage CPU profiles, memory snapshots and torch profiler traces to a profile directory in the temp directory.")
+    fake_tts.add_arguments(parser)
+    parser.add_argument("--worker", action='store_true', help="Run as one of several workers (on this or other hosts) sharing --temp_dir and --output_dir.")
+    parser.add_argument("--worker_id", default=None, help="Worker identifier in lease files (default: host, pid and a random suffix).")
+    parser.add_argument("--lease_seconds", type=float, default=600, help="Seconds after which a chapter lease that is not renewed is taken over.")
+    parser.add_argument("--steal_after", type=float, default=None, help="Seconds after which idle workers start a backup copy of a chapter still in progress.")
 
     args = parser.parse_args()
-    main(args)
+    if output_format_error(args):
+        parser.error(output_format_error(args))
+    sys.exit(main(args))
@@ -2,7 +2,6 @@
 
 import os
 import sys
-import torch
 import argparse
 from tqdm import tqdm
 from pathlib import Path
@@ -14,6 +13,14 @@ from nltk.tokenize import sent_tokenize
 import nltk
 import re
 import time
+from memory_governor import MemoryGovernor
+from job_manifest import JobManifest, part_path
+from profiling import start_profiler, section
+from tts_backends import SesameBackend
+import fake_tts
+
+# Sample rate of the CSM model's audio, which the synthetic backend matches
+CSM_SAMPLE_RATE = 24000
 
 # Add /opt/csm to path to help find generator modules
 sys.path.insert(0, '/opt/csm')
@@ -70,15 +77,15 @@ def preprocess_text(text, max_chunk_size=1000):
     print(f"Split text into {len(chunks)} chunks")
     return chunks
 
-def generate_audio(model, text, output_path):
+def generate_audio(backend, text, output_path, governor):
     """Generate audio for a text segment."""
     try:
-        # Clear CUDA cache
-        torch.cuda.empty_cache()
+        # Release cached memory only when close to the budget
+        governor.release_if_needed()
         
-        # Generate audio
-        audio = model.generate(text=text)
-        audio.export(output_path, format="mp3")
+        # Generate audio; the backend returns 16-bit mono PCM
+        pcm = backend.synthesize(text)
+        AudioSegment(data=pcm, sample_width=2, frame_rate=backend.sample_rate, channels=1).export(output_path, format="mp3")
         return True
     except Exception as e:
         print(f"Error generating audio: {e}")
@@ -108,48 +115,66 @@ def main():
     parser.add_argument("--epub", required=True, help="Path to the EPUB file")
     parser.add_argument("--output_dir", default="audiobook_chapters_sesame", help="Output directory for chapter audio files")
     parser.add_argument("--chunk_size", type=int, default=1000, help="Maximum characters per chunk")
+    parser.add_argument("--profile", action='store_true', help="Write CPU profiles, memory snapshots and torch profiler traces to a profile directory in --output_dir")
+    fake_tts.add_arguments(parser)
     args = parser.parse_args()
 
     os.makedirs(args.output_dir, exist_ok=True)
+    profiler = start_profiler(args.profile, args.output_dir)
 
     # Extract chapters
     chapters = extract_chapters_from_epub(args.epub)
 
-    # Load CSM model
-    print("Loading Sesame CSM model...")
-    try:
+    # Load CSM model, unless the synthetic backend was selected with --fake_tts
+    backend = fake_tts.from_args(args, sample_rate=CSM_SAMPLE_RATE)
+    if backend is None:
+        print("Loading Sesame CSM model...")
         try:
-            from audiobook_generator import load_csm_1b, Segment
-            print("Using enhanced audiobook generator with error handling")
-        except ImportError:
-            from generator import load_csm_1b, Segment
-            print("Using original CSM generator")
-        model = load_csm_1b("/models/sesame-csm-1b", device="cuda")
-        model = model.half()
-    except Exception as e:
-        print(f"Error loading CSM model: {e}")
-        sys.exit(1)
+            try:
+                from audiobook_generator import load_csm_1b, Segment
+                print("Using enhanced audiobook generator with error handling")
+            except ImportError:
+                from generator import load_csm_1b, Segment
+                print("Using original CSM generator")
+            model = load_csm_1b("/models/sesame-csm-1b", device="cuda")
+            model = model.half()
+            if profiler:
+                profiler.wrap_generator(model)
+            backend = SesameBackend(model)
+        except Exception as e:
+            print(f"Error loading CSM model: {e}")
+            sys.exit(1)
+
+    governor = MemoryGovernor()
+    manifest = JobManifest(args.output_dir)
 
     # Generate audio for each chapter
     for idx, (title, chapter_text) in enumerate(chapters, 1):
         print(f"Processing chapter {idx}: {title}")
         # Split chapter into chunks
         chunks = preprocess_text(chapter_text, args.chunk_size)
+        chunk_keys = [f"chapter_{idx:02d}/{i:03d}" for i in range(len(chunks))]
+        manifest.plan(dict(zip(chunk_keys, chunks)))
         audio_files = []
         for i, chunk in enumerate(chunks):
             chunk_path = os.path.join(args.output_dir, f"chapter_{idx:02d}_chunk_{i:03d}.mp3")
-            if os.path.exists(chunk_path):
+            if manifest.is_done(chunk_keys[i]):
                 print(f"Skipping chunk {i} of chapter {idx} - already processed")
                 audio_files.append(chunk_path)
                 continue
-            success = generate_audio(model, chunk, chunk_path)
+            success = generate_audio(backend, chunk, part_path(chunk_path), governor)
             if success:
+                manifest.commit_output(chunk_keys[i], chunk, part_path(chunk_path), chunk_path)
                 audio_files.append(chunk_path)
         # Combine all chunk files for this chapter
-        chapter_output = os.path.join(args.output_dir, f"chapter_{idx:02d}_{re.sub(r'[^\w\s-]', '', title).strip().replace(' ', '_')}.mp3")
-        combine_audio_files(audio_files, chapter_output)
+        safe_title = re.sub(r'[^\w\s-]', '', title).strip().replace(' ', '_')
+        chapter_output = os.path.join(args.output_dir, f"chapter_{idx:02d}_{safe_title}.mp3")
+        with section(profiler, f"combine_chapter_{idx:02d}"):
+            combine_audio_files(audio_files, chapter_output)
         print(f"Chapter {idx} audio saved to {chapter_output}")
 
+    manifest.close()
+    print(f"Memory governor: {governor.summary()}")
     print("Per-chapter audiobook generation complete!")
 
 if __name__ == "__main__":
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""
+Job manifest for audiobook generation runs.
+
+The manifest records the chunk plan of a job and the outcome of every
+chunk: its status, output file, output digest and duration, and the
+sentence spans a chunk was split into when generation failed. A resumed
+run derives all remaining work from the manifest in one read instead of
+stat-ing every chunk file, and re-synthesizes only the spans that failed.
+
+Crash safety:
+
+- Updates are appended to ``journal.jsonl`` and fsync'd, so an update is
+  either fully recorded or (a torn last line) ignored on replay.
+- ``manifest.json`` is a snapshot written via atomic rename; on load the
+  journal is replayed over it and then folded into a new snapshot.
+- Chunk outputs are written to a ``.part`` path and only renamed into
+  place by ``commit_output``, after which the chunk is journaled as done.
+  A file killed mid-write is therefore never treated as complete.
+- ``commit_pcm`` appends a chunk's PCM to a chunk store (see chunk_store),
+  which fsyncs it and its index record, before journaling the chunk.
+"""
+
+import hashlib
+import json
+import os
+import re
+import threading
+
+from audio_io import wav_duration
+
+MANIFEST_NAME = "manifest.json"
+# Characters of a part_path tag replaced so it stays one file name
+UNSAFE_TAG_CHARS = r"[^\w.-]"
+JOURNAL_NAME = "journal.jsonl"
+
+# Chunk statuses
+PENDING = "pending"
+DONE = "done"
+PARTIAL = "partial"
+FAILED = "failed"
+
+
+def text_digest(text):
+    """Short digest identifying the text of a chunk in the plan."""
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
+
+
+def file_digest(path):
+    """SHA-256 of a file's contents."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def part_path(output_path, tag=None):
+    """
+    Return the in-progress path for an output, keeping its extension.
+
+    Writers that may produce the same output concurrently (e.g. a worker and
+    the backup copy of its chapter) pass their own tag, so each writes a
+    complete file of its own and the last rename into place wins.
+    """
+    root, ext = os.path.splitext(output_path)
+    if tag:
+        return f"{root}.part.{re.sub(UNSAFE_TAG_CHARS, '_', tag)}{ext}"
+    return f"{root}.part{ext}"
+
+
+class JobManifest:
+    """
+    Per-job chunk plan and outcomes, backed by a snapshot and an append-only journal.
+
+    Args:
+        job_dir (str): Directory of the manifest and journal.
+        guard (callable): Called before every write; raises to stop a writer that
+            no longer owns the job, e.g. work_leases.Lease.check.
+    """
+
+    def __init__(self, job_dir, guard=None):
+        self.job_dir = job_dir
+        self.guard = guard
+        self.path = os.path.join(job_dir, MANIFEST_NAME)
+        self.journal_path = os.path.join(job_dir, JOURNAL_NAME)
+        self.chunks = {}
+        self._lock = threading.Lock()
+
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                data = json.load(f)
+            self.chunks = data.get("chunks", {})
+        replayed, torn = self._replay_journal()
+        if replayed or torn:
+            # Fold the journal into a fresh snapshot so the next load is a single read; this
+            # also drops a torn line, which would otherwise swallow the next appended record
+            self.compact()
+        self._journal = open(self.journal_path, "a")
+
+    def _replay_journal(self):
+        """Apply the journal's records; return the number applied and whether a torn line was found."""
+        if not os.path.exists(self.journal_path):
+            return 0, False
+        count, torn = 0, False
+        with open(self.journal_path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                    key, entry = record["key"], record["entry"]
+                except (json.JSONDecodeError, KeyError, TypeError):
+                    # A torn write; records an older version appended after one are still read
+                    torn = True
+                    continue
+                self.chunks[key] = entry
+                count += 1
+        return count, torn
+
+    def _check(self):
+        if self.guard is not None:
+            self.guard()
+
+    def _append(self, key, entry):
+        self._append_all({key: entry})
+
+    def _append_all(self, entries):
+        """Journal entries with a single write and fsync."""
+        if not entries:
+            return
+        self._check()
+        with self._lock:
+            self.chunks.update(entries)
+            self._journal.write("".join(json.dumps({"key": key, "entry": entry}) + "\n"
+                                        for key, entry in entries.items()))
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+
+    def plan(self, texts):
+        """
+        Register the chunk plan as a mapping of chunk key to text.
+
+        Chunks whose text changed since the manifest was written (e.g. a
+        different chunk size) are reset to pending. The new entries are
+        journaled together, with one fsync for the whole plan.
+        """
+        pending = {}
+        for key, text in texts.items():
+            key = str(key)
+            entry = self.chunks.get(key)
+            digest = text_digest(text)
+            if entry is None or entry.get("text_digest") != digest:
+                pending[key] = {"status": PENDING, "chars": len(text), "text_digest": digest,
+                                "output": None, "digest": None, "duration": None, "spans": []}
+        self._append_all(pending)
+
+    def chunk(self, key):
+        """Return the manifest entry for a chunk, or None if it is not in the plan."""
+        return self.chunks.get(str(key))
+
+    def is_done(self, key):
+        entry = self.chunk(key)
+        return entry is not None and entry["status"] == DONE
+
+    def pending(self, keys=None):
+        """Return the keys that still need work, in plan order."""
+        keys = self.chunks.keys() if keys is None else [str(key) for key in keys]
+        return [key for key in keys if not self.is_done(key)]
+
+    def record_chunk(self, key, text, status, output=None, spans=None, digest=None, duration=None):
+        """Journal the outcome of a chunk."""
+        self._append(str(key), {
+            "status": status,
+            "chars": len(text),
+            "text_digest": text_digest(text),
+            "output": output,
+            "digest": digest,
+            "duration": duration,
+            "spans": spans or [],
+        })
+
+    def commit_output(self, key, text, tmp_path, output_path, spans=None):
+        """
+        Atomically move a finished output into place and journal the chunk as done.
+
+        The output is fsync'd before the rename, and the chunk is only
+        journaled after it, so a crash at any point leaves either the old
+        state or a complete, recorded output.
+        """
+        self._check()
+        with open(tmp_path, "rb") as f:
+            os.fsync(f.fileno())
+        digest = file_digest(tmp_path)
+        duration = wav_duration(tmp_path) if tmp_path.lower().endswith(".wav") else None
+        os.replace(tmp_path, output_path)
+        self.record_chunk(key, text, DONE, output=output_path, spans=spans, digest=digest, duration=duration)
+
+    def commit_pcm(self, key, text, store, chunk, pcm, sample_rate, spans=None):
+        """Append a finished chunk's 16-bit mono PCM to a chunk store and journal the chunk as done."""
+        self._check()
+        store.append(chunk, pcm, sample_rate)
+        self.record_chunk(key, text, DONE, output=store.locator(chunk), spans=spans,
+                          digest=hashlib.sha256(pcm).hexdigest(), duration=len(pcm) / (2 * sample_rate))
+
+    def failed_spans(self, key):
+        """Return the failed spans recorded for a chunk."""
+        entry = self.chunk(key)
+        if not entry:
+            return []
+        return [span for span in entry["spans"] if span["status"] == FAILED]
+
+    def summary(self):
+        """Return a count of chunks per status."""
+        counts = {}
+        for entry in self.chunks.values():
+            counts[entry["status"]] = counts.get(entry["status"], 0) + 1
+        return counts
+
+    def compact(self):
+        """Write a snapshot atomically and truncate the journal."""
+        self._check()
+        with self._lock:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({"chunks": self.chunks}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+            # The snapshot now holds everything in the journal
+            journal = getattr(self, "_journal", None)
+            if journal is not None:
+                journal.truncate(0)
+            else:
+                open(self.journal_path, "w").close()
+
+    def close(self):
+        """Compact the manifest and close the journal, which is closed even if the guard refuses the compaction."""
+        if self._journal.closed:
+            return
+        try:
+            self.compact()
+        finally:
+            self._journal.close()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Adaptive memory governor shared by the Piper and Sesame generator scripts.
+
+Instead of pausing for a fixed time after every batch or emptying the CUDA
+cache before every chunk, the governor samples process RSS (including
+child processes such as piper) and the torch allocator, then steers worker
+concurrency and batch size toward a configured memory budget. Caches are
+only released when usage is actually close to the budget.
+"""
+
+import gc
+import psutil
+
+# torch is only available in the Sesame container
+try:
+    import torch
+except ImportError:
+    torch = None
+
+MB = 1024 * 1024
+
+
+class MemoryGovernor:
+    """
+    Additive-increase / multiplicative-decrease controller for memory use.
+
+    Args:
+        budget_mb (int): Host memory budget for this process and its children.
+            Defaults to the current RSS plus 80% of available system memory.
+        per_item_mb (int): Estimated memory per in-flight chunk, used for the
+            initial batch size.
+        max_concurrency (int): Upper bound on concurrent workers.
+        max_batch_size (int): Upper bound on chunks between memory checks.
+        gpu_budget_mb (int): CUDA allocator budget. Defaults to 90% of the
+            device memory when CUDA is available.
+        high_water (float): Pressure above which concurrency and batch size
+            are halved and caches are released.
+        low_water (float): Pressure below which they are increased by one.
+    """
+
+    def __init__(self, budget_mb=None, per_item_mb=50, max_concurrency=1, max_batch_size=20,
+                 gpu_budget_mb=None, high_water=0.9, low_water=0.7):
+        self.process = psutil.Process()
+        if budget_mb is None:
+            budget_mb = (self.process.memory_info().rss + 0.8 * psutil.virtual_memory().available) / MB
+        self.budget_mb = budget_mb
+        if gpu_budget_mb is None and self.cuda_available:
+            gpu_budget_mb = 0.9 * torch.cuda.get_device_properties(0).total_memory / MB
+        self.gpu_budget_mb = gpu_budget_mb
+        self.high_water = high_water
+        self.low_water = low_water
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_batch_size = max(1, max_batch_size)
+
+        self.concurrency = 1
+        self.batch_size = max(1, min(self.max_batch_size, int(budget_mb / max(1, per_item_mb))))
+        self.last_sample = {}
+        self.peak_rss_mb = 0
+        self.releases = 0
+
+    @property
+    def cuda_available(self):
+        return torch is not None and torch.cuda.is_available()
+
+    def sample(self):
+        """Sample host and allocator memory usage and return it as a dict of MB values."""
+        rss = self.process.memory_info().rss
+        for child in self.process.children(recursive=True):
+            try:
+                rss += child.memory_info().rss
+            except psutil.Error:
+                pass  # child exited between listing and sampling
+        stats = {
+            "rss_mb": rss / MB,
+            "available_mb": psutil.virtual_memory().available / MB,
+            "cuda_allocated_mb": 0.0,
+            "cuda_reserved_mb": 0.0,
+        }
+        if self.cuda_available:
+            stats["cuda_allocated_mb"] = torch.cuda.memory_allocated() / MB
+            stats["cuda_reserved_mb"] = torch.cuda.memory_reserved() / MB
+        self.peak_rss_mb = max(self.peak_rss_mb, stats["rss_mb"])
+        self.last_sample = stats
+        return stats
+
+    def pressure(self, stats=None):
+        """Return memory use as a fraction of the tightest budget."""
+        stats = stats or self.sample()
+        pressure = stats["rss_mb"] / self.budget_mb
+        # The rest of the system may need memory even when we are under budget
+        if stats["available_mb"] < 0.1 * psutil.virtual_memory().total / MB:
+            pressure = max(pressure, self.high_water)
+        if self.gpu_budget_mb:
+            pressure = max(pressure, stats["cuda_allocated_mb"] / self.gpu_budget_mb)
+        return pressure
+
+    def update(self):
+        """
+        Sample memory, adjust concurrency and batch size, and release caches under pressure.
+
+        Call this between batches. Returns the measured pressure.
+        """
+        pressure = self.pressure(self.sample())
+        if pressure >= self.high_water:
+            self.concurrency = max(1, self.concurrency // 2)
+            self.batch_size = max(1, self.batch_size // 2)
+            self.release()
+        elif pressure < self.low_water:
+            self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+            self.batch_size = min(self.max_batch_size, self.batch_size + 1)
+        return pressure
+
+    def release_if_needed(self):
+        """Release caches only if usage is above the high-water mark."""
+        if self.pressure() >= self.high_water:
+            self.release()
+            return True
+        return False
+
+    def release(self):
+        """Collect garbage and return cached CUDA blocks to the driver."""
+        gc.collect()
+        if self.cuda_available:
+            torch.cuda.empty_cache()
+        self.releases += 1
+
+    def summary(self):
+        """Return a one-line description of the governor state."""
+        return ("memory budget {:.0f}MB, peak RSS {:.0f}MB, workers {}, batch size {}, cache releases {}"
+                .format(self.budget_mb, self.peak_rss_mb, self.concurrency, self.batch_size, self.releases))
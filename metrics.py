@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""
+Lightweight timing instrumentation shared by the generator scripts.
+
+Stages (text extraction, chunking, synthesis, concatenation, export) are
+wrapped with ``timed`` or ``METRICS.timer``, which record call counts,
+errors and a latency histogram per stage. Synthesis also records the
+audio seconds it produced, so the real-time factor (synthesis seconds per
+audio second) can be reported per backend.
+
+The registry is exported as a JSON summary and as a Prometheus textfile
+that node_exporter's textfile collector can scrape. Only the standard
+library is used.
+"""
+
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+PREFIX = "audiobook"
+# Histogram bucket upper bounds in seconds
+BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, str(value).replace('"', '\\"')) for name, value in pairs) + "}"
+
+
+class Histogram:
+    """Cumulative-bucket histogram of durations in seconds."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """Approximate a quantile as the upper bound of the bucket that contains it."""
+        if not self.count:
+            return None
+        target = q * self.count
+        for bound, count in zip(self.buckets, self.counts):
+            if count >= target:
+                return bound
+        return self.max
+
+
+class MetricsRegistry:
+    """Counters, gauges and histograms, each keyed by name and labels."""
+
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        with self._lock:
+            metric = self.counters.setdefault(name, {})
+            key = _label_key(labels)
+            metric[key] = metric.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self.gauges.setdefault(name, {})[_label_key(labels)] = value
+
+    def observe(self, name, value, **labels):
+        with self._lock:
+            metric = self.histograms.setdefault(name, {})
+            key = _label_key(labels)
+            if key not in metric:
+                metric[key] = Histogram()
+            metric[key].observe(value)
+
+    @contextmanager
+    def timer(self, stage, **labels):
+        """Time a block as one call of a stage; exceptions are counted and re-raised."""
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.inc("stage_errors_total", stage=stage, **labels)
+            raise
+        finally:
+            self.observe("stage_seconds", time.perf_counter() - start, stage=stage, **labels)
+
+    def record_synthesis(self, backend, seconds, audio_seconds, chars):
+        """Record one synthesized chunk for the real-time factor."""
+        self.inc("synthesis_seconds_total", seconds, backend=backend)
+        self.inc("synthesized_chars_total", chars, backend=backend)
+        if audio_seconds:
+            self.inc("audio_seconds_total", audio_seconds, backend=backend)
+
+    def record_pipeline(self, report):
+        """Record the per-stage report of a Pipeline run as gauges."""
+        self.set("pipeline_wall_seconds", report["wall_seconds"])
+        for stage in report["stages"]:
+            for field in ("utilization", "busy_seconds", "starved_seconds", "blocked_seconds", "max_input_queue"):
+                self.set(f"pipeline_{field}", stage[field], stage=stage["stage"])
+
+    def real_time_factors(self):
+        """Return synthesis seconds per audio second, per backend."""
+        with self._lock:
+            synthesis = dict(self.counters.get("synthesis_seconds_total", {}))
+            audio = dict(self.counters.get("audio_seconds_total", {}))
+        return {dict(key)["backend"]: synthesis[key] / audio[key] for key in synthesis if audio.get(key)}
+
+    def summary(self):
+        """Return all metrics as a JSON-serializable dict."""
+        def labelled(metric, render):
+            return [{"labels": dict(key), **render(value)} for key, value in metric.items()]
+
+        with self._lock:
+            report = {
+                "counters": {name: labelled(metric, lambda v: {"value": v}) for name, metric in self.counters.items()},
+                "gauges": {name: labelled(metric, lambda v: {"value": v}) for name, metric in self.gauges.items()},
+                "histograms": {name: labelled(metric, lambda h: {
+                    "count": h.count, "sum": round(h.sum, 4), "max": round(h.max, 4),
+                    "p50": h.quantile(0.5), "p95": h.quantile(0.95)}) for name, metric in self.histograms.items()},
+            }
+        report["real_time_factor"] = self.real_time_factors()
+        return report
+
+    def prometheus(self):
+        """Render all metrics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            for name, metric in sorted(self.counters.items()):
+                lines.append(f"# TYPE {PREFIX}_{name} counter")
+                lines.extend(f"{PREFIX}_{name}{_format_labels(key)} {value}" for key, value in metric.items())
+            for name, metric in sorted(self.gauges.items()):
+                lines.append(f"# TYPE {PREFIX}_{name} gauge")
+                lines.extend(f"{PREFIX}_{name}{_format_labels(key)} {value}" for key, value in metric.items())
+            for name, metric in sorted(self.histograms.items()):
+                lines.append(f"# TYPE {PREFIX}_{name} histogram")
+                for key, histogram in metric.items():
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        lines.append(f"{PREFIX}_{name}_bucket{_format_labels(key, [('le', bound)])} {count}")
+                    lines.append(f"{PREFIX}_{name}_bucket{_format_labels(key, [('le', '+Inf')])} {histogram.count}")
+                    lines.append(f"{PREFIX}_{name}_sum{_format_labels(key)} {histogram.sum}")
+                    lines.append(f"{PREFIX}_{name}_count{_format_labels(key)} {histogram.count}")
+        lines.append(f"# TYPE {PREFIX}_real_time_factor gauge")
+        for backend, factor in self.real_time_factors().items():
+            lines.append(f'{PREFIX}_real_time_factor{{backend="{backend}"}} {factor}')
+        return "\n".join(lines) + "\n"
+
+    def write_json(self, path):
+        """Write the JSON summary atomically."""
+        _write_atomic(path, json.dumps(self.summary(), indent=2))
+
+    def write_prometheus(self, path):
+        """Write a Prometheus textfile atomically, so the collector never reads a partial file."""
+        _write_atomic(path, self.prometheus())
+
+    def print_summary(self):
+        """Print per-stage call counts and latencies, slowest stage first."""
+        with self._lock:
+            stages = [(dict(key), h) for key, h in self.histograms.get("stage_seconds", {}).items()]
+        if not stages:
+            return
+        print(f"{'stage':<24} {'calls':>7} {'total s':>9} {'mean s':>8} {'max s':>8}")
+        for labels, h in sorted(stages, key=lambda item: -item[1].sum):
+            print(f"{labels['stage']:<24} {h.count:>7} {h.sum:>9.1f} {h.sum / h.count:>8.2f} {h.max:>8.2f}")
+        for backend, factor in self.real_time_factors().items():
+            print(f"Real-time factor ({backend}): {factor:.2f}")
+        self.print_caches()
+
+    def print_caches(self):
+        """Print the hit rate of each cache level and the time the caches saved."""
+        with self._lock:
+            hits = dict(self.counters.get("cache_hits_total", {}))
+            misses = dict(self.counters.get("cache_misses_total", {}))
+            saved = dict(self.counters.get("cache_seconds_saved_total", {}))
+        for key in sorted(set(hits) | set(misses)):
+            labels, lookups = dict(key), hits.get(key, 0) + misses.get(key, 0)
+            print(f"Cache {labels['cache']} ({labels['level']}): {hits.get(key, 0) / lookups:.1%} hits of {lookups} lookups")
+        for key, seconds in saved.items():
+            print(f"Cache {dict(key)['cache']}: about {seconds:.1f}s saved")
+
+
+def _write_atomic(path, text):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+# Registry shared by every module of a run
+METRICS = MetricsRegistry()
+
+
+def timed(stage):
+    """Decorator recording each call of a function as one call of stage."""
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with METRICS.timer(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def export(json_path=None, prometheus_path=None):
+    """Write the shared registry to the requested files and print its summary."""
+    METRICS.print_summary()
+    if json_path:
+        METRICS.write_json(json_path)
+    if prometheus_path:
+        METRICS.write_prometheus(prometheus_path)
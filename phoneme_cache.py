@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""
+Persistent word- and sentence-level phoneme cache for in-process Piper.
+
+A novel's vocabulary is small and heavily repeated, so most of the words,
+and many short sentences ("he said."), have been phonemized before. The
+cache keeps phonemes in a bounded in-memory LRU in front of an SQLite
+store that is shared by every book and process on the host
+(~/.cache/audiobook/phonemes.sqlite by default). Entries are keyed by the
+espeak voice (language) and the espeak version, so a different voice or
+an upgraded espeak never sees stale phonemes.
+
+In ``words`` mode a sentence that is not cached is assembled from the
+phonemes of its words, each phonemized once. espeak phonemizes English
+mostly word by word, but a few reductions depend on the next word; the
+``sentences`` mode phonemizes uncached sentences whole and reproduces
+espeak's output exactly.
+
+Hits, misses and the phonemization time they saved are recorded in the
+shared metrics and printed in the run summary.
+"""
+
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import METRICS
+
+PHONEME_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "audiobook", "phonemes.sqlite")
+# Sentences end at terminal punctuation followed by whitespace, as espeak splits them
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+# New entries written to the store per transaction
+FLUSH_EVERY = 500
+
+
+class PhonemeCache:
+    """
+    Phonemes of words and sentences for one espeak voice and version.
+
+    Args:
+        phonemize (callable): Phonemizes text into a list of phoneme lists, one per sentence.
+        language (str): espeak voice the phonemes are for.
+        espeak_version (str): Version of espeak producing them.
+        path (str): SQLite store shared across books; None keeps the cache in memory only.
+        max_entries (int): Entries kept in memory.
+        words (bool): Assemble uncached sentences from cached words, which is faster but
+            not always what espeak says (see the module docstring).
+    """
+
+    def __init__(self, phonemize, language, espeak_version, path=PHONEME_CACHE_PATH, max_entries=200_000, words=False):
+        self._phonemize = phonemize
+        self.language = language
+        self.espeak_version = espeak_version
+        self.max_entries = max(1, max_entries)
+        self.words = words
+        self.sentence_level = "sentence_words" if words else "sentence"
+        self._memory = OrderedDict()
+        self._pending = []
+        self.stats = {}
+        self._lock = threading.RLock()
+        self._db = None
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            # One connection shared by the worker threads under the lock; other processes use their own
+            self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS phonemes (language TEXT, espeak TEXT, level TEXT, text TEXT, "
+                             "phonemes TEXT, PRIMARY KEY (language, espeak, level, text))")
+            self._db.commit()
+
+    def _record(self, level, result, seconds=0.0):
+        with self._lock:
+            entry = self.stats.setdefault(level, {"hits": 0, "misses": 0, "miss_seconds": 0.0, "saved_seconds": 0.0})
+            entry[result] += 1
+            entry["miss_seconds"] += seconds
+            # Counted as hits happen, so metrics exported before close() include it
+            saved = entry["miss_seconds"] / entry["misses"] if result == "hits" and entry["misses"] else 0.0
+            entry["saved_seconds"] += saved
+        METRICS.inc(f"cache_{result}_total", cache="phonemes", level=level)
+        if saved:
+            METRICS.inc("cache_seconds_saved_total", saved, cache="phonemes")
+
+    def _get(self, level, text):
+        key = (level, text)
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+            if self._db is None:
+                return None
+            row = self._db.execute("SELECT phonemes FROM phonemes WHERE language=? AND espeak=? AND level=? AND text=?",
+                                   (self.language, self.espeak_version, level, text)).fetchone()
+            if row is None:
+                return None
+            phonemes = json.loads(row[0])
+            self._remember(key, phonemes)
+            return phonemes
+
+    def _remember(self, key, phonemes):
+        self._memory[key] = phonemes
+        if len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _put(self, level, text, phonemes):
+        with self._lock:
+            self._remember((level, text), phonemes)
+            if self._db is None:
+                return
+            self._pending.append((self.language, self.espeak_version, level, text, json.dumps(phonemes)))
+            if len(self._pending) >= FLUSH_EVERY:
+                self.flush()
+
+    def _lookup(self, level, text, compute):
+        phonemes = self._get(level, text)
+        if phonemes is not None:
+            self._record(level, "hits")
+            return phonemes
+        start = time.perf_counter()
+        phonemes = compute(text)
+        self._record(level, "misses", time.perf_counter() - start)
+        self._put(level, text, phonemes)
+        return phonemes
+
+    def _espeak(self, text):
+        # espeak may split further than SENTENCE_END; its sentences are joined by a pause
+        phonemes = []
+        for sentence in self._phonemize(text):
+            if phonemes:
+                phonemes.append(" ")
+            phonemes.extend(sentence)
+        return phonemes
+
+    def _from_words(self, sentence):
+        phonemes = []
+        for word in sentence.split():
+            if phonemes:
+                phonemes.append(" ")
+            phonemes.extend(self._lookup("word", word, self._espeak))
+        return phonemes
+
+    def phonemize(self, text):
+        """Return the phonemes of each sentence of text."""
+        compute = self._from_words if self.words else self._espeak
+        return [self._lookup(self.sentence_level, sentence, compute)
+                for sentence in SENTENCE_END.split(text.strip()) if sentence]
+
+    def seconds_saved(self):
+        """Estimate the phonemization time saved: each hit saved the mean time of the misses at its level so far."""
+        with self._lock:
+            return sum(entry["saved_seconds"] for entry in self.stats.values())
+
+    def summary(self):
+        parts = []
+        for level, entry in sorted(self.stats.items()):
+            lookups = entry["hits"] + entry["misses"]
+            parts.append(f"{level} {entry['hits'] / lookups:.0%} of {lookups}")
+        return f"hit rate {', '.join(parts) or 'n/a'}; about {self.seconds_saved():.1f}s of phonemization saved"
+
+    def flush(self):
+        """Write new entries to the shared store."""
+        with self._lock:
+            if self._db is None or not self._pending:
+                return
+            self._db.executemany("INSERT OR IGNORE INTO phonemes VALUES (?, ?, ?, ?, ?)", self._pending)
+            self._db.commit()
+            self._pending = []
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
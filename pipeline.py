@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""
+Thread-based staged pipeline with bounded queues.
+
+The generator scripts used to run strictly in phases (extract everything,
+chunk everything, synthesize everything, then combine). Here each stage
+runs in its own worker threads and hands items to the next stage through
+a bounded queue, so the encoder works on chapter N while chapter N+1 is
+synthesized and chapter N+2 is extracted. The bounded queues keep at most
+a few chapters in flight between any two stages.
+
+Per-stage metrics (busy time, time starved for input, time blocked on a
+full output queue, and queue occupancy) show which stage is the
+bottleneck. The time until the last stage produced its first output
+(e.g. the first playable chapter) is reported as well.
+"""
+
+import json
+import queue
+import threading
+import time
+import traceback
+
+_DONE = object()
+
+
+def prioritized(items, first, key=lambda item: item[0]):
+    """
+    Yield the items whose key is in first ahead of the others, in the order of first.
+
+    Items are read lazily; the ones that come before a prioritized item are
+    held back only until every prioritized key has been seen.
+    """
+    order = list(first)
+    found = {}
+    held = []
+    for item in items:
+        if key(item) in order:
+            found[key(item)] = item
+            while order and order[0] in found:
+                yield found.pop(order.pop(0))
+        elif order:
+            held.append(item)
+        else:
+            yield item
+        if not order and held:
+            yield from held
+            held = []
+    # Prioritized keys that never appeared do not hold back the rest
+    yield from (found[k] for k in order if k in found)
+    yield from held
+
+
+class StageMetrics:
+    """Timing and occupancy counters for one pipeline stage."""
+
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = workers
+        self.items = 0
+        self.dropped = 0
+        self.errors = 0
+        self.busy_seconds = 0.0
+        self.starved_seconds = 0.0
+        self.blocked_seconds = 0.0
+        self.queue_samples = 0
+        self.queue_total = 0
+        self.queue_max = 0
+        self._lock = threading.Lock()
+
+    def add(self, **deltas):
+        with self._lock:
+            for key, value in deltas.items():
+                setattr(self, key, getattr(self, key) + value)
+
+    def sample_queue(self, size):
+        with self._lock:
+            self.queue_samples += 1
+            self.queue_total += size
+            self.queue_max = max(self.queue_max, size)
+
+    def as_dict(self, wall_seconds):
+        capacity = max(1e-9, wall_seconds * self.workers)
+        return {
+            "stage": self.name,
+            "workers": self.workers,
+            "items": self.items,
+            "dropped": self.dropped,
+            "errors": self.errors,
+            "busy_seconds": round(self.busy_seconds, 3),
+            "starved_seconds": round(self.starved_seconds, 3),
+            "blocked_seconds": round(self.blocked_seconds, 3),
+            "utilization": round(self.busy_seconds / capacity, 3),
+            "avg_input_queue": round(self.queue_total / self.queue_samples, 2) if self.queue_samples else 0.0,
+            "max_input_queue": self.queue_max,
+        }
+
+
+class Stage:
+    """
+    A pipeline stage.
+
+    Args:
+        name (str): Stage name used in metrics and log messages.
+        func (callable): Called with each input item. Its return value is
+            passed to the next stage; returning None drops the item.
+        workers (int): Number of threads running func concurrently.
+    """
+
+    def __init__(self, name, func, workers=1):
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+        self.metrics = StageMetrics(name, self.workers)
+
+
+class Pipeline:
+    """
+    Run items through a sequence of stages connected by bounded queues.
+
+    Args:
+        stages (list): Stage objects, in order.
+        queue_size (int): Capacity of the queue in front of each stage.
+        sample_interval (float): Seconds between queue occupancy samples.
+        after_item (callable): Called as after_item(stage name, seconds) each
+            time a stage finishes an item, e.g. to profile stage boundaries.
+    """
+
+    def __init__(self, stages, queue_size=2, sample_interval=0.5, after_item=None):
+        self.stages = stages
+        self.after_item = after_item
+        self.queue_size = max(1, queue_size)
+        self.sample_interval = sample_interval
+        self.wall_seconds = 0.0
+        self.first_output_seconds = None
+        self.notes = {}
+
+    def run(self, items):
+        """
+        Feed items through all stages and return the outputs of the last stage.
+
+        An exception raised while iterating items stops the input; the items
+        already fed are finished and the exception is then re-raised.
+        """
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        # The last stage's outputs are collected without bound
+        queues.append(queue.Queue())
+        results = []
+        stop_sampling = threading.Event()
+        start = time.perf_counter()
+
+        def put(q, item, metrics):
+            t0 = time.perf_counter()
+            q.put(item)
+            if metrics is not None:
+                metrics.add(blocked_seconds=time.perf_counter() - t0)
+
+        feed_error = []
+
+        def feed():
+            # The stages are always told the input ended, even if reading it failed
+            try:
+                for item in items:
+                    put(queues[0], item, None)
+            except BaseException as e:
+                feed_error.append(e)
+            finally:
+                for _ in range(self.stages[0].workers):
+                    queues[0].put(_DONE)
+
+        def work(index, stage, finished):
+            in_q, out_q = queues[index], queues[index + 1]
+            metrics = stage.metrics
+            while True:
+                t0 = time.perf_counter()
+                item = in_q.get()
+                metrics.add(starved_seconds=time.perf_counter() - t0)
+                if item is _DONE:
+                    break
+                t0 = time.perf_counter()
+                try:
+                    output = stage.func(item)
+                except Exception as e:
+                    print(f"Error in pipeline stage '{stage.name}': {e}")
+                    traceback.print_exc()
+                    metrics.add(errors=1)
+                    output = None
+                busy = time.perf_counter() - t0
+                metrics.add(busy_seconds=busy, items=1)
+                if self.after_item is not None:
+                    self.after_item(stage.name, busy)
+                if output is None:
+                    metrics.add(dropped=1)
+                    continue
+                put(out_q, output, metrics)
+            # The last worker of a stage to finish tells the next stage
+            with finished["lock"]:
+                finished["count"] += 1
+                last = finished["count"] == stage.workers
+            if last:
+                next_workers = self.stages[index + 1].workers if index + 1 < len(self.stages) else 1
+                for _ in range(next_workers):
+                    out_q.put(_DONE)
+
+        def sample():
+            while not stop_sampling.wait(self.sample_interval):
+                for stage, q in zip(self.stages, queues):
+                    stage.metrics.sample_queue(q.qsize())
+
+        threads = [threading.Thread(target=feed, name="pipeline-feed", daemon=True),
+                   threading.Thread(target=sample, name="pipeline-sampler", daemon=True)]
+        for index, stage in enumerate(self.stages):
+            finished = {"count": 0, "lock": threading.Lock()}
+            for n in range(stage.workers):
+                threads.append(threading.Thread(target=work, args=(index, stage, finished),
+                                                name=f"pipeline-{stage.name}-{n}", daemon=True))
+        for thread in threads:
+            thread.start()
+
+        while True:
+            item = queues[-1].get()
+            if item is _DONE:
+                break
+            if self.first_output_seconds is None:
+                self.first_output_seconds = time.perf_counter() - start
+            results.append(item)
+
+        stop_sampling.set()
+        for thread in threads:
+            thread.join()
+        self.wall_seconds = time.perf_counter() - start
+        if feed_error:
+            raise feed_error[0]
+        return results
+
+    def metrics(self):
+        """Return per-stage metrics for the last run, plus the likely bottleneck."""
+        stages = [stage.metrics.as_dict(self.wall_seconds) for stage in self.stages]
+        bottleneck = max(stages, key=lambda m: m["utilization"])["stage"] if stages else None
+        first_output = round(self.first_output_seconds, 3) if self.first_output_seconds is not None else None
+        return {"wall_seconds": round(self.wall_seconds, 3), "first_output_seconds": first_output,
+                "bottleneck": bottleneck, "stages": stages, **self.notes}
+
+    def print_metrics(self):
+        """Print a per-stage occupancy table."""
+        report = self.metrics()
+        print(f"Pipeline finished in {report['wall_seconds']:.1f}s; bottleneck stage: {report['bottleneck']}")
+        if report["first_output_seconds"] is not None:
+            print(f"First output after {report['first_output_seconds']:.1f}s")
+        print(f"{'stage':<12} {'items':>6} {'util':>6} {'busy s':>9} {'starved s':>10} {'blocked s':>10} {'avg q':>6} {'max q':>6}")
+        for m in report["stages"]:
+            print(f"{m['stage']:<12} {m['items']:>6} {m['utilization']:>6.0%} {m['busy_seconds']:>9.1f} "
+                  f"{m['starved_seconds']:>10.1f} {m['blocked_seconds']:>10.1f} {m['avg_input_queue']:>6.2f} {m['max_input_queue']:>6}")
+
+    def write_metrics(self, path):
+        """Write the metrics of the last run as JSON."""
+        with open(path, "w") as f:
+            json.dump(self.metrics(), f, indent=2)
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+Built-in profiling for the generator scripts (``--profile``).
+
+Everything is written to a ``profile`` directory in the job directory:
+
+- ``cpu_<stage>.folded``: sampled CPU stacks per pipeline stage, in the
+  collapsed-stack format read by speedscope (https://speedscope.app) and
+  flamegraph.pl. Samples are attributed to stages by thread name, so the
+  sampler adds no code to the stages themselves.
+- ``memory_<n>_<label>.txt`` and ``.tracemalloc``: tracemalloc snapshots
+  taken at stage boundaries. The text file lists the allocation sites that
+  grew most since the previous snapshot; the binary dump loads with
+  ``tracemalloc.Snapshot.load``.
+- ``torch_<label>_<n>.json``: torch profiler traces around the first calls
+  of the model's generate methods, viewable in Perfetto or
+  chrome://tracing.
+"""
+
+import atexit
+import os
+import re
+import sys
+import threading
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+# Stack depth recorded per allocation; enough to see who grows an AudioSegment
+TRACEMALLOC_FRAMES = 10
+# Innermost frames of threads that are idle, waiting for work
+IDLE_FRAMES = ("(queue.py:", "_worker (thread.py:", "wait (threading.py:", "_wait_for_tstate_lock (threading.py:")
+
+
+def stage_of_thread(name):
+    """Map a thread name to the pipeline stage it works for."""
+    if name.startswith("pipeline-"):
+        return name.split("-")[1]
+    if name == "MainThread":
+        return "main"
+    return re.sub(r"[-_]?\d+$", "", name) or "other"
+
+
+class Profiler:
+    """
+    Sampling CPU profiler, tracemalloc snapshots and torch profiler traces.
+
+    Args:
+        out_dir (str): Directory the profiles are written to.
+        interval (float): Seconds between CPU stack samples.
+        torch_traces (int): Number of generate calls traced with the torch profiler.
+    """
+
+    def __init__(self, out_dir, interval=0.01, torch_traces=3):
+        self.out_dir = out_dir
+        self.interval = interval
+        self.torch_traces = torch_traces
+        self.stacks = {}
+        self.samples = 0
+        self._snapshots = 0
+        self._previous = None
+        self._traced = {}
+        self._tracing = threading.local()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = None
+
+    def start(self):
+        os.makedirs(self.out_dir, exist_ok=True)
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+        self._sampler = threading.Thread(target=self._sample, name="profiler", daemon=True)
+        self._sampler.start()
+        print(f"Profiling to {self.out_dir}")
+        return self
+
+    def _sample(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                if any(marker in name for name in stack[:2] for marker in IDLE_FRAMES):
+                    continue
+                key = (stage_of_thread(names.get(ident, "other")), ";".join(reversed(stack)))
+                with self._lock:
+                    self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+
+    def snapshot(self, label):
+        """Take a tracemalloc snapshot and write it with the sites that grew since the last one."""
+        if not tracemalloc.is_tracing():
+            return
+        with self._lock:
+            self._snapshots += 1
+            index, previous = self._snapshots, self._previous
+            snapshot = tracemalloc.take_snapshot().filter_traces([
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            ])
+            self._previous = snapshot
+        safe_label = re.sub(r"[^\w-]", "_", label)
+        base = os.path.join(self.out_dir, f"memory_{index:04d}_{safe_label}")
+        snapshot.dump(base + ".tracemalloc")
+        current, peak = tracemalloc.get_traced_memory()
+        with open(base + ".txt", "w") as f:
+            f.write(f"{label}: traced {current / 1e6:.1f}MB, peak {peak / 1e6:.1f}MB\n\n")
+            if previous is not None:
+                f.write("Largest growth since the previous snapshot:\n")
+                for stat in snapshot.compare_to(previous, "traceback")[:15]:
+                    f.write(f"{stat.size_diff / 1e6:+.2f}MB ({stat.size / 1e6:.2f}MB total)\n")
+                    f.write("\n".join(f"    {line}" for line in stat.traceback.format()) + "\n")
+            f.write("\nLargest allocation sites:\n")
+            for stat in snapshot.statistics("lineno")[:15]:
+                f.write(f"{stat}\n")
+
+    def after_item(self, stage, seconds):
+        """Pipeline hook: snapshot memory each time a stage finishes an item."""
+        self.snapshot(f"after_{stage}")
+
+    @contextmanager
+    def section(self, label):
+        """Snapshot memory before and after a block, e.g. the final concatenation."""
+        self.snapshot(f"before_{label}")
+        try:
+            yield
+        finally:
+            self.snapshot(f"after_{label}")
+
+    @contextmanager
+    def torch_trace(self, label):
+        """Trace a block with the torch profiler, for the first torch_traces blocks of each label."""
+        if getattr(self._tracing, "active", False):
+            # Already inside a traced call (generate calls generate_spans)
+            yield
+            return
+        with self._lock:
+            count = self._traced.get(label, 0)
+            self._traced[label] = count + 1
+        if count >= self.torch_traces:
+            yield
+            return
+        try:
+            import torch
+            from torch.profiler import profile, ProfilerActivity
+        except ImportError:
+            yield
+            return
+        activities = [ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(ProfilerActivity.CUDA)
+        self._tracing.active = True
+        try:
+            with profile(activities=activities, record_shapes=True, profile_memory=True) as prof:
+                yield
+        finally:
+            self._tracing.active = False
+        prof.export_chrome_trace(os.path.join(self.out_dir, f"torch_{label}_{count + 1}.json"))
+
+    def wrap_generator(self, generator):
+        """Run the generator's generate methods under the torch profiler."""
+        for name in ("generate", "generate_spans"):
+            method = getattr(generator, name, None)
+            if method is None:
+                continue
+
+            def traced(*args, _method=method, _name=name, **kwargs):
+                with self.torch_trace(_name):
+                    return _method(*args, **kwargs)
+            setattr(generator, name, traced)
+        return generator
+
+    def stop(self):
+        """Stop sampling and write the CPU profiles per stage."""
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+        self.snapshot("end")
+        tracemalloc.stop()
+        by_stage = {}
+        for (stage, stack), count in self.stacks.items():
+            by_stage.setdefault(stage, []).append((stack, count))
+        for stage, stacks in by_stage.items():
+            with open(os.path.join(self.out_dir, f"cpu_{stage}.folded"), "w") as f:
+                for stack, count in sorted(stacks, key=lambda item: -item[1]):
+                    f.write(f"{stack} {count}\n")
+        print(f"Profiles written to {self.out_dir} ({self.samples} CPU samples, {self._snapshots} memory snapshots)")
+
+
+def start_profiler(enabled, job_dir, **kwargs):
+    """
+    Start a Profiler writing to job_dir/profile, or return None when profiling is off.
+
+    The profiles are written when the process exits, however the script ends.
+    """
+    if not enabled:
+        return None
+    profiler = Profiler(os.path.join(job_dir, "profile"), **kwargs).start()
+    atexit.register(profiler.stop)
+    return profiler
+
+
+def section(profiler, label):
+    """Profiler.section, or a no-op when profiling is off."""
+    return profiler.section(label) if profiler else nullcontext()
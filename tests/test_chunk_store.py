@@ -0,0 +1,60 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from chunk_store import ChunkStore, PcmReader, RECORD, parse_locator, store_path
+
+
+def test_appended_chunks_are_found_after_reopening(tmp_path):
+    path = store_path(str(tmp_path), 1)
+    store = ChunkStore(path)
+    store.append(0, b"\x01\x00" * 10, 22050)
+    store.append(1, b"\x02\x00" * 20, 22050)
+    store.append(0, b"\x03\x00" * 5, 22050)  # re-rendered: the newest version wins
+    store.close()
+
+    reopened = ChunkStore(path)
+    assert 0 in reopened and 1 in reopened and 2 not in reopened
+    assert bytes(reopened.read(0)) == b"\x03\x00" * 5
+    assert bytes(reopened.read(1)) == b"\x02\x00" * 20
+    assert reopened.format(1) == (22050, 1, 20)
+    reopened.close()
+
+
+def test_truncated_tail_record_is_ignored_and_dropped_on_append(tmp_path):
+    path = store_path(str(tmp_path), 1)
+    store = ChunkStore(path)
+    store.append(0, b"\x01\x00" * 10, 22050)
+    store.append(1, b"\x02\x00" * 10, 22050)
+    store.close()
+    # A writer killed mid-record leaves part of the last index record
+    with open(path + ".idx", "r+b") as f:
+        f.truncate(os.path.getsize(path + ".idx") - RECORD.size // 2)
+
+    reopened = ChunkStore(path)
+    assert 0 in reopened and 1 not in reopened
+    reopened.append(1, b"\x04\x00" * 10, 22050)
+    reopened.append(2, b"\x05\x00" * 10, 22050)
+    reopened.close()
+
+    again = ChunkStore(path)
+    assert sorted(again.entries) == [0, 1, 2]
+    assert bytes(again.read(1)) == b"\x04\x00" * 10
+    assert bytes(again.read(2)) == b"\x05\x00" * 10
+    again.close()
+
+
+def test_locator_round_trip(tmp_path):
+    path = store_path(str(tmp_path), 3)
+    store = ChunkStore(path)
+    store.append(7, b"\x06\x00" * 8, 24000)
+    locator = store.locator(7)
+    store.close()
+
+    assert parse_locator(locator) == (path, 7)
+    assert parse_locator(str(tmp_path / "chunk_0007.wav")) is None
+    reader = PcmReader()
+    assert reader.format(locator) == (24000, 1, 8)
+    assert b"".join(bytes(block) for block in reader.blocks(locator)) == b"\x06\x00" * 8
+    reader.close()
@@ -0,0 +1,71 @@
+"""Two local Piper workers sharing a job directory, one of them a straggler that gets backed up."""
+
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def _missing_requirements():
+    if shutil.which("ffmpeg") is None:
+        return "ffmpeg is not installed"
+    try:
+        import nltk
+        nltk.data.find("tokenizers/punkt")
+    except (ImportError, LookupError):
+        return "nltk punkt data is not installed"
+    return None
+
+
+pytestmark = pytest.mark.skipif(_missing_requirements() is not None, reason=str(_missing_requirements()))
+
+
+def _worker(tmp_path, name, *options):
+    log = open(tmp_path / f"{name}.log", "w")
+    command = [sys.executable, os.path.join(ROOT, "generate_audiobook_piper.py"),
+               "--input", str(tmp_path / "book.epub"), "--output", "", "--fake_tts",
+               "--temp_dir", str(tmp_path / "temp"), "--output_dir", str(tmp_path / "chapters"),
+               "--stats_file", str(tmp_path / "throughput.json"), "--worker", "--worker_id", name,
+               "--encode_workers", "0", *options]
+    return subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT), log
+
+
+def test_backup_of_straggler_publishes_complete_chapters(tmp_path):
+    from benchmark import make_epub
+
+    make_epub(str(tmp_path / "book.epub"), chapters=3, paragraphs=3, seed=1)
+    # The straggler claims the first chapter and synthesizes it slowly
+    straggler, straggler_log = _worker(tmp_path, "straggler", "--fake_latency", "10")
+    lease_path = tmp_path / "temp" / "leases" / "chapter_01.lease"
+    deadline = time.time() + 60
+    while not lease_path.exists() and time.time() < deadline:
+        time.sleep(0.1)
+    assert lease_path.exists()
+    fast, fast_log = _worker(tmp_path, "fast", "--steal_after", "1")
+
+    try:
+        assert fast.wait(timeout=300) == 0
+        assert straggler.wait(timeout=300) == 0
+    finally:
+        for process, log in ((fast, fast_log), (straggler, straggler_log)):
+            if process.poll() is None:
+                process.kill()
+            log.close()
+
+    assert "Backing up straggler chapter_01" in (tmp_path / "fast.log").read_text()
+    for num in (1, 2, 3):
+        assert (tmp_path / "temp" / "leases" / f"chapter_{num:02d}.done").exists()
+    names = os.listdir(tmp_path / "chapters")
+    assert not [name for name in names if ".part" in name]
+    chapters = sorted(name for name in names if name.startswith("chapter_") and name.endswith(".mp3"))
+    assert len(chapters) == 3
+    for name in chapters:
+        with open(tmp_path / "chapters" / name, "rb") as f:
+            head = f.read(3)
+        assert head == b"ID3" or head[0] == 0xFF
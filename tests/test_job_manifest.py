@@ -0,0 +1,46 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from job_manifest import JobManifest, DONE, JOURNAL_NAME, PENDING
+
+
+def test_torn_first_journal_line_does_not_lose_later_records(tmp_path):
+    with open(tmp_path / JOURNAL_NAME, "w") as f:
+        f.write('{"key": "a", "ent')  # killed mid-write
+    manifest = JobManifest(str(tmp_path))
+    manifest.plan({"a": "first", "b": "second"})
+    manifest.record_chunk("a", "first", DONE)
+    manifest.record_chunk("b", "second", DONE)
+    manifest._journal.close()  # crash: no compaction on close
+
+    assert JobManifest(str(tmp_path)).summary() == {DONE: 2}
+
+
+def test_torn_last_line_is_ignored(tmp_path):
+    manifest = JobManifest(str(tmp_path))
+    manifest.plan({"a": "first"})
+    manifest.record_chunk("a", "first", DONE)
+    manifest._journal.write('{"key": "a", "entry": {"sta')
+    manifest._journal.close()
+
+    reloaded = JobManifest(str(tmp_path))
+    assert reloaded.is_done("a")
+    reloaded.record_chunk("a", "first", DONE)
+    reloaded._journal.close()
+    assert JobManifest(str(tmp_path)).is_done("a")
+
+
+def test_plan_is_journaled_with_one_fsync(tmp_path, monkeypatch):
+    manifest = JobManifest(str(tmp_path))
+    fsyncs = []
+    real_fsync = os.fsync
+    monkeypatch.setattr(os, "fsync", lambda fd: (fsyncs.append(fd), real_fsync(fd)))
+    manifest.plan({f"{i:04d}": f"chunk {i}" for i in range(1000)})
+    assert len(fsyncs) == 1
+    manifest._journal.close()  # crash: no compaction on close
+
+    reloaded = JobManifest(str(tmp_path))
+    assert reloaded.summary() == {PENDING: 1000}
+    assert reloaded.chunk("0999")["chars"] == len("chunk 999")
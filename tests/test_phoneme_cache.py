@@ -0,0 +1,30 @@
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from metrics import METRICS
+from phoneme_cache import PhonemeCache
+
+
+def _saved_total():
+    return sum(METRICS.counters.get("cache_seconds_saved_total", {}).values())
+
+
+def test_saved_time_is_counted_before_close():
+    def phonemize(text):
+        time.sleep(0.01)
+        return [list(text)]
+
+    cache = PhonemeCache(phonemize, "en-us", "test", path=None)
+    before = _saved_total()
+    cache.phonemize("He said. He said.")
+    assert cache.stats["sentence"]["hits"] == 1
+    # Exported metrics (e.g. by a worker before its backend is closed) already include the hit
+    assert cache.seconds_saved() > 0
+    assert _saved_total() - before == pytest.approx(cache.seconds_saved())
+    cache.close()
+    assert _saved_total() - before == pytest.approx(cache.seconds_saved())
@@ -0,0 +1,27 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pipeline import Pipeline, Stage
+
+
+def test_run_returns_outputs_of_last_stage():
+    pipeline = Pipeline([Stage("double", lambda x: x * 2), Stage("inc", lambda x: x + 1, workers=2)])
+    assert sorted(pipeline.run(range(5))) == [1, 3, 5, 7, 9]
+
+
+def test_raising_input_iterator_is_reraised_after_fed_items_finish():
+    processed = []
+
+    def items():
+        yield 1
+        yield 2
+        raise ValueError("malformed book")
+
+    pipeline = Pipeline([Stage("record", processed.append), Stage("noop", lambda x: x, workers=2)])
+    with pytest.raises(ValueError, match="malformed book"):
+        pipeline.run(items())
+    assert processed == [1, 2]
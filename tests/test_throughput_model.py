@@ -0,0 +1,35 @@
+"""Throughput statistics saved by several processes at once."""
+
+import json
+import multiprocessing
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from throughput_model import ThroughputModel  # noqa: E402
+
+
+def _save_run(path, start):
+    model = ThroughputModel("fake", "tone", path)
+    model.observe(100, 1.0)
+    start.wait()
+    model.save()
+
+
+def test_concurrent_saves_all_count(tmp_path):
+    path = str(tmp_path / "throughput.json")
+    context = multiprocessing.get_context("spawn")
+    start = context.Event()
+    processes = [context.Process(target=_save_run, args=(path, start)) for _ in range(8)]
+    for process in processes:
+        process.start()
+    start.set()
+    for process in processes:
+        process.join(timeout=60)
+        assert process.exitcode == 0
+
+    with open(path) as f:
+        entry = next(iter(json.load(f)["entries"].values()))
+    assert entry["runs"] == 8
@@ -0,0 +1,54 @@
+import json
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from job_manifest import JobManifest, DONE
+from work_leases import LeaseLost, LeaseQueue, run_worker
+
+
+def test_renew_after_takeover_does_not_overwrite_new_lease(tmp_path):
+    slow = LeaseQueue(str(tmp_path), worker_id="slow", lease_seconds=0.2, poll_interval=0.05)
+    fast = LeaseQueue(str(tmp_path), worker_id="fast", lease_seconds=60, poll_interval=0.05)
+    lease = slow.claim(["chapter_01"])
+    time.sleep(0.3)  # the slow worker misses its heartbeat
+
+    taken = fast.claim(["chapter_01"])
+    assert taken is not None and taken.key == "chapter_01"
+    assert not lease.renew()
+    assert lease.lost
+    with open(tmp_path / "chapter_01.lease") as f:
+        assert json.load(f)["worker"] == "fast"
+    assert taken.renew()
+
+
+def test_lost_lease_stops_manifest_writes_and_is_not_completed(tmp_path):
+    leases = tmp_path / "leases"
+    slow = LeaseQueue(str(leases), worker_id="slow", lease_seconds=0.2, poll_interval=0.05)
+    fast = LeaseQueue(str(leases), worker_id="fast", lease_seconds=60, poll_interval=0.05)
+
+    def process(key, lease):
+        manifest = JobManifest(str(tmp_path), guard=lease.check)
+        manifest.plan({"a": "first"})
+        # The slow worker hangs past its lease: no heartbeat renews it
+        lease._stop.set()
+        lease._heartbeat.join()
+        time.sleep(0.3)
+        taken = fast.claim([key])
+        assert taken is not None
+        assert not lease.renew()
+        with pytest.raises(LeaseLost):
+            manifest.record_chunk("a", "first", DONE)
+        taken.complete()
+        return True
+
+    summary = run_worker(slow, ["chapter_01"], process)
+    assert summary == {"done": 1, "failed": 0, "remaining": 0}
+    assert not JobManifest(str(tmp_path)).is_done("a")
+    with open(leases / "chapter_01.done") as f:
+        assert json.load(f)["worker"] == "fast"
+    assert not any(".failed." in name for name in os.listdir(leases))
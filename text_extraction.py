@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+"""
+Chapter-aware text extraction and chunking shared by the generator scripts.
+"""
+
+import re
+from tqdm import tqdm
+import nltk
+from nltk.tokenize import sent_tokenize
+import ebooklib
+from ebooklib import epub
+from bs4 import BeautifulSoup
+from PyPDF2 import PdfReader
+from metrics import METRICS, timed
+
+# Download NLTK data
+nltk.download('punkt', quiet=True)
+
+# Typical narration speed (about 150 words per minute), used to estimate audio length from text
+SPEECH_CHARS_PER_SECOND = 15
+
+
+@timed("html_to_text")
+def html_to_text(html_content):
+    """Convert HTML content to plain text."""
+    soup = BeautifulSoup(html_content, 'html.parser')
+    text = soup.get_text()
+    # Clean up extra whitespace
+    text = re.sub(r'\s+', ' ', text).strip()
+    return text
+
+def iter_epub_chapters(epub_path):
+    """Yield (text, title) for each chapter of an ePub as soon as it is parsed."""
+    with METRICS.timer("epub_read"):
+        book = epub.read_epub(epub_path)
+    
+    # Get the spine (reading order)
+    spine = [item_id for item_id, _ in book.spine]
+    count = 0
+    
+    # Process items in reading order
+    for item_id in tqdm(spine, desc="Processing ePub items"):
+        # Get the item
+        item = book.get_item_with_id(item_id)
+        
+        # Skip if not a document
+        if not item or item.get_type() != ebooklib.ITEM_DOCUMENT:
+            continue
+            
+        # Get content
+        content = item.get_content().decode('utf-8')
+        
+        # Find title if possible
+        with METRICS.timer("html_parse"):
+            soup = BeautifulSoup(content, 'html.parser')
+        title_tag = soup.find(['h1', 'h2', 'h3', 'h4'])
+        title = title_tag.get_text().strip() if title_tag else f"Chapter {count + 1}"
+        
+        # Extract text
+        text = html_to_text(content)
+        
+        # Skip if no meaningful content
+        if len(text.strip()) < 50:
+            continue
+            
+        count += 1
+        yield text, title
+
+@timed("extract_text_from_epub")
+def extract_text_from_epub(epub_path):
+    """Extract text and chapters from an ePub file."""
+    print(f"Extracting text from ePub: {epub_path}...")
+    
+    chapters = []
+    chapter_titles = []
+    for text, title in iter_epub_chapters(epub_path):
+        chapters.append(text)
+        chapter_titles.append(title)
+    
+    print(f"Extracted {len(chapters)} chapters from ePub")
+    return chapters, chapter_titles
+
+def iter_chapters(input_path):
+    """
+    Yield (text, title) for each chapter of an ePub or PDF.
+
+    ePub chapters are yielded as they are parsed so later pipeline stages
+    can start on the first chapter while the rest is still being read.
+    PDF chapter detection needs the whole text, so PDF chapters are
+    yielded once it is extracted.
+    """
+    if input_path.lower().endswith('.epub'):
+        print(f"Extracting text from ePub: {input_path}...")
+        yield from iter_epub_chapters(input_path)
+    elif input_path.lower().endswith('.pdf'):
+        chapters, chapter_titles = extract_text_from_pdf(input_path)
+        yield from zip(chapters, chapter_titles)
+    else:
+        raise ValueError(f"Unsupported file format: {input_path}")
+
+def book_metadata(input_path):
+    """
+    Return the title, author and cover image of an ePub or PDF as a dict.
+
+    The cover is (image bytes, media type), or None; PDFs have none.
+    """
+    metadata = {"title": None, "author": None, "cover": None}
+    if input_path.lower().endswith('.pdf'):
+        info = PdfReader(input_path).metadata
+        if info:
+            metadata.update(title=info.title, author=info.author)
+        return metadata
+
+    book = epub.read_epub(input_path)
+    for key, name in (("title", "title"), ("author", "creator")):
+        values = book.get_metadata("DC", name)
+        if values:
+            metadata[key] = values[0][0]
+    covers = list(book.get_items_of_type(ebooklib.ITEM_COVER))
+    # EPUB 2 names the cover image in <meta name="cover" content="item id"/>
+    for _, attributes in book.get_metadata("OPF", "cover"):
+        item = book.get_item_with_id(attributes.get("content"))
+        if item is not None:
+            covers.append(item)
+    covers += [item for item in book.get_items_of_type(ebooklib.ITEM_IMAGE) if "cover" in item.get_name().lower()]
+    if covers:
+        metadata["cover"] = (covers[0].get_content(), covers[0].media_type)
+    return metadata
+
+@timed("extract_text_from_pdf")
+def extract_text_from_pdf(pdf_path):
+    """Extract text from a PDF file and attempt to detect chapters."""
+    print(f"Extracting text from PDF: {pdf_path}...")
+    
+    reader = PdfReader(pdf_path)
+    full_text = ""
+    
+    for i, page in enumerate(tqdm(reader.pages, desc="Processing PDF pages")):
+        with METRICS.timer("pdf_page_extract"):
+            page_text = page.extract_text()
+        
+        # Clean up page headers, footers, page numbers, etc.
+        page_text = re.sub(r'Page \d+ of \d+', '', page_text)
+        page_text = re.sub(r'^\s*\d+\s*$', '', page_text, flags=re.MULTILINE)
+        
+        full_text += page_text + "\n"
+    
+    # Detect chapters in the PDF text
+    chapters, chapter_titles = detect_chapters_in_text(full_text)
+    print(f"Detected {len(chapters)} chapters from PDF")
+    
+    return chapters, chapter_titles
+
+@timed("detect_chapters_in_text")
+def detect_chapters_in_text(text):
+    """Attempt to detect chapters in plain text."""
+    # Common chapter heading patterns
+    chapter_patterns = [
+        r'^CHAPTER\s+\d+',          # "CHAPTER 1", "CHAPTER 2", etc.
+        r'^Chapter\s+\d+',          # "Chapter 1", "Chapter 2", etc.
+        r'^\d+\.\s+[A-Z]',          # "1. CHAPTER TITLE", "2. CHAPTER TITLE"
+        r'^PART\s+\d+',             # "PART 1", "PART 2", etc.
+        r'^Part\s+\d+',             # "Part 1", "Part 2", etc.
+        r'^SECTION\s+\d+',          # "SECTION 1", "SECTION 2", etc.
+        r'^Section\s+\d+',          # "Section 1", "Section 2", etc.
+        r'^INTRODUCTION',           # "INTRODUCTION"
+        r'^Introduction',           # "Introduction"
+        r'^APPENDIX\s+\d*',         # "APPENDIX", "APPENDIX A", etc.
+        r'^Appendix\s+\d*',         # "Appendix", "Appendix A", etc.
+    ]
+    
+    # Split text into lines
+    lines = text.split('\n')
+    
+    # Find potential chapter boundaries
+    chapter_starts = []
+    chapter_titles = []
+    
+    for i, line in enumerate(lines):
+        line = line.strip()
+        if not line:
+            continue
+            
+        # Check if line matches a chapter pattern
+        for pattern in chapter_patterns:
+            if re.match(pattern, line):
+                chapter_starts.append(i)
+                chapter_titles.append(line)
+                break
+    
+    # If no chapters detected, treat as a single chapter
+    if not chapter_starts:
+        return [text], ["Chapter 1"]
+    
+    # Extract chapter text
+    chapters = []
+    for i in range(len(chapter_starts)):
+        start = chapter_starts[i]
+        end = chapter_starts[i+1] if i+1 < len(chapter_starts) else len(lines)
+        chapter_text = '\n'.join(lines[start:end]).strip()
+        chapters.append(chapter_text)
+    
+    return chapters, chapter_titles
+
+@timed("split_text_into_chunks")
+def split_text_into_chunks(text, max_chars=1000):
+    """Split text into manageable chunks for TTS processing."""
+    # Split text into sentences
+    sentences = sent_tokenize(text)
+    
+    # Group sentences into chunks
+    chunks = []
+    current_chunk = ""
+    
+    for sentence in sentences:
+        # Clean the sentence
+        sentence = sentence.strip()
+        if not sentence:
+            continue
+            
+        # If adding this sentence doesn't exceed max_chars, add it to the current chunk
+        if len(current_chunk) + len(sentence) + 1 <= max_chars:
+            current_chunk += sentence + " "
+        else:
+            # Save the current chunk if it's not empty
+            if current_chunk:
+                chunks.append(current_chunk.strip())
+            current_chunk = sentence + " "
+    
+    # Add the last chunk if not empty
+    if current_chunk:
+        chunks.append(current_chunk.strip())
+    
+    return chunks
+
+
+def leading_chunks(chunks, minutes, chars_per_second=SPEECH_CHARS_PER_SECOND):
+    """Return how many leading chunks cover about the first minutes of narration (at least one)."""
+    budget = minutes * 60 * chars_per_second
+    count, total = 0, 0
+    for chunk in chunks:
+        if count and total + len(chunk) > budget:
+            break
+        total += len(chunk)
+        count += 1
+    return count
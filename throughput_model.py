@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+"""
+Learned synthesis throughput for ETAs and capacity planning.
+
+Every synthesized chunk is recorded with its length in characters, the
+seconds it took, the seconds of audio it produced and the size of its
+output file. Per backend, voice and host, chunk time is fitted as a fixed
+per-chunk overhead plus a per-character cost, so short and long chunks are
+both predicted well. The statistics are persisted after each run and older
+runs are gradually down-weighted, so the model follows changes to the host.
+Saves are serialized with flock on the statistics file's .lock file, so
+workers of one job finishing at the same time do not drop each other's runs.
+
+Without any recorded runs the model falls back to the old rule of thumb of
+5 seconds per chunk and typical narration speed.
+"""
+
+import datetime
+import json
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # e.g. Windows: concurrent saves may then drop one run
+
+DEFAULT_STATS_PATH = os.path.join(os.path.expanduser("~"), ".cache", "audiobook", "throughput.json")
+# Weight kept by the statistics of earlier runs each time a run is saved
+DECAY = 0.8
+# Fallbacks used before anything has been recorded
+DEFAULT_SECONDS_PER_CHUNK = 5.0
+DEFAULT_CHARS_PER_AUDIO_SECOND = 15.0
+DEFAULT_WAV_BYTES_PER_SECOND = 22050 * 2
+MP3_BYTES_PER_SECOND = 128000 // 8
+
+_SUMS = ("n", "sx", "sy", "sxx", "sxy", "audio_chars", "audio_seconds", "output_bytes")
+
+
+def format_seconds(seconds):
+    """Format seconds as H:MM:SS."""
+    return str(datetime.timedelta(seconds=int(seconds)))
+
+
+def _load(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"entries": {}}
+
+
+@contextmanager
+def _locked(path):
+    # Held across the read-modify-write of a save, so runs finishing at once all count
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path + ".lock", "a") as lock_file:
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class ThroughputModel:
+    """
+    Throughput statistics of one backend and voice on this host.
+
+    Args:
+        backend (str): TTS backend, e.g. "piper" or "sesame".
+        voice (str): Voice model or preset name.
+        path (str): Statistics file shared by all runs on this host.
+    """
+
+    def __init__(self, backend, voice, path=None):
+        self.backend = backend
+        self.voice = voice
+        self.host = socket.gethostname()
+        self.key = f"{backend}|{voice}|{self.host}"
+        self.path = path or os.environ.get("AUDIOBOOK_STATS", DEFAULT_STATS_PATH)
+        prior = _load(self.path)["entries"].get(self.key, {})
+        self.prior = {name: prior.get(name, 0.0) for name in _SUMS}
+        self.prior_peak_rss_mb = prior.get("peak_rss_mb")
+        self.run = {name: 0.0 for name in _SUMS}
+        self._lock = threading.Lock()
+
+    @property
+    def has_data(self):
+        return self.prior["n"] + self.run["n"] > 0
+
+    def _sums(self):
+        return {name: self.prior[name] + self.run[name] for name in _SUMS}
+
+    def observe(self, chars, seconds, audio_seconds=None, output_bytes=None):
+        """Record one synthesized chunk."""
+        with self._lock:
+            run = self.run
+            run["n"] += 1
+            run["sx"] += chars
+            run["sy"] += seconds
+            run["sxx"] += chars * chars
+            run["sxy"] += chars * seconds
+            if audio_seconds:
+                run["audio_chars"] += chars
+                run["audio_seconds"] += audio_seconds
+                run["output_bytes"] += output_bytes or 0
+
+    def coefficients(self):
+        """Return (seconds per chunk, seconds per character) of the fitted chunk time."""
+        with self._lock:
+            s = self._sums()
+        if s["n"] == 0:
+            return DEFAULT_SECONDS_PER_CHUNK, 0.0
+        denominator = s["n"] * s["sxx"] - s["sx"] ** 2
+        if s["n"] < 2 or abs(denominator) < 1e-9:
+            return 0.0, s["sy"] / max(1.0, s["sx"])
+        per_char = (s["n"] * s["sxy"] - s["sx"] * s["sy"]) / denominator
+        per_chunk = (s["sy"] - per_char * s["sx"]) / s["n"]
+        if per_chunk < 0 or per_char < 0:
+            # A noisy fit; fall back to a plain characters-per-second rate
+            return 0.0, s["sy"] / max(1.0, s["sx"])
+        return per_chunk, per_char
+
+    def rates(self):
+        """Return characters synthesized per second and audio seconds produced per second."""
+        with self._lock:
+            s = self._sums()
+        if s["sy"] == 0:
+            return None, None
+        audio_rate = s["audio_seconds"] / s["sy"] * (s["sx"] / s["audio_chars"]) if s["audio_chars"] else None
+        return s["sx"] / s["sy"], audio_rate
+
+    def predict_seconds(self, chunks, workers=1):
+        """Predict the wall time to synthesize a list of chunk texts with workers in parallel."""
+        per_chunk, per_char = self.coefficients()
+        total = sum(per_chunk + per_char * len(chunk) for chunk in chunks)
+        return total / max(1, workers)
+
+    def eta(self, chunks, workers=1):
+        """Predicted remaining time for chunks, formatted as H:MM:SS."""
+        return format_seconds(self.predict_seconds(chunks, workers))
+
+    def audio_seconds(self, chars):
+        """Predict the seconds of audio produced from chars characters."""
+        with self._lock:
+            s = self._sums()
+        chars_per_second = s["audio_chars"] / s["audio_seconds"] if s["audio_seconds"] else DEFAULT_CHARS_PER_AUDIO_SECOND
+        return chars / chars_per_second
+
+    def wav_bytes_per_second(self):
+        with self._lock:
+            s = self._sums()
+        return s["output_bytes"] / s["audio_seconds"] if s["audio_seconds"] else DEFAULT_WAV_BYTES_PER_SECOND
+
+    def plan(self, chapters, workers=1, per_item_mb=None):
+        """
+        Predict wall time, disk usage and peak memory for a book before synthesis.
+
+        Args:
+            chapters (list): (chapter number, title, chunk texts) tuples.
+            workers (int): Chunks synthesized in parallel.
+            per_item_mb (int): Estimated memory per in-flight chunk, used for
+                the peak memory when no earlier run was recorded.
+
+        Returns:
+            dict: The plan, with one entry per chapter.
+        """
+        plan_chapters = []
+        for chapter_num, title, chunks in chapters:
+            chars = sum(len(chunk) for chunk in chunks)
+            audio_seconds = self.audio_seconds(chars)
+            plan_chapters.append({
+                "chapter": chapter_num,
+                "title": title,
+                "chunks": len(chunks),
+                "chars": chars,
+                "seconds": round(self.predict_seconds(chunks, workers), 1),
+                "audio_seconds": round(audio_seconds, 1),
+            })
+        audio_seconds = sum(c["audio_seconds"] for c in plan_chapters)
+        temp_bytes = audio_seconds * self.wav_bytes_per_second()
+        output_bytes = audio_seconds * MP3_BYTES_PER_SECOND
+        peak_rss_mb = self.prior_peak_rss_mb
+        if peak_rss_mb is None and per_item_mb:
+            peak_rss_mb = per_item_mb * max(1, workers)
+        return {
+            "backend": self.backend,
+            "voice": self.voice,
+            "host": self.host,
+            "fitted": self.has_data,
+            "chapters": plan_chapters,
+            "chunks": sum(c["chunks"] for c in plan_chapters),
+            "chars": sum(c["chars"] for c in plan_chapters),
+            "wall_seconds": round(sum(c["seconds"] for c in plan_chapters), 1),
+            "audio_seconds": round(audio_seconds, 1),
+            # Chunk files and the chapter and book outputs exist at the same time
+            "disk_mb": round((temp_bytes + 2 * output_bytes) / (1024 * 1024), 1),
+            "peak_rss_mb": round(peak_rss_mb, 1) if peak_rss_mb is not None else None,
+        }
+
+    def save(self, peak_rss_mb=None):
+        """Fold this run into the statistics file, down-weighting earlier runs."""
+        with self._lock:
+            run = dict(self.run)
+        if run["n"] == 0:
+            return
+        with _locked(self.path):
+            data = _load(self.path)
+            entry = data["entries"].get(self.key, {})
+            for name in _SUMS:
+                entry[name] = DECAY * entry.get(name, 0.0) + run[name]
+            if peak_rss_mb is not None:
+                entry["peak_rss_mb"] = max(peak_rss_mb, DECAY * entry.get("peak_rss_mb", 0.0))
+            entry.update(backend=self.backend, voice=self.voice, host=self.host,
+                         runs=entry.get("runs", 0) + 1, updated=time.time())
+            data["entries"][self.key] = entry
+
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(data, f, indent=2)
+            os.replace(tmp_path, self.path)
+
+    def summary(self):
+        """Return a one-line description of the fitted throughput."""
+        per_chunk, per_char = self.coefficients()
+        chars_rate, audio_rate = self.rates()
+        text = f"{self.key}: {per_chunk:.2f}s per chunk + {per_char * 1000:.2f}s per 1000 chars"
+        if chars_rate:
+            text += f", {chars_rate:.0f} chars/s"
+        if audio_rate:
+            text += f", {audio_rate:.2f} audio s/s"
+        return text
+
+
+class RunningEstimate:
+    """
+    A book's predicted synthesis time, refined as its chapters are chunked.
+
+    Reading the whole book up front for an ETA would keep extraction from
+    overlapping synthesis, so each chapter is added as it is chunked.
+
+    Args:
+        throughput (ThroughputModel): Model predicting the chunk times.
+        workers (int): Chunks synthesized in parallel.
+    """
+
+    def __init__(self, throughput, workers=1):
+        self.throughput = throughput
+        self.workers = workers
+        self.chapters = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, chunks):
+        """Add the chunk texts of a chapter and return the predicted seconds of all chapters added so far."""
+        seconds = self.throughput.predict_seconds(chunks, self.workers)
+        with self._lock:
+            self.chapters += 1
+            self.seconds += seconds
+            return self.seconds
+
+    def summary(self):
+        """Return a one-line description of the estimate so far."""
+        with self._lock:
+            return f"{format_seconds(self.seconds)} for the {self.chapters} chapters read so far"
+
+
+def print_plan(plan):
+    """Print a plan returned by ThroughputModel.plan."""
+    print(f"Plan for {plan['backend']} voice '{plan['voice']}' on {plan['host']}"
+          + ("" if plan["fitted"] else " (no recorded runs; using default estimates)"))
+    print(f"{'chapter':>7} {'chunks':>6} {'chars':>8} {'audio':>9} {'wall':>9}  title")
+    for c in plan["chapters"]:
+        print(f"{c['chapter']:>7} {c['chunks']:>6} {c['chars']:>8} {format_seconds(c['audio_seconds']):>9} "
+              f"{format_seconds(c['seconds']):>9}  {c['title']}")
+    print(f"Total: {plan['chunks']} chunks, {plan['chars']} chars, {format_seconds(plan['audio_seconds'])} of audio")
+    print(f"Predicted wall time: {format_seconds(plan['wall_seconds'])}")
+    print(f"Predicted disk usage: {plan['disk_mb']:.0f}MB")
+    if plan["peak_rss_mb"] is not None:
+        print(f"Predicted peak memory: {plan['peak_rss_mb']:.0f}MB")
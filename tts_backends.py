@@ -0,0 +1,444 @@
+#!/usr/bin/env python3
+"""
+Common interface of the TTS backends.
+
+A backend turns text into 16-bit mono PCM at its ``sample_rate``; callers
+write the PCM wherever they need it. Each backend advertises its
+Capabilities, from which the scheduler picks the number of worker threads,
+whether chunks are grouped into batch calls, and whether streaming is
+used:
+
+- ``batching``: ``synthesize_batch`` handles several texts in one call
+  more efficiently than one call per text.
+- ``streaming``: ``stream`` yields audio before the whole text is done.
+- ``max_concurrency``: texts that may be synthesized at the same time.
+- ``max_batch_size``: texts per ``synthesize_batch`` call.
+- ``warm_start_seconds``: one-off cost of loading the voice, paid once per
+  backend when it is ``resident`` and on every call otherwise.
+"""
+
+import hashlib
+import importlib.metadata
+import json
+import math
+import multiprocessing
+import os
+import queue
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+
+from audio_io import read_wav
+from metrics import METRICS, timed
+from phoneme_cache import PHONEME_CACHE_PATH, PhonemeCache
+
+# The in-process Piper backend needs onnxruntime and piper-phonemize (espeak-ng)
+try:
+    import numpy as np
+    import onnxruntime
+    from piper_phonemize import phonemize_codepoints, phonemize_espeak
+except ImportError:
+    onnxruntime = None
+
+PIPER_SAMPLE_RATE = 22050
+# Rough time piper needs to load an ONNX voice
+PIPER_WARM_START_SECONDS = 1.0
+# Phoneme ids that start, end and separate the phonemes of a sentence
+BOS, EOS, PAD = "^", "$", "_"
+# Audio samples per spectrogram frame of Piper's VITS voices
+PIPER_HOP_LENGTH = 256
+# Samples below this fraction of full scale count as silence when trimming padded batch outputs
+SILENCE_LEVEL = 0.002
+ONNX_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "audiobook", "onnx")
+
+
+class Capabilities:
+    """What a backend can exploit; see the module docstring."""
+
+    def __init__(self, batching=False, streaming=False, max_concurrency=1, max_batch_size=1,
+                 warm_start_seconds=0.0, resident=True):
+        self.batching = batching
+        self.streaming = streaming
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_batch_size = max(1, max_batch_size) if batching else 1
+        self.warm_start_seconds = warm_start_seconds
+        self.resident = resident
+
+    def summary(self):
+        features = [name for name in ("batching", "streaming") if getattr(self, name)]
+        return (f"{', '.join(features) or 'no batching or streaming'}, up to {self.max_concurrency} concurrent"
+                + (f", batches of {self.max_batch_size}" if self.batching else "")
+                + f", warm start {self.warm_start_seconds:.1f}s" + ("" if self.resident else " per call"))
+
+
+class Backend:
+    """
+    Base class of the TTS backends; subclasses implement synthesize.
+
+    Failures are raised as exceptions, so callers can tell a failed chunk
+    from silence.
+    """
+
+    name = "backend"
+
+    def __init__(self, voice, sample_rate, capabilities):
+        self.voice = voice
+        self.sample_rate = sample_rate
+        self.capabilities = capabilities
+
+    def synthesize(self, text):
+        """Return the 16-bit mono PCM of text."""
+        raise NotImplementedError
+
+    def synthesize_batch(self, texts):
+        """Return the PCM of each text."""
+        return [self.synthesize(text) for text in texts]
+
+    def stream(self, text):
+        """Yield the PCM of text in pieces, as it is synthesized."""
+        yield self.synthesize(text)
+
+    def close(self):
+        pass
+
+
+def worker_count(capabilities, max_workers):
+    """Return the number of threads to synthesize with, within the command-line limit."""
+    return max(1, min(max_workers, capabilities.max_concurrency))
+
+
+def batch_groups(items, workers, capabilities):
+    """Split items into the groups of one synthesize_batch call each, spread over workers."""
+    if not capabilities.batching:
+        return [[item] for item in items]
+    size = max(1, min(capabilities.max_batch_size, math.ceil(len(items) / max(1, workers))))
+    return [items[k:k + size] for k in range(0, len(items), size)]
+
+
+def pcm16(audio):
+    """Convert a float audio tensor in [-1, 1] to little-endian int16 bytes."""
+    import torch
+    return (audio.clamp(-1, 1) * 32767).to(torch.int16).cpu().numpy().tobytes()
+
+
+def _piper_sample_rate(model_path):
+    """Read the sample rate from the voice's JSON config, next to the model."""
+    try:
+        with open(model_path + ".json") as f:
+            return json.load(f)["audio"]["sample_rate"]
+    except (OSError, ValueError, KeyError):
+        return PIPER_SAMPLE_RATE
+
+
+class PiperProcessBackend(Backend):
+    """Piper run as a new process per chunk, reloading the voice every time."""
+
+    name = "piper"
+
+    def __init__(self, model_path, max_concurrency=None):
+        super().__init__(os.path.basename(model_path), _piper_sample_rate(model_path), Capabilities(
+            max_concurrency=max_concurrency or max(1, multiprocessing.cpu_count() // 2),
+            warm_start_seconds=PIPER_WARM_START_SECONDS, resident=False))
+        self.model_path = model_path
+
+    @timed("piper_process_synthesize")
+    def synthesize(self, text):
+        # Unique files per call so workers can run concurrently
+        work_dir = tempfile.mkdtemp(prefix="piper_")
+        try:
+            text_file, output_file = os.path.join(work_dir, "input.txt"), os.path.join(work_dir, "output.wav")
+            with open(text_file, "w") as f:
+                f.write(text)
+            completed = subprocess.run(["piper", "--model", self.model_path, "--output_file", output_file,
+                                        "--file", text_file], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            if completed.returncode != 0:
+                raise RuntimeError(f"piper exited with {completed.returncode}: {completed.stderr.decode()[-500:]}")
+            pcm, self.sample_rate = read_wav(output_file)
+            return pcm
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+class PiperPoolBackend(Backend):
+    """
+    Long-lived Piper processes that keep a voice model loaded between chunks.
+
+    Each process runs 'piper --json-input --output_dir DIR', reads one JSON
+    line per chunk on stdin and prints the path of the WAV it wrote, so the
+    model is loaded once per process instead of once per chunk. Processes
+    are checked out by one thread at a time and restarted if they die.
+    """
+
+    name = "piper"
+
+    def __init__(self, model_path, size, work_dir):
+        super().__init__(os.path.basename(model_path), _piper_sample_rate(model_path), Capabilities(
+            max_concurrency=size, warm_start_seconds=PIPER_WARM_START_SECONDS))
+        self.model_path = model_path
+        self.work_dir = work_dir
+        os.makedirs(work_dir, exist_ok=True)
+        self._idle = queue.Queue()
+        for _ in range(max(1, size)):
+            self._idle.put(None)  # started lazily on first use
+
+    def _start(self):
+        METRICS.inc("piper_process_starts_total")
+        return subprocess.Popen(
+            ["piper", "--model", self.model_path, "--json-input", "--output_dir", self.work_dir],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, bufsize=1,
+        )
+
+    def synthesize(self, text):
+        """Generate the audio of text with a resident process."""
+        process = self._idle.get()
+        try:
+            if process is None or process.poll() is not None:
+                process = self._start()
+            with METRICS.timer("piper_pool_synthesize"):
+                process.stdin.write(json.dumps({"text": text}) + "\n")
+                process.stdin.flush()
+                wav_path = process.stdout.readline().strip()
+            if not wav_path:
+                raise RuntimeError("piper exited without producing audio")
+            pcm, self.sample_rate = read_wav(wav_path)
+            os.remove(wav_path)
+            return pcm
+        except Exception:
+            if process is not None:
+                process.kill()
+            process = None
+            raise
+        finally:
+            self._idle.put(process)
+
+    def close(self):
+        while not self._idle.empty():
+            process = self._idle.get()
+            if process is not None and process.poll() is None:
+                process.stdin.close()
+                process.wait()
+
+
+class SesameBackend(Backend):
+    """
+    A loaded CSM generator, one chunk at a time on its device.
+
+    The Sesame generator script drives the generator directly to retry
+    failed sentence spans; this wrapper gives other callers PCM and the
+    generator's capabilities.
+    """
+
+    name = "sesame"
+
+    def __init__(self, generator, voice="default", load_seconds=0.0, speaker=0, context=None,
+                 max_audio_length_ms=60_000):
+        super().__init__(voice, generator.sample_rate, Capabilities(
+            streaming=hasattr(generator, "generate_stream"), max_concurrency=1, warm_start_seconds=load_seconds))
+        self.generator = generator
+        self.speaker = speaker
+        self.context = context or []
+        self.max_audio_length_ms = max_audio_length_ms
+
+    def synthesize(self, text):
+        audio = self.generator.generate(text=text, speaker=self.speaker, context=self.context,
+                                        max_audio_length_ms=self.max_audio_length_ms)
+        return pcm16(audio)
+
+    def stream(self, text):
+        if not self.capabilities.streaming:
+            yield self.synthesize(text)
+            return
+        for audio in self.generator.generate_stream(text, self.speaker, self.context,
+                                                    max_audio_length_ms=self.max_audio_length_ms):
+            yield pcm16(audio)
+
+
+def _sound_end(audio):
+    """Return the index after the last sample of audio that is not near-silent."""
+    loud = np.flatnonzero(np.abs(audio) > SILENCE_LEVEL)
+    return int(loud[-1]) + 1 if loud.size else 0
+
+
+def _trim_padding(audio, tail=0):
+    """Cut the near-silent tail a shorter sentence gets from being padded to the batch's longest, keeping tail samples of it."""
+    return audio[:_sound_end(audio) + tail]
+
+
+class OnnxPiperBackend(Backend):
+    """
+    A Piper voice run in-process with onnxruntime.
+
+    The voice's .onnx model and .onnx.json config are loaded once. Text is
+    phonemized with espeak-ng (piper-phonemize), like the piper binary does,
+    and several sentences are padded into one inference call: the sentences
+    of a synthesize_batch call are sorted by length so each call pads
+    little. The audio of a padded sentence is cut to the length its phoneme
+    durations give, when the voice outputs them. There is no process, pipe
+    or WAV file between the model and the caller.
+
+    Args:
+        model_path (str): Piper voice (.onnx), with its config next to it as .onnx.json.
+        threads (int): Threads per inference (onnxruntime intra-op threads).
+        sentences_per_call (int): Sentences batched into one inference call.
+        max_concurrency (int): Concurrent inferences; each uses threads threads.
+        cache_dir (str): Directory of graph-optimized models, so later runs skip optimization.
+            None disables the cache.
+        phoneme_cache (str): "words" or "sentences" to cache phonemes (see phoneme_cache), or None.
+        phoneme_cache_path (str): Phoneme store shared across books.
+        phoneme_cache_entries (int): Phonemized words and sentences kept in memory.
+    """
+
+    name = "piper-onnx"
+
+    def __init__(self, model_path, threads=1, sentences_per_call=8, max_concurrency=None, cache_dir=ONNX_CACHE_DIR,
+                 phoneme_cache=None, phoneme_cache_path=PHONEME_CACHE_PATH, phoneme_cache_entries=200_000):
+        if onnxruntime is None:
+            raise RuntimeError("the in-process Piper backend needs onnxruntime, numpy and piper-phonemize")
+        start = time.time()
+        with open(model_path + ".json") as f:
+            self.config = json.load(f)
+        self.session = self._load(model_path, threads, cache_dir)
+        self.inputs = {i.name for i in self.session.get_inputs()}
+        inference = self.config.get("inference", {})
+        self.scales = np.array([inference.get("noise_scale", 0.667), inference.get("length_scale", 1.0),
+                                inference.get("noise_w", 0.8)], dtype=np.float32)
+        self.id_map = self.config["phoneme_id_map"]
+        self.sentences_per_call = max(1, sentences_per_call)
+        self.phoneme_cache = None
+        if phoneme_cache and self.config.get("phoneme_type", "espeak") == "espeak":
+            language = self.config["espeak"]["voice"]
+            self.phoneme_cache = PhonemeCache(lambda text: phonemize_espeak(text, language), language,
+                                              espeak_version(), phoneme_cache_path, phoneme_cache_entries,
+                                              words=phoneme_cache == "words")
+        super().__init__(os.path.basename(model_path), self.config["audio"]["sample_rate"], Capabilities(
+            batching=True, max_concurrency=max_concurrency or max(1, multiprocessing.cpu_count() // max(1, threads)),
+            max_batch_size=self.sentences_per_call, warm_start_seconds=time.time() - start))
+
+    def _load(self, model_path, threads, cache_dir):
+        options = onnxruntime.SessionOptions()
+        # Threads are set explicitly so concurrent inferences do not oversubscribe a shared host
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if cache_dir:
+            # Optimized graphs depend on the model, onnxruntime version, threads and the host's CPU
+            with open(model_path, "rb") as f:
+                digest = hashlib.sha256(f.read()).hexdigest()[:16]
+            cached = os.path.join(cache_dir, f"{os.path.basename(model_path)}.{digest}.{socket.gethostname()}"
+                                             f".ort{onnxruntime.__version__}.t{threads}.onnx")
+            if os.path.exists(cached):
+                options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL
+                model_path = cached
+            else:
+                os.makedirs(cache_dir, exist_ok=True)
+                options.optimized_model_filepath = cached
+        with METRICS.timer("onnx_session_load"):
+            return onnxruntime.InferenceSession(model_path, sess_options=options, providers=["CPUExecutionProvider"])
+
+    def phoneme_ids(self, text):
+        """Return the phoneme ids of each sentence of text."""
+        if self.config.get("phoneme_type", "espeak") == "text":
+            sentences = phonemize_codepoints(text)
+        elif self.phoneme_cache is not None:
+            sentences = self.phoneme_cache.phonemize(text)
+        else:
+            sentences = phonemize_espeak(text, self.config["espeak"]["voice"])
+        ids = []
+        for phonemes in sentences:
+            sentence_ids = list(self.id_map[BOS])
+            for phoneme in phonemes:
+                if phoneme in self.id_map:
+                    sentence_ids.extend(self.id_map[phoneme])
+                    sentence_ids.extend(self.id_map[PAD])
+            sentence_ids.extend(self.id_map[EOS])
+            ids.append(sentence_ids)
+        return ids
+
+    def _infer(self, batch):
+        """Return the float audio of each phoneme id sequence in batch, from one inference call."""
+        lengths = np.array([len(ids) for ids in batch], dtype=np.int64)
+        padded = np.zeros((len(batch), lengths.max()), dtype=np.int64)
+        for row, ids in enumerate(batch):
+            padded[row, :len(ids)] = ids
+        feeds = {"input": padded, "input_lengths": lengths, "scales": self.scales}
+        if "sid" in self.inputs:
+            feeds["sid"] = np.zeros(len(batch), dtype=np.int64)
+        with METRICS.timer("onnx_inference"):
+            outputs = self.session.run(None, feeds)
+        audio = outputs[0].reshape(len(batch), -1)
+        durations = outputs[1].reshape(len(batch), -1) if len(outputs) > 1 else None
+        if durations is not None and durations.shape[1] == padded.shape[1]:
+            # Voices exported with phoneme durations (in spectrogram frames) give each row's exact length
+            return [audio[row, :int(np.ceil(durations[row, :lengths[row]]).sum()) * PIPER_HOP_LENGTH]
+                    for row in range(len(batch))]
+        # Otherwise padded rows are cut after their last sound, keeping the trailing silence
+        # piper emits after a sentence, as measured on the batch's unpadded longest row
+        longest = int(np.argmax(lengths))
+        tail = audio.shape[1] - _sound_end(audio[longest])
+        return [audio[row] if lengths[row] == lengths[longest] else _trim_padding(audio[row], tail)
+                for row in range(len(batch))]
+
+    @staticmethod
+    def _to_pcm(audio):
+        # Normalized per sentence, like piper
+        peak = float(np.max(np.abs(audio))) if audio.size else 0.0
+        audio = audio * (32767 / max(0.01, peak))
+        return np.clip(audio, -32768, 32767).astype(np.int16).tobytes()
+
+    def synthesize(self, text):
+        return self.synthesize_batch([text])[0]
+
+    def synthesize_batch(self, texts):
+        sentences = [(t, ids) for t, text in enumerate(texts) for ids in self.phoneme_ids(text)]
+        order = sorted(range(len(sentences)), key=lambda k: len(sentences[k][1]))
+        audio = [None] * len(sentences)
+        for start in range(0, len(order), self.sentences_per_call):
+            call = order[start:start + self.sentences_per_call]
+            for k, sentence_audio in zip(call, self._infer([sentences[k][1] for k in call])):
+                audio[k] = self._to_pcm(sentence_audio)
+        pcm = [[] for _ in texts]
+        for (t, _), sentence_pcm in zip(sentences, audio):
+            pcm[t].append(sentence_pcm)
+        return [b"".join(parts) for parts in pcm]
+
+    def close(self):
+        if self.phoneme_cache is not None:
+            self.phoneme_cache.close()
+
+
+def espeak_version():
+    """Return the version of the espeak-ng bundled with piper-phonemize."""
+    try:
+        return importlib.metadata.version("piper-phonemize")
+    except importlib.metadata.PackageNotFoundError:
+        return "unknown"
+
+
+def add_piper_arguments(parser):
+    """Add the options selecting and tuning the Piper backend to a generator's argument parser."""
+    parser.add_argument("--piper_backend", choices=["pool", "process", "onnx"], default="pool",
+                        help="Run Piper as resident processes (pool), one process per chunk (process), or in-process with onnxruntime (onnx)")
+    parser.add_argument("--onnx_threads", type=int, default=1, help="Threads per inference with --piper_backend onnx")
+    parser.add_argument("--onnx_sentences_per_call", type=int, default=8, help="Sentences batched into one inference with --piper_backend onnx")
+    parser.add_argument("--onnx_cache_dir", default=ONNX_CACHE_DIR, help="Directory of optimized voice models with --piper_backend onnx ('' disables the cache)")
+    parser.add_argument("--phoneme_cache", choices=["sentences", "words", "off"], default="sentences",
+                        help="Cache phonemes of sentences with --piper_backend onnx, phonemizing uncached sentences whole, exactly as espeak does "
+                             "('words' assembles them from cached words; faster, but WARNING: reductions across word boundaries are lost, so some words are pronounced differently)")
+    parser.add_argument("--phoneme_cache_file", default=PHONEME_CACHE_PATH, help="Phoneme store shared across books ('' keeps the cache in memory)")
+    parser.add_argument("--phoneme_cache_entries", type=int, default=200_000, help="Phonemized words and sentences kept in memory")
+
+
+def piper_backend_from_args(args, work_dir):
+    """Return the Piper backend selected on the command line; pool processes write to work_dir."""
+    if args.piper_backend == "onnx":
+        return OnnxPiperBackend(args.model, args.onnx_threads, args.onnx_sentences_per_call,
+                                cache_dir=args.onnx_cache_dir or None,
+                                phoneme_cache=None if args.phoneme_cache == "off" else args.phoneme_cache,
+                                phoneme_cache_path=args.phoneme_cache_file or None,
+                                phoneme_cache_entries=args.phoneme_cache_entries)
+    if args.piper_backend == "process":
+        return PiperProcessBackend(args.model, args.max_workers)
+    return PiperPoolBackend(args.model, args.max_workers, work_dir)
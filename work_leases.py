@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+"""
+Lease-file work sharding over a shared filesystem.
+
+Several workers, on one host or many hosts mounting the same NFS job
+directory, split a job's work items (chapters) between them without any
+queue service. Every item has files in a lease directory:
+
+- ``<key>.lease``: the claim of the worker processing the item. It is
+  created with O_EXCL, so exactly one worker claims a free item, and is
+  renewed by a heartbeat. A lease that is not renewed before it expires
+  (the worker died or hung) is taken over by another worker.
+- ``<key>.backup.lease``: a second, speculative claim on a straggler, an
+  item whose lease has been held for longer than ``steal_after`` seconds.
+  Idle workers back up stragglers once nothing else is left to claim, and
+  the first copy to finish completes the item.
+- ``<key>.done``: the item is complete. Outputs must be committed (renamed
+  into place) before ``complete`` is called.
+
+A worker whose lease was taken over (it hung past the expiry and then
+resumed) must stop writing the item's files: ``Lease.check`` raises
+LeaseLost once the heartbeat found the lease gone, and run_worker never
+completes an item whose lease it no longer holds.
+- ``<key>.failed.<worker>.<time>``: one file per failed attempt; an item
+  with ``max_attempts`` failures is no longer claimed.
+
+Only operations that NFS also provides are used: exclusive create, rename,
+link and, around renewing and taking over a lease, an flock on
+``<key>.lease.lock`` (NFSv4 locks), so a renewal never overwrites a lease
+another worker has just taken over. Lease expiry compares wall-clock times
+of different hosts, so ``lease_seconds`` must be much larger than the clock
+skew between them.
+"""
+
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # e.g. Windows: renewals and takeovers are not serialized
+
+LEASE_SUFFIX = ".lease"
+BACKUP_SUFFIX = ".backup.lease"
+DONE_SUFFIX = ".done"
+FAILED_MARK = ".failed."
+
+
+class LeaseLost(RuntimeError):
+    """Raised when a worker finds that another worker has taken over its lease."""
+
+
+def default_worker_id():
+    """Return an identifier unique to this worker process."""
+    return f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        # Missing, or caught mid-write by a non-atomic filesystem
+        return None
+
+
+@contextmanager
+def _lease_lock(path):
+    """Hold the lock serializing renewals and takeovers of the lease at path."""
+    with open(path + ".lock", "a") as f:
+        if fcntl:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _create_exclusive(path, data):
+    """Create path with data only if it does not exist. Returns True on success."""
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, "w") as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    return True
+
+
+class Lease:
+    """
+    A claim on one work item, renewed by a heartbeat thread while in use.
+
+    Use as a context manager around the work; call ``complete`` after the
+    item's outputs are committed, or ``fail`` if the attempt failed.
+    Leaving the block without either releases the claim for another worker.
+    """
+
+    def __init__(self, queue, key, path, backup=False):
+        self.queue = queue
+        self.key = key
+        self.path = path
+        self.backup = backup
+        self.lost = False
+        self._stop = threading.Event()
+        self._heartbeat = None
+        self._finished = False
+
+    def _record(self, claimed):
+        now = time.time()
+        return {"worker": self.queue.worker_id, "claimed": claimed, "renewed": now,
+                "expires": now + self.queue.lease_seconds, "backup": self.backup}
+
+    def renew(self):
+        """Extend the lease. Returns False if another worker has taken it over."""
+        # Under the lease lock, no takeover can happen between the check and the write
+        with _lease_lock(self.path):
+            current = _read_json(self.path)
+            if current is None or current.get("worker") != self.queue.worker_id:
+                self.lost = True
+                return False
+            tmp_path = f"{self.path}.{self.queue.worker_id}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self._record(current["claimed"]), f)
+            os.replace(tmp_path, self.path)
+            return True
+
+    def check(self):
+        """Raise LeaseLost if the heartbeat found the lease taken over; call before every write of the item's files."""
+        if self.lost:
+            raise LeaseLost(f"lease on {self.key} was taken over by another worker")
+
+    def _beat(self):
+        while not self._stop.wait(self.queue.lease_seconds / 3):
+            if not self.renew():
+                print(f"Warning: lease on {self.key} was taken over by another worker")
+                return
+
+    def __enter__(self):
+        self._heartbeat = threading.Thread(target=self._beat, name=f"lease-{self.key}", daemon=True)
+        self._heartbeat.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._heartbeat.join()
+        if not self._finished:
+            self.release()
+
+    def _remove(self):
+        current = _read_json(self.path)
+        if current is not None and current.get("worker") == self.queue.worker_id:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+    def complete(self, info=None):
+        """Mark the item done (the first copy to finish wins) and drop the lease."""
+        _create_exclusive(self.queue._path(self.key, DONE_SUFFIX),
+                          {"worker": self.queue.worker_id, "finished": time.time(), "backup": self.backup, **(info or {})})
+        self._finished = True
+        self._remove()
+
+    def fail(self, error=None):
+        """Record a failed attempt and release the item for a retry."""
+        failed_path = self.queue._path(self.key, f"{FAILED_MARK}{self.queue.worker_id}.{int(time.time() * 1000)}")
+        _create_exclusive(failed_path, {"worker": self.queue.worker_id, "error": error})
+        self.release()
+
+    def release(self):
+        """Give up the claim without completing the item."""
+        self._finished = True
+        self._remove()
+
+
+class LeaseQueue:
+    """
+    Claim work items from a lease directory shared by all workers of a job.
+
+    Args:
+        lease_dir (str): Directory on the shared filesystem holding the lease files.
+        worker_id (str): Identifier of this worker (default: host, pid and a random suffix).
+        lease_seconds (float): Time after which an unrenewed lease may be taken over.
+        steal_after (float): Age after which an item's lease may be backed up by
+            an idle worker. None disables backups of stragglers.
+        max_attempts (int): Failed attempts after which an item is given up.
+        poll_interval (float): Seconds between checks while waiting for other workers.
+    """
+
+    def __init__(self, lease_dir, worker_id=None, lease_seconds=300, steal_after=None,
+                 max_attempts=3, poll_interval=5.0):
+        self.lease_dir = lease_dir
+        self.worker_id = worker_id or default_worker_id()
+        self.lease_seconds = lease_seconds
+        self.steal_after = steal_after
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        os.makedirs(lease_dir, exist_ok=True)
+
+    def _path(self, key, suffix):
+        return os.path.join(self.lease_dir, f"{key}{suffix}")
+
+    def is_done(self, key):
+        return os.path.exists(self._path(key, DONE_SUFFIX))
+
+    def attempts(self, key):
+        """Return the number of failed attempts recorded for an item."""
+        prefix = f"{key}{FAILED_MARK}"
+        return sum(1 for name in os.listdir(self.lease_dir) if name.startswith(prefix))
+
+    def is_given_up(self, key):
+        return self.attempts(key) >= self.max_attempts
+
+    def _claim_path(self, key, path, backup):
+        lease = Lease(self, key, path, backup=backup)
+        if _create_exclusive(path, lease._record(time.time())):
+            # The item may have been completed between the check and the claim
+            if self.is_done(key):
+                lease.release()
+                return None
+            return lease
+        return None
+
+    def _take_over(self, key, path, backup=False):
+        """Claim an expired lease. Only the worker whose rename succeeds may claim it."""
+        with _lease_lock(path):
+            return self._take_over_locked(key, path, backup)
+
+    def _take_over_locked(self, key, path, backup):
+        current = _read_json(path)
+        if current is None or current.get("expires", 0) > time.time():
+            return None
+        stale_path = f"{path}.stale.{self.worker_id}"
+        try:
+            os.rename(path, stale_path)
+        except FileNotFoundError:
+            return None
+        renamed = _read_json(stale_path)
+        if renamed is not None and renamed.get("expires", 0) > time.time():
+            # The holder renewed just before the rename; put its lease back
+            try:
+                os.link(stale_path, path)
+            except FileExistsError:
+                pass
+            os.remove(stale_path)
+            return None
+        os.remove(stale_path)
+        print(f"Taking over expired lease on {key} from {current.get('worker')}")
+        return self._claim_path(key, path, backup)
+
+    def _try_claim(self, key):
+        if self.is_done(key) or self.is_given_up(key):
+            return None
+        path = self._path(key, LEASE_SUFFIX)
+        return self._claim_path(key, path, False) or self._take_over(key, path)
+
+    def _try_backup(self, key):
+        """Back up a straggler: a live lease held by another worker for longer than steal_after."""
+        if self.steal_after is None or self.is_done(key):
+            return None
+        current = _read_json(self._path(key, LEASE_SUFFIX))
+        if current is None or current.get("worker") == self.worker_id:
+            return None
+        if time.time() - current.get("claimed", time.time()) < self.steal_after:
+            return None
+        path = self._path(key, BACKUP_SUFFIX)
+        lease = self._claim_path(key, path, True) or self._take_over(key, path, backup=True)
+        if lease is not None:
+            print(f"Backing up straggler {key} held by {current.get('worker')}")
+        return lease
+
+    def remaining(self, keys):
+        """Return the keys that are neither done nor given up."""
+        return [key for key in keys if not self.is_done(key) and not self.is_given_up(key)]
+
+    def claim(self, keys):
+        """
+        Claim the next item, in the order of keys.
+
+        Free and expired items are claimed first, then stragglers are backed
+        up. Blocks while other workers hold the remaining items, and returns
+        None once every item is done or given up.
+        """
+        while True:
+            remaining = self.remaining(keys)
+            if not remaining:
+                return None
+            for key in remaining:
+                lease = self._try_claim(key)
+                if lease is not None:
+                    return lease
+            for key in remaining:
+                lease = self._try_backup(key)
+                if lease is not None:
+                    return lease
+            time.sleep(self.poll_interval)
+
+    def summary(self, keys):
+        """Return counts of done, given-up and remaining items."""
+        done = sum(1 for key in keys if self.is_done(key))
+        given_up = sum(1 for key in keys if not self.is_done(key) and self.is_given_up(key))
+        return {"done": done, "failed": given_up, "remaining": len(keys) - done - given_up}
+
+
+def run_worker(queue, keys, process, assemble=None):
+    """
+    Process items until all are done, then run the final assembly exactly once.
+
+    Args:
+        queue (LeaseQueue): The job's lease queue.
+        keys (list): Item keys, in the order they should be claimed.
+        process (callable): Called as process(key, lease); returns True if the
+            item's outputs were committed. It may raise LeaseLost (see Lease.check).
+        assemble (callable): Called once, by one worker, after every item is
+            done. Returns True on success.
+
+    Returns:
+        dict: The queue summary for keys.
+    """
+    while True:
+        lease = queue.claim(keys)
+        if lease is None:
+            break
+        with lease:
+            try:
+                ok = process(lease.key, lease)
+            except LeaseLost as e:
+                print(f"Stopped processing {lease.key}: {e}")
+                lease.release()
+                continue
+            except Exception as e:
+                print(f"Error processing {lease.key}: {e}")
+                lease.fail(str(e))
+                continue
+            if not ok:
+                lease.fail()
+            elif lease.renew():
+                # Renewed first: the heartbeat may not have seen a takeover yet
+                lease.complete()
+            else:
+                print(f"Not completing {lease.key}: its lease was taken over by another worker")
+                lease.release()
+
+    summary = queue.summary(keys)
+    if assemble is not None and summary["done"] == len(keys):
+        # The assembly is an item of its own, so a dead assembler is taken over too
+        while True:
+            lease = queue.claim(["assemble"])
+            if lease is None:
+                break
+            with lease:
+                if assemble():
+                    lease.complete()
+                else:
+                    lease.fail()
+    return summary